@@ -0,0 +1,45 @@
+"""
+Tareas de administración desde línea de comandos.
+
+    python -m backend.admin rebuild-rollups   # regenera spend_rollups
+    python -m backend.admin rebuild-search    # regenera el índice de texto completo
+    python -m backend.admin rebuild-chunks    # regenera los fragmentos BM25
+    python -m backend.admin prune-documents   # borra textos de documentos sin referencias
+    python -m backend.admin prune-files       # recalcula referencias y borra originales sin facturas
+    python -m backend.admin purge-logs        # retención y compactación de los logs de extracción
+    python -m backend.admin enrich-invoices   # completa con el LLM las facturas pendientes, omitidas o fallidas
+"""
+import argparse
+import logging
+
+from .database import SessionLocal, init_db
+from . import rollups, search, retrieval, documents, storage, extraction_logs, enrichment
+
+COMMANDS = {
+    "rebuild-rollups": rollups.rebuild_rollups,
+    "rebuild-search": search.rebuild_search_index,
+    "rebuild-chunks": retrieval.rebuild_chunks,
+    "prune-documents": documents.prune_documents,
+    "prune-files": storage.prune_files,
+    "purge-logs": extraction_logs.maintain_logs,
+    "enrich-invoices": enrichment.retry_enrichment,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tareas de administración de TFM Invoice Intelligence")
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    init_db()
+    db = SessionLocal()
+    try:
+        count = COMMANDS[args.command](db)
+        print(f"✅ {args.command}: {count} elementos")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,14 @@ from datetime import datetime
 import logging
 from pathlib import Path
 from sqlalchemy.orm import Session
-from .database import Provider, ExtractionLog, SystemSetting
+from .database import Provider, SystemSetting
+from .schemas import (
+    InvoiceExtraction, json_schema_for, openai_response_format,
+    parse_json_tolerant, validate_extraction
+)
+from .kpis import compute_kpis
+from .extraction_logs import record_extraction
+from .storage import write_atomic
 from google import genai
 from openai import OpenAI
 
@@ -54,9 +61,18 @@ def _configure_clients(db: Session = None):
     else:
         openai_client = None
 
-def call_ai_service(prompt: str, json_format: bool = False, db: Session = None) -> str:
-    """Función unificada para llamar al proveedor de IA configurado"""
-    
+# Contadores de extracción (llamadas, respuestas reparadas, llamadas desperdiciadas)
+EXTRACTION_STATS = {"llm_calls": 0, "parsed": 0, "repaired": 0, "failed": 0, "output_chars": 0}
+
+def call_ai_service(prompt: str, json_format: bool = False, db: Session = None, response_model: type = None) -> str:
+    """Función unificada para llamar al proveedor de IA configurado.
+
+    Si se indica `response_model` (modelo Pydantic), la salida se restringe a su
+    JSON schema en el proveedor (Ollama `format`, Gemini `response_schema`,
+    OpenAI structured outputs).
+    """
+    json_format = json_format or response_model is not None
+
     _configure_clients(db)
     logger.info(f"🤖 Llamando al servicio de IA: {AI_PROVIDER.upper()}")
     
@@ -67,6 +83,8 @@ def call_ai_service(prompt: str, json_format: bool = False, db: Session = None)
                 config = {}
                 if json_format:
                     config["response_mime_type"] = "application/json"
+                if response_model is not None:
+                    config["response_schema"] = response_model
                 response = gemini_client.models.generate_content(
                     model='gemini-2.0-flash',
                     contents=prompt,
@@ -86,7 +104,10 @@ def call_ai_service(prompt: str, json_format: bool = False, db: Session = None)
             response = openai_client.chat.completions.create(
                 model="gpt-4o",
                 messages=[{"role": "user", "content": prompt}],
-                response_format={"type": "json_object"} if json_format else None
+                response_format=(
+                    openai_response_format(response_model) if response_model is not None
+                    else {"type": "json_object"} if json_format else None
+                )
             )
             return response.choices[0].message.content
         except Exception as e:
@@ -99,7 +120,9 @@ def call_ai_service(prompt: str, json_format: bool = False, db: Session = None)
             "prompt": prompt,
             "stream": False
         }
-        if json_format:
+        if response_model is not None:
+            payload["format"] = json_schema_for(response_model)
+        elif json_format:
             payload["format"] = "json"
             
         try:
@@ -187,11 +210,24 @@ def get_text_from_image(image_path: str):
     except Exception as e:
         return f"OCR Error: {str(e)}"
 
-def extract_invoice_data(text: str, db: Session, filename: str = "unknown"):
-    """Workflow /extraer_factura - Extracción estandarizada con patrones en DB"""
-    
-    logger.info(f"🔍 Iniciando extracción de factura: {filename}...")
-    
+def extract_text(file_path: str) -> str:
+    """Texto de un fichero ya guardado: pdfplumber para PDF, Tesseract para imágenes"""
+    if file_path.lower().endswith(".pdf"):
+        return get_text_from_pdf(file_path)
+    return get_text_from_image(file_path)
+
+def save_and_extract_text(content: bytes, file_path: str) -> str:
+    """Guarda el fichero subido y extrae su texto (PDF o imagen).
+
+    Función de módulo sin estado para poder ejecutarse en el pool de procesos
+    de extracción (executors, pool "cpu").
+    """
+    if not os.path.exists(file_path):  # Ruta por contenido: si ya existe, es el mismo fichero
+        write_atomic(file_path, content)
+    return extract_text(file_path)
+
+def match_provider_patterns(text: str, db: Session) -> tuple:
+    """Fase regex: elige el proveedor con más coincidencias y devuelve (datos detectados, puntuaciones)"""
     extracted_hints = {}
     matched_provider = None
     best_score = -1
@@ -298,7 +334,14 @@ def extract_invoice_data(text: str, db: Session, filename: str = "unknown"):
         logger.warning("⚠️ No se identificó un proveedor específico")
     
     logger.info(f"📊 Datos detectados por Regex: {json.dumps(extracted_hints, ensure_ascii=False)}")
-    
+    return extracted_hints, debug_scores
+
+
+def llm_extract(text: str, extracted_hints: dict, db: Session = None) -> dict:
+    """Fase LLM: completa la extracción con el modelo. Las ayudas de regex tienen prioridad.
+
+    Lanza la excepción del proveedor si la llamada falla.
+    """
     # Cargar instrucciones específicas del workflow
     workflow_instructions = load_agent_file("workflows/extraer-factura.md")
     
@@ -310,66 +353,73 @@ def extract_invoice_data(text: str, db: Session, filename: str = "unknown"):
     DATOS DETECTADOS POR REGEX (Priorízalos si existen):
     {json.dumps(extracted_hints, ensure_ascii=False, indent=2)}
     
-    Extrae TODOS los siguientes campos en formato JSON:
-    
-    - invoice_number: {extracted_hints.get('invoice_number', 'Número de factura')}
-    - date: {extracted_hints.get('date', 'Formato YYYY-MM-DD')}
-    - vendor_name: {extracted_hints.get('vendor_name', 'Nombre de la empresa')}
-    - total_amount: {extracted_hints.get('total_amount', 'Importe decimal')}
-    - currency: EUR
-    - type: "Purchase"
-    - category: {extracted_hints.get('category', 'Telecom, Electricity, Gas, Water u Other')}
-    - consumption: Número de consumo o null
-    - consumption_unit: kWh, m3, GB o null
-    - unit_price: Precio unitario o null
-    - period: Periodo facturación
-    - taxes: Impuestos totales
-    - power: Potencia contratada o null
-    - observations: Notas importantes o null
+    Rellena el esquema JSON de la respuesta (usa null si un dato no aparece):
+    - date en formato YYYY-MM-DD, importes y consumos como números decimales.
+    - category: Telecom, Electricity, Gas, Water u Other.
+    - consumption_unit: kWh, m3, GB o null.
     
     Texto factura (primeros 2500 caracteres):
     {text[:2500]}
-    
-    Devuelve JSON válido.
     """
     
+    # Salida restringida al esquema InvoiceExtraction en el proveedor
+    result_text = call_ai_service(prompt, db=db, response_model=InvoiceExtraction)
+    EXTRACTION_STATS["llm_calls"] += 1
+    EXTRACTION_STATS["output_chars"] += len(result_text or "")
+    
+    try:
+        raw_data = json.loads(result_text)
+    except (json.JSONDecodeError, TypeError):
+        # Markdown, texto extra o salida truncada: parser tolerante
+        raw_data = parse_json_tolerant(result_text)
+        EXTRACTION_STATS["repaired"] += 1
+        logger.warning("⚠️ Respuesta JSON reparada por el parser tolerante")
+    final_data = validate_extraction(raw_data)
+    EXTRACTION_STATS["parsed"] += 1
+    
+    # Post-procesamiento: forzar las ayudas detectadas por regex
+    for key in ['invoice_number', 'date', 'category', 'vendor_name', 'total_amount']:
+        if extracted_hints.get(key):
+            final_data[key] = extracted_hints[key]
+    return final_data
+
+
+def regex_only_data(extracted_hints: dict, notes: str = None) -> dict:
+    """Datos de la factura solo con lo detectado por regex (sin LLM)"""
+    data = {
+        "invoice_number": extracted_hints.get('invoice_number', "unknown"),
+        "date": extracted_hints.get('date', None),
+        "category": extracted_hints.get('category', "Other"),
+        "vendor_name": extracted_hints.get('vendor_name', "Unknown"),
+        "total_amount": extracted_hints.get('total_amount', 0.0),
+        "currency": "EUR",
+        "type": "Purchase",
+    }
+    if notes:
+        data["notes"] = notes
+    return data
+
+
+def extract_invoice_data(text: str, db: Session, filename: str = "unknown"):
+    """Workflow /extraer_factura - Extracción estandarizada con patrones en DB"""
+    
+    logger.info(f"🔍 Iniciando extracción de factura: {filename}...")
+    extracted_hints, debug_scores = match_provider_patterns(text, db)
+    
     final_data = {}
     try:
-        # Usar la función unificada
-        result_text = call_ai_service(prompt, json_format=True, db=db)
-        
-        # Limpieza básica por si el modelo devuelve markdown code blocks
-        clean_text = result_text.replace("```json", "").replace("```", "").strip()
-        final_data = json.loads(clean_text)
-        
-        # Post-procesamiento: forzar las ayudas detectadas por regex
-        for key in ['invoice_number', 'date', 'category', 'vendor_name', 'total_amount']:
-            if extracted_hints.get(key):
-                final_data[key] = extracted_hints[key]
+        final_data = llm_extract(text, extracted_hints, db)
 
         # Guardar Log de Extracción en DB
-        log = ExtractionLog(
-            file_name=filename,
-            raw_text=text[:5000],
-            matching_scores=debug_scores,
-            final_json=final_data
-        )
-        db.add(log)
-        db.commit()
+        # Texto: mismo documento que la factura (deduplicado por hash); solo las mejores puntuaciones
+        record_extraction(db, filename, text, debug_scores, final_data)
         
     except Exception as e:
         logger.error(f"❌ Error en Ollama o Guardado de Log: {e}")
+        if not final_data:
+            EXTRACTION_STATS["failed"] += 1
         # Si falla la IA, devolvemos lo que tenemos de regex
-        final_data = {
-            "invoice_number": extracted_hints.get('invoice_number', "unknown"),
-            "date": extracted_hints.get('date', None),
-            "category": extracted_hints.get('category', "Other"),
-            "vendor_name": extracted_hints.get('vendor_name', "Unknown"),
-            "total_amount": extracted_hints.get('total_amount', 0.0),
-            "currency": "EUR",
-            "type": "Purchase",
-            "notes": f"Extraído vía Regex (IA falló: {str(e)[:50]})"
-        }
+        final_data = regex_only_data(extracted_hints, f"Extraído vía Regex (IA falló: {str(e)[:50]})")
 
     return json.dumps(final_data, ensure_ascii=False)
 
@@ -423,8 +473,8 @@ def generate_kpis_direccion(invoices_data: list, db: Session = None):
     
     TAREA: Generar KPIs ejecutivos para presentación a dirección.
     
-    Datos de facturas:
-    {json.dumps(invoices_data, indent=2)}
+    KPIs precalculados (cifras exactas, no las recalcules):
+    {json.dumps(compute_kpis(invoices_data), ensure_ascii=False)}
     
     FORMATO DE SALIDA:
     ## KPIs PRINCIPALES
@@ -473,7 +523,8 @@ def generate_kpis_reclamacion(invoice_data: dict, contract_data: dict = None, hi
     
     return call_ai_service(prompt, db=db)
 
-def compare_supplier(current_invoice: dict, historical_invoices: list = None, alternative_supplier: dict = None, db: Session = None):
+def compare_supplier(current_invoice: dict, historical_invoices: list = None, alternative_supplier: dict = None,
+                     benchmark: list = None, db: Session = None):
     """Workflow /comparar_proveedor - Benchmarking comparativo"""
     # Cargar instrucciones workflow
     workflow_instructions = load_agent_file("workflows/comparar-proveedor.md")
@@ -494,6 +545,9 @@ def compare_supplier(current_invoice: dict, historical_invoices: list = None, al
     Proveedor alternativo:
     {json.dumps(alternative_supplier, indent=2) if alternative_supplier else "No disponible"}
     
+    Tabla comparativa de coste por unidad (precalculada con todas las facturas, cifras exactas):
+    {json.dumps(benchmark, ensure_ascii=False) if benchmark else "No disponible"}
+    
     FORMATO DE SALIDA:
     ## COMPARATIVA DE PRECIOS
     [Tabla comparativa]
@@ -519,8 +573,8 @@ def generate_meeting_summary(invoices_data: list, issues: list = None, db: Sessi
     
     TAREA: Preparar mensaje ejecutivo para dirección.
     
-    Datos de facturas del periodo:
-    {json.dumps(invoices_data, indent=2)}
+    KPIs del periodo precalculados (cifras exactas, no las recalcules):
+    {json.dumps(compute_kpis(invoices_data or []), ensure_ascii=False)}
     
     Incidencias detectadas:
     {json.dumps(issues, indent=2) if issues else "Ninguna"}
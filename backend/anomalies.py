@@ -0,0 +1,154 @@
+"""
+Escaneo masivo de anomalías con NumPy (antes de cualquier llamada al LLM).
+
+Carga importe, consumo, precio por unidad y fecha de todas las facturas en
+arrays y calcula en una sola pasada vectorizada, por proveedor:
+- desviación del importe y del precio por unidad respecto a la media,
+- z-score del importe,
+- saltos respecto a la factura anterior del mismo proveedor (consumo y precio),
+comparando con los umbrales consumption_increase_pct / price_deviation_pct.
+Solo las facturas marcadas se envían después a check_alerts para la narrativa.
+"""
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .database import Invoice
+from .reports import apply_filters
+
+DEFAULT_THRESHOLDS = {
+    "consumption_increase_pct": 20,
+    "price_deviation_pct": 15,
+    "zscore": 2.5,
+    "min_history": 3,  # facturas mínimas del proveedor para calcular medias y z-scores
+}
+
+
+def load_arrays(db: Session, **filters) -> dict:
+    """Columnas necesarias como arrays NumPy, ordenadas por proveedor y fecha"""
+    rows = apply_filters(db.query(
+        Invoice.id, Invoice.vendor_name, Invoice.category, Invoice.date,
+        Invoice.total_amount, Invoice.consumption, Invoice.consumption_unit
+    ), **filters).order_by(Invoice.vendor_name, Invoice.date, Invoice.id).all()
+
+    ids, vendors, categories, dates, amounts, consumption, units = zip(*rows) if rows else ([],) * 7
+    amounts = np.array([np.nan if a is None else a for a in amounts], dtype=float)
+    consumption = np.array([np.nan if not c or c <= 0 else c for c in consumption], dtype=float)
+    vendor_names, vendor_codes = np.unique(np.array([v or "" for v in vendors], dtype=object), return_inverse=True)
+    return {
+        "id": np.array(ids, dtype=np.int64),
+        "vendor": vendor_codes.astype(np.int64),
+        "vendor_names": vendor_names,
+        "category": list(categories),
+        "unit": list(units),
+        "date": np.array([np.datetime64(d, "D") if d else np.datetime64("NaT") for d in dates], dtype="datetime64[D]"),
+        "amount": amounts,
+        "consumption": consumption,
+        "price": amounts / consumption,  # NaN si no hay consumo
+    }
+
+
+def _group_mean_std(values: np.ndarray, groups: np.ndarray, n_groups: int):
+    """Media, desviación típica y nº de valores válidos por grupo (ignorando NaN)"""
+    valid = ~np.isnan(values)
+    clean = np.where(valid, values, 0.0)
+    count = np.bincount(groups, weights=valid.astype(float), minlength=n_groups)
+    total = np.bincount(groups, weights=clean, minlength=n_groups)
+    squares = np.bincount(groups, weights=clean * clean, minlength=n_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / count
+        std = np.sqrt(np.maximum(squares / count - mean * mean, 0.0))
+    return mean, std, count
+
+
+def _previous(values: np.ndarray, groups: np.ndarray) -> np.ndarray:
+    """Valor de la factura anterior del mismo proveedor (NaN en la primera)"""
+    prev = np.full_like(values, np.nan)
+    if len(values) > 1:
+        same = groups[1:] == groups[:-1]
+        prev[1:] = np.where(same, values[:-1], np.nan)
+    return prev
+
+
+def _pct_change(current: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(reference > 0, (current - reference) / reference * 100.0, np.nan)
+
+
+def scan_anomalies(db: Session, thresholds: dict = None, **filters) -> dict:
+    """Marca las facturas anómalas. Devuelve {"scanned", "flagged", "alerts"}"""
+    limits = {**DEFAULT_THRESHOLDS, **(thresholds or {})}
+    data = load_arrays(db, **filters)
+    n = len(data["id"])
+    if n == 0:
+        return {"scanned": 0, "flagged": 0, "thresholds": limits, "alerts": []}
+
+    groups = data["vendor"]
+    n_groups = len(data["vendor_names"])
+    amount, consumption, price = data["amount"], data["consumption"], data["price"]
+
+    amount_mean, amount_std, amount_count = _group_mean_std(amount, groups, n_groups)
+    price_mean, _, price_count = _group_mean_std(price, groups, n_groups)
+    enough_amounts = amount_count[groups] >= limits["min_history"]
+    enough_prices = price_count[groups] >= limits["min_history"]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        zscore = np.where(amount_std[groups] > 0, (amount - amount_mean[groups]) / amount_std[groups], 0.0)
+    amount_dev = _pct_change(amount, amount_mean[groups])
+    price_dev = _pct_change(price, price_mean[groups])
+    consumption_jump = _pct_change(consumption, _previous(consumption, groups))
+    price_jump = _pct_change(price, _previous(price, groups))
+
+    flags = {
+        "importe_atipico": enough_amounts & (np.abs(zscore) >= limits["zscore"]),
+        "desviacion_precio": enough_prices & (np.abs(np.nan_to_num(price_dev)) > limits["price_deviation_pct"]),
+        "salto_consumo": np.nan_to_num(consumption_jump) > limits["consumption_increase_pct"],
+        "salto_precio": np.abs(np.nan_to_num(price_jump)) > limits["price_deviation_pct"],
+    }
+    flag_matrix = np.column_stack(list(flags.values()))
+    flag_count = flag_matrix.sum(axis=1)
+    severe = (flag_count >= 2) | (np.abs(zscore) >= limits["zscore"] + 1) \
+        | (np.nan_to_num(consumption_jump) > 2 * limits["consumption_increase_pct"]) \
+        | (np.abs(np.nan_to_num(price_jump)) > 2 * limits["price_deviation_pct"])
+
+    flagged = np.flatnonzero(flag_count > 0)
+    # Primero las más graves y, dentro de ellas, las de mayor z-score
+    order = flagged[np.lexsort((-np.abs(zscore[flagged]), -flag_count[flagged], ~severe[flagged]))]
+    names = list(flags)
+
+    def _round(value):
+        return None if np.isnan(value) else round(float(value), 2)
+
+    alerts = []
+    for i in order:
+        vendor = data["vendor_names"][groups[i]] or None
+        alerts.append({
+            "invoice_id": int(data["id"][i]),
+            "vendor": vendor,
+            "category": data["category"][i],
+            "date": None if np.isnat(data["date"][i]) else str(data["date"][i]),
+            "total": _round(amount[i]),
+            "consumption": _round(consumption[i]),
+            "unit": data["unit"][i],
+            "price_per_unit": None if np.isnan(price[i]) else round(float(price[i]), 4),
+            "severity": "ALTA" if severe[i] else "MEDIA",
+            "reasons": [name for name, flag in zip(names, flag_matrix[i]) if flag],
+            "zscore": round(float(zscore[i]), 2),
+            "amount_deviation_pct": _round(amount_dev[i]),
+            "price_deviation_pct": _round(price_dev[i]),
+            "consumption_jump_pct": _round(consumption_jump[i]),
+            "price_jump_pct": _round(price_jump[i]),
+            "vendor_avg_total": _round(amount_mean[groups[i]]),
+            "vendor_avg_price": None if np.isnan(price_mean[groups[i]]) else round(float(price_mean[groups[i]]), 4),
+        })
+    return {"scanned": n, "flagged": len(alerts), "thresholds": limits, "alerts": alerts}
+
+
+def historical_averages(db: Session, invoice: Invoice) -> dict:
+    """Promedios de la categoría (sin la propia factura) calculados con AVG en SQL"""
+    count, avg_consumption, avg_total = db.query(
+        func.count(Invoice.id), func.avg(func.coalesce(Invoice.consumption, 0.0)), func.avg(Invoice.total_amount)
+    ).filter(Invoice.category == invoice.category, Invoice.id != invoice.id).one()
+    if not count:
+        return None
+    return {"avg_consumption": avg_consumption or 0.0, "avg_total": avg_total or 0.0}
@@ -0,0 +1,151 @@
+"""
+Benchmark de concurrencia: latencia del health check durante una subida masiva.
+
+Mientras se suben facturas en paralelo (OCR/pdfplumber + LLM + escritura en
+la base de datos), un sondeo pide GET / cada pocos milisegundos. Si el
+trabajo bloqueante está fuera del bucle de eventos (backend/executors.py),
+el health check responde igual de rápido que con la API en reposo.
+
+Uso:
+    # Autocontenido: LLM falso + API sobre SQLite en este proceso
+    python -m backend.bench.concurrency --spawn --uploads 40 --concurrency 8
+
+    # Contra una API ya levantada (uvicorn en otro proceso)
+    python -m backend.bench.concurrency --base-url http://localhost:8000
+"""
+import argparse
+import http.client
+import json
+import multiprocessing
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+
+from .loadtest import percentile, synthetic_invoice_text, synthetic_pdf, spawn_stack
+
+
+class Prober:
+    """Health checks sobre una conexión keep-alive (http.client: mínima sobrecarga en el cliente)"""
+
+    def __init__(self, base_url: str):
+        parts = urlsplit(base_url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+
+    def __call__(self) -> float:
+        """Latencia (ms) de un GET /"""
+        started = time.perf_counter()
+        self.conn.request("GET", "/")
+        response = self.conn.getresponse()
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"Health check con estado {response.status}")
+        return (time.perf_counter() - started) * 1000
+
+
+def _probe_until(base_url: str, interval_ms: float, done, results):
+    """(Proceso hijo) health checks continuos hasta que se marca done"""
+    probe = Prober(base_url)
+    probe()
+    results.put("ready")
+    latencies = []
+    while not done.is_set():
+        latencies.append(probe())
+        time.sleep(interval_ms / 1000)
+    results.put(latencies)
+
+
+def summarize(latencies: list) -> dict:
+    return {
+        "samples": len(latencies),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "max_ms": round(max(latencies), 3) if latencies else 0.0,
+    }
+
+
+def run(base_url: str, uploads: int = 40, concurrency: int = 8, idle_probes: int = 200,
+        interval_ms: float = 5, seed: int = 42) -> dict:
+    probe = Prober(base_url)
+    probe()  # calentar la conexión
+
+    idle = [probe() for _ in range(idle_probes)]
+
+    run_id = f"{int(time.time())}{seed}"
+    errors = []
+
+    def upload(seq: int):
+        text = synthetic_invoice_text(seq, random.Random(seed + seq))
+        files = {"file": (f"concurrency_{run_id}_{seq:05d}.pdf", synthetic_pdf(text), "application/pdf")}
+        resp = requests.post(base_url + "/upload", files=files, timeout=300)
+        if resp.status_code != 200 or resp.json().get("status") == "error":
+            errors.append(seq)
+
+    # El sondeo va en otro proceso: los hilos de subida no le quitan el GIL al cliente
+    ctx = multiprocessing.get_context("spawn")
+    done, results = ctx.Event(), ctx.Queue()
+    watcher = ctx.Process(target=_probe_until, args=(base_url, interval_ms, done, results), daemon=True)
+    watcher.start()
+    results.get()  # el sondeo ya está midiendo
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(upload, range(uploads)))
+    wall = time.perf_counter() - started
+    done.set()
+    busy = results.get()
+    watcher.join()
+
+    return {
+        "uploads": uploads,
+        "concurrency": concurrency,
+        "upload_errors": len(errors),
+        "upload_wall_seconds": round(wall, 3),
+        "uploads_per_second": round(uploads / wall, 2) if wall else 0.0,
+        "health_idle": summarize(idle),
+        "health_during_uploads": summarize(busy),
+    }
+
+
+def format_report(result: dict) -> str:
+    lines = [
+        f"Subidas: {result['uploads']} (concurrencia {result['concurrency']}) en {result['upload_wall_seconds']}s "
+        f"→ {result['uploads_per_second']} /s, errores: {result['upload_errors']}",
+        f"{'health check':<18} {'n':>6} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8} {'maxms':>8}",
+    ]
+    for label, key in (("en reposo", "health_idle"), ("durante subidas", "health_during_uploads")):
+        s = result[key]
+        lines.append(f"{label:<18} {s['samples']:>6} {s['p50_ms']:>8.3f} {s['p95_ms']:>8.3f} "
+                     f"{s['p99_ms']:>8.3f} {s['max_ms']:>8.3f}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Latencia del health check durante una subida masiva")
+    parser.add_argument("--base-url", default=None, help="URL de una API ya levantada")
+    parser.add_argument("--spawn", action="store_true", help="Levantar LLM falso + API sobre SQLite en proceso")
+    parser.add_argument("--uploads", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--idle-probes", type=int, default=200)
+    parser.add_argument("--interval-ms", type=float, default=5, help="Pausa entre sondeos durante las subidas")
+    parser.add_argument("--latency-ms", type=float, default=200, help="(spawn) latencia del LLM falso")
+    parser.add_argument("--json", dest="json_out", default=None, help="Guardar el resultado en JSON")
+    args = parser.parse_args(argv)
+
+    if not args.base_url and not args.spawn:
+        parser.error("indica --base-url o --spawn")
+    base_url = args.base_url or spawn_stack(args.latency_ms, 0)[0]
+
+    result = run(base_url, uploads=args.uploads, concurrency=args.concurrency,
+                 idle_probes=args.idle_probes, interval_ms=args.interval_ms)
+    print(format_report(result))
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Servidor LLM falso y determinista que habla el protocolo de Ollama (/api/generate).
+
+Sirve para medir el pipeline sin depender de Ollama, Gemini u OpenAI:
+la latencia, la velocidad de generación y las respuestas son configurables
+y reproducibles.
+
+Uso:
+    python -m backend.bench.fake_llm --port 11434 --latency-ms 200 --tokens-per-sec 40
+    OLLAMA_URL=http://localhost:11434/api/generate uvicorn backend.main:app
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timezone
+from typing import Optional, Union
+
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+# Respuestas por defecto (se pueden sustituir con FAKE_LLM_RESPONSES=<fichero.json>)
+DEFAULT_RESPONSES = {
+    "json": {
+        "invoice_number": "FAKE-{prompt_hash}",
+        "date": "2025-01-15",
+        "vendor_name": "Proveedor Simulado",
+        "total_amount": 123.45,
+        "currency": "EUR",
+        "type": "Purchase",
+        "category": "Electricity",
+        "consumption": 250.0,
+        "consumption_unit": "kWh",
+        "unit_price": 0.15,
+        "period": "01/12/2024 - 31/12/2024",
+        "taxes": 21.43,
+        "power": 4.6,
+        "observations": None
+    },
+    "text": (
+        "## KPIs PRINCIPALES\n"
+        "- Gasto total: 123.45 EUR\n"
+        "## ANÁLISIS EJECUTIVO\n"
+        "- Respuesta simulada por el servidor LLM de benchmark.\n"
+        "## ACCIONES RECOMENDADAS\n"
+        "- Ninguna (entorno de pruebas)."
+    )
+}
+
+
+class FakeLLMConfig:
+    """Parámetros de simulación (leídos de variables de entorno)"""
+
+    def __init__(self, latency_ms: float = None, jitter_ms: float = None,
+                 tokens_per_sec: float = None, responses_path: str = None):
+        self.latency_ms = float(latency_ms if latency_ms is not None else os.getenv("FAKE_LLM_LATENCY_MS", 100))
+        self.jitter_ms = float(jitter_ms if jitter_ms is not None else os.getenv("FAKE_LLM_JITTER_MS", 0))
+        self.tokens_per_sec = float(tokens_per_sec if tokens_per_sec is not None else os.getenv("FAKE_LLM_TOKENS_PER_SEC", 0))
+        self.responses = dict(DEFAULT_RESPONSES)
+        responses_path = responses_path or os.getenv("FAKE_LLM_RESPONSES")
+        if responses_path:
+            with open(responses_path, "r", encoding="utf-8") as f:
+                self.responses.update(json.load(f))
+
+
+class GenerateRequest(BaseModel):
+    model_config = {"extra": "allow"}
+    model: str = "fake"
+    prompt: str = ""
+    stream: bool = True  # Ollama hace streaming por defecto
+    format: Optional[Union[str, dict]] = None
+
+
+def count_tokens(text: str) -> int:
+    """Aproximación de tokens (≈ 4 caracteres por token)"""
+    return max(1, len(text) // 4)
+
+
+def _jitter(prompt: str, jitter_ms: float) -> float:
+    """Jitter determinista derivado del prompt (mismo prompt → misma latencia)"""
+    if jitter_ms <= 0:
+        return 0.0
+    digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+    return (int.from_bytes(digest[:4], "big") / 0xFFFFFFFF) * jitter_ms
+
+
+def render_response(req: GenerateRequest, config: FakeLLMConfig) -> str:
+    """Devuelve la respuesta enlatada adecuada al tipo de petición.
+
+    El marcador {prompt_hash} se sustituye por un hash corto del prompt para que
+    documentos distintos produzcan números de factura distintos (y deterministas).
+    """
+    prompt_hash = hashlib.sha256(req.prompt.encode("utf-8")).hexdigest()[:10]
+    if req.format:
+        text = json.dumps(config.responses["json"], ensure_ascii=False)
+    else:
+        text = config.responses["text"]
+    return text.replace("{prompt_hash}", prompt_hash)
+
+
+def create_app(config: FakeLLMConfig = None) -> FastAPI:
+    config = config or FakeLLMConfig()
+    app = FastAPI(title="Fake Ollama")
+    app.state.config = config
+    app.state.stats = {"requests": 0, "prompt_tokens": 0, "output_tokens": 0}
+
+    @app.get("/")
+    async def root():
+        return {"status": "healthy", "service": "Fake Ollama"}
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": "qwen2.5:3b"}]}
+
+    @app.get("/stats")
+    async def stats():
+        return app.state.stats
+
+    @app.post("/api/generate")
+    async def generate(req: GenerateRequest):
+        text = render_response(req, config)
+        prompt_tokens = count_tokens(req.prompt)
+        output_tokens = count_tokens(text)
+        app.state.stats["requests"] += 1
+        app.state.stats["prompt_tokens"] += prompt_tokens
+        app.state.stats["output_tokens"] += output_tokens
+
+        first_token_s = (config.latency_ms + _jitter(req.prompt, config.jitter_ms)) / 1000
+        eval_s = output_tokens / config.tokens_per_sec if config.tokens_per_sec > 0 else 0.0
+        started = time.perf_counter()
+
+        def _final(response: str, elapsed: float) -> dict:
+            return {
+                "model": req.model,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                "response": response,
+                "done": True,
+                "done_reason": "stop",
+                "total_duration": int(elapsed * 1e9),
+                "prompt_eval_count": prompt_tokens,
+                "eval_count": output_tokens,
+                "eval_duration": int(eval_s * 1e9)
+            }
+
+        if not req.stream:
+            await asyncio.sleep(first_token_s + eval_s)
+            return _final(text, time.perf_counter() - started)
+
+        async def _stream():
+            await asyncio.sleep(first_token_s)
+            step = 16
+            per_piece = eval_s * step / max(len(text), 1)
+            for i in range(0, len(text), step):
+                if per_piece:
+                    await asyncio.sleep(per_piece)
+                piece = {"model": req.model, "response": text[i:i + step], "done": False}
+                yield json.dumps(piece, ensure_ascii=False) + "\n"
+            yield json.dumps(_final("", time.perf_counter() - started)) + "\n"
+
+        return StreamingResponse(_stream(), media_type="application/x-ndjson")
+
+    return app
+
+
+app = create_app()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor LLM falso (protocolo Ollama)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency-ms", type=float, default=None, help="Latencia hasta el primer token")
+    parser.add_argument("--jitter-ms", type=float, default=None, help="Jitter determinista máximo")
+    parser.add_argument("--tokens-per-sec", type=float, default=None, help="Velocidad de generación (0 = instantánea)")
+    parser.add_argument("--responses", default=None, help="JSON con respuestas enlatadas {'json': {...}, 'text': '...'}")
+    args = parser.parse_args()
+
+    import uvicorn
+    config = FakeLLMConfig(args.latency_ms, args.jitter_ms, args.tokens_per_sec, args.responses)
+    print(f"🤖 Fake LLM en {args.host}:{args.port} (latencia={config.latency_ms}ms, {config.tokens_per_sec or '∞'} tok/s)")
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
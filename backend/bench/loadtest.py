@@ -0,0 +1,300 @@
+"""
+Generador de carga extremo a extremo para la API de facturas.
+
+Lanza peticiones concurrentes contra /upload, /chat y /workflow/* y reporta
+throughput, latencias p50/p95/p99 y tasa de errores por escenario.
+
+Modos:
+    # Contra una instancia ya levantada
+    python -m backend.bench.loadtest --base-url http://localhost:8000
+
+    # Autocontenido: levanta el LLM falso y la app sobre SQLite en este proceso
+    python -m backend.bench.loadtest --spawn --requests 300 --concurrency 16
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+CHAT_QUERIES = [
+    "¿Cuánto hemos gastado en total?",
+    "¿Cuánto gastamos en luz en diciembre?",
+    "Total Som Energia 2024",
+    "¿Cuál es el número de factura de la última factura de O2?",
+    "¿Qué proveedor ha subido más de precio?",
+]
+
+WORKFLOWS_GLOBAL = ["kpis-direccion", "resumen-reunion"]
+WORKFLOWS_INVOICE = ["validar-factura", "alertas", "comparar-proveedor", "kpis-reclamacion"]
+
+VENDORS = [
+    ("Som Energia", "Electricity", "kWh"),
+    ("Iberdrola", "Electricity", "kWh"),
+    ("Naturgy", "Gas", "m3"),
+    ("Canal de Isabel II", "Water", "m3"),
+    ("O2", "Telecom", "GB"),
+]
+
+
+def percentile(values: list, pct: float) -> float:
+    """Percentil por rango más cercano (devuelve 0 si no hay muestras)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = math.ceil(pct / 100 * len(ordered))
+    return ordered[min(len(ordered), max(1, rank)) - 1]
+
+
+def synthetic_invoice_text(seq: int, rng: random.Random) -> str:
+    """Texto de factura sintético y determinista"""
+    vendor, category, unit = VENDORS[seq % len(VENDORS)]
+    month = seq % 12 + 1
+    year = 2024 + (seq // 12) % 2
+    consumption = rng.randint(50, 900)
+    total = round(consumption * rng.uniform(0.1, 0.3) + 15, 2)
+    return "\n".join([
+        f"{vendor}",
+        f"N.º de factura: LT{year}{seq:06d}",
+        f"Fecha de la factura: 15/{month:02d}/{year}",
+        f"Suministro: {category}",
+        f"Consumo total: {consumption} {unit}",
+        f"Importe total: {total:.2f} EUR",
+    ])
+
+
+def synthetic_pdf(text: str) -> bytes:
+    """Construye un PDF mínimo (una página, Helvetica) con el texto dado"""
+    def _escape(line: str) -> str:
+        return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    lines = text.split("\n")
+    stream = "BT /F1 11 Tf 14 TL 50 780 Td " + " ".join(f"({_escape(l)}) '" for l in lines) + " ET"
+    stream_bytes = stream.encode("latin-1", errors="replace")
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R "
+        b"/Resources << /Font << /F1 5 0 R >> >> >>",
+        b"<< /Length " + str(len(stream_bytes)).encode() + b" >>\nstream\n" + stream_bytes + b"\nendstream",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>",
+    ]
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n".encode() + obj + b"\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for off in offsets:
+        out += f"{off:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+
+class LoadTest:
+    """Ejecuta una mezcla ponderada de escenarios y acumula las muestras"""
+
+    def __init__(self, base_url: str, concurrency: int = 8, weights: dict = None,
+                 seed: int = 42, timeout: float = 300):
+        self.base_url = base_url.rstrip("/")
+        self.concurrency = concurrency
+        self.weights = weights or {"upload": 1, "chat": 2, "workflow": 2}
+        self.rng = random.Random(seed)
+        self.timeout = timeout
+        self.invoice_ids = []
+        self.samples = []  # (escenario, endpoint, latencia_s, ok)
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._local = threading.local()
+        self._run_id = f"{int(time.time())}{seed}"
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _record(self, scenario: str, endpoint: str, started: float, ok: bool):
+        with self._lock:
+            self.samples.append((scenario, endpoint, time.perf_counter() - started, ok))
+
+    def _call(self, scenario: str, endpoint: str, method: str, **kwargs):
+        started = time.perf_counter()
+        ok = False
+        body = None
+        try:
+            resp = self._session().request(method, self.base_url + endpoint, timeout=self.timeout, **kwargs)
+            body = resp.json() if resp.headers.get("content-type", "").startswith("application/json") else None
+            ok = resp.status_code == 200 and not (isinstance(body, dict) and body.get("status") == "error")
+        except Exception:
+            ok = False
+        self._record(scenario, endpoint, started, ok)
+        return body
+
+    def upload(self):
+        seq = next(self._seq)
+        text = synthetic_invoice_text(seq, random.Random(seq))
+        name = f"loadtest_{self._run_id}_{seq:06d}.pdf"
+        files = {"file": (name, synthetic_pdf(text), "application/pdf")}
+        body = self._call("upload", "/upload", "POST", files=files)
+        if isinstance(body, dict) and body.get("invoice", {}).get("id"):
+            with self._lock:
+                self.invoice_ids.append(body["invoice"]["id"])
+
+    def chat(self):
+        query = CHAT_QUERIES[next(self._seq) % len(CHAT_QUERIES)]
+        self._call("chat", "/chat", "POST", json={"query": query})
+
+    def workflow(self):
+        seq = next(self._seq)
+        with self._lock:
+            ids = list(self.invoice_ids)
+        if ids and seq % 3:
+            name = WORKFLOWS_INVOICE[seq % len(WORKFLOWS_INVOICE)]
+            self._call("workflow", f"/workflow/{name}", "POST", json={"invoice_id": ids[seq % len(ids)]})
+        else:
+            name = WORKFLOWS_GLOBAL[seq % len(WORKFLOWS_GLOBAL)]
+            self._call("workflow", f"/workflow/{name}", "POST", json={})
+
+    def seed(self, count: int):
+        """Sube facturas iniciales para que chat y workflows tengan datos"""
+        for _ in range(count):
+            self.upload()
+        self.samples.clear()
+
+    def run(self, total_requests: int) -> dict:
+        scenarios = [name for name, w in self.weights.items() for _ in range(int(w))]
+        plan = [self.rng.choice(scenarios) for _ in range(total_requests)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for _ in pool.map(lambda name: getattr(self, name)(), plan):
+                pass
+        return self.report(time.perf_counter() - started)
+
+    def report(self, wall_s: float) -> dict:
+        groups = {}
+        for scenario, _, latency, ok in self.samples:
+            groups.setdefault(scenario, []).append((latency, ok))
+        groups["total"] = [(lat, ok) for _, _, lat, ok in self.samples]
+
+        result = {"wall_seconds": round(wall_s, 3), "concurrency": self.concurrency, "scenarios": {}}
+        for name, rows in groups.items():
+            latencies = [lat * 1000 for lat, _ in rows]
+            errors = sum(1 for _, ok in rows if not ok)
+            result["scenarios"][name] = {
+                "requests": len(rows),
+                "errors": errors,
+                "error_rate": round(errors / len(rows), 4) if rows else 0.0,
+                "throughput_rps": round(len(rows) / wall_s, 2) if wall_s > 0 else 0.0,
+                "p50_ms": round(percentile(latencies, 50), 2),
+                "p95_ms": round(percentile(latencies, 95), 2),
+                "p99_ms": round(percentile(latencies, 99), 2),
+            }
+        return result
+
+
+def format_report(result: dict) -> str:
+    lines = [
+        f"Duración: {result['wall_seconds']}s | Concurrencia: {result['concurrency']}",
+        f"{'escenario':<10} {'req':>6} {'err%':>7} {'rps':>8} {'p50ms':>9} {'p95ms':>9} {'p99ms':>9}",
+    ]
+    for name, s in result["scenarios"].items():
+        lines.append(
+            f"{name:<10} {s['requests']:>6} {s['error_rate'] * 100:>6.1f}% {s['throughput_rps']:>8.2f} "
+            f"{s['p50_ms']:>9.1f} {s['p95_ms']:>9.1f} {s['p99_ms']:>9.1f}"
+        )
+    if result.get("llm"):
+        llm = result["llm"]
+        lines.append(f"LLM: {llm['requests']} llamadas | {llm['prompt_tokens']} tokens prompt | {llm['output_tokens']} tokens salida")
+    return "\n".join(lines)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _serve(app, port: int):
+    """Arranca uvicorn en un hilo y espera a que acepte conexiones"""
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def spawn_stack(latency_ms: float, tokens_per_sec: float, workdir: str = None) -> tuple:
+    """Levanta LLM falso + API sobre SQLite en este proceso; devuelve (url_api, url_llm)"""
+    from backend.bench.fake_llm import FakeLLMConfig, create_app
+
+    llm_port = _free_port()
+    _serve(create_app(FakeLLMConfig(latency_ms=latency_ms, tokens_per_sec=tokens_per_sec)), llm_port)
+
+    workdir = workdir or tempfile.mkdtemp(prefix="loadtest_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'loadtest.db')}"
+    # Los PDFs sintéticos van al directorio temporal, no al almacén del repositorio
+    os.environ["STORAGE_DIR"] = os.path.join(workdir, "storage")
+    os.environ["OLLAMA_URL"] = f"http://127.0.0.1:{llm_port}/api/generate"
+    os.environ["AI_PROVIDER"] = "ollama"
+    os.environ["TESTING"] = "false"
+    from backend.main import app
+
+    app_port = _free_port()
+    _serve(app, app_port)
+    return f"http://127.0.0.1:{app_port}", f"http://127.0.0.1:{llm_port}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prueba de carga de la API de facturas")
+    parser.add_argument("--base-url", default=None, help="URL de una API ya levantada")
+    parser.add_argument("--spawn", action="store_true", help="Levantar LLM falso + API sobre SQLite en proceso")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed-invoices", type=int, default=10)
+    parser.add_argument("--mix", default="upload=1,chat=2,workflow=2", help="Pesos por escenario")
+    parser.add_argument("--latency-ms", type=float, default=100, help="(spawn) latencia del LLM falso")
+    parser.add_argument("--tokens-per-sec", type=float, default=0, help="(spawn) tokens/s del LLM falso")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", dest="json_out", default=None, help="Guardar el resultado en JSON")
+    args = parser.parse_args(argv)
+
+    if not args.base_url and not args.spawn:
+        parser.error("indica --base-url o --spawn")
+
+    llm_url = None
+    if args.base_url:
+        base_url = args.base_url
+    else:
+        base_url, llm_url = spawn_stack(args.latency_ms, args.tokens_per_sec)
+    weights = {k: int(v) for k, v in (item.split("=") for item in args.mix.split(","))}
+
+    test = LoadTest(base_url, concurrency=args.concurrency, weights=weights, seed=args.seed)
+    print(f"🚀 Sembrando {args.seed_invoices} facturas en {base_url}...")
+    test.seed(args.seed_invoices)
+    print(f"🚀 Lanzando {args.requests} peticiones (concurrencia {args.concurrency})...")
+    result = test.run(args.requests)
+    if llm_url:
+        # Tokens consumidos en el LLM falso (incluye la siembra)
+        result["llm"] = requests.get(f"{llm_url}/stats", timeout=10).json()
+    print(format_report(result))
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    return result
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,143 @@
+"""
+Benchmarking local de precios entre proveedores (coste por unidad).
+
+Para cada (categoría, unidad, proveedor) se mantiene en memoria la serie de
+precios por unidad de las facturas con consumo y se calcula su distribución
+(percentiles, media, último precio y tendencia). La caché se refresca de
+forma incremental: si las facturas ya cargadas no han cambiado solo se leen
+las nuevas; si hubo borrados o modificaciones (nº, sumas o la última
+updated_at, que cubre cambios de proveedor, categoría o fecha) se reconstruye.
+
+El workflow comparar-proveedor recibe la tabla ya calculada y el mejor
+proveedor alternativo, sin llamadas extra al LLM.
+"""
+import threading
+from collections import defaultdict
+from datetime import date
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .database import Invoice
+
+MIN_INVOICES = 2  # facturas mínimas de un proveedor para usarlo como alternativa
+TREND_WINDOW = 3  # últimas facturas frente a las anteriores
+
+
+class PriceSeries:
+    """Serie de precios por unidad de un proveedor (ordenable por fecha)"""
+
+    def __init__(self):
+        self.points = []  # (fecha, precio, consumo)
+        self._stats = None
+
+    def add(self, when, price: float, consumption: float):
+        self.points.append((when, price, consumption))
+        self._stats = None
+
+    def stats(self) -> dict:
+        if self._stats is None:
+            ordered = sorted(self.points, key=lambda p: p[0] or date.min)
+            prices = np.array([p[1] for p in ordered], dtype=float)
+            p25, median, p75 = np.percentile(prices, [25, 50, 75])
+            trend = None
+            if len(prices) >= 2 * TREND_WINDOW:
+                recent, before = prices[-TREND_WINDOW:].mean(), prices[-2 * TREND_WINDOW:-TREND_WINDOW].mean()
+                trend = round(float((recent - before) / before * 100), 1) if before else None
+            self._stats = {
+                "invoices": len(prices),
+                "min": round(float(prices.min()), 4),
+                "p25": round(float(p25), 4),
+                "median": round(float(median), 4),
+                "p75": round(float(p75), 4),
+                "max": round(float(prices.max()), 4),
+                "mean": round(float(prices.mean()), 4),
+                "last": round(float(prices[-1]), 4),
+                "trend_pct": trend,
+                "consumption": round(float(sum(p[2] for p in ordered)), 2),
+            }
+        return self._stats
+
+
+class BenchmarkCache:
+    def __init__(self):
+        self.series = defaultdict(PriceSeries)  # (categoría, unidad, proveedor) -> PriceSeries
+        self.max_id = 0
+        self.count = 0
+        self.total = 0.0
+        self.consumption = 0.0
+        self.updated_at = None  # max(updated_at) de las facturas cargadas
+
+
+_cache = BenchmarkCache()
+_cache_lock = threading.Lock()
+
+
+def _metered(query):
+    return query.filter(Invoice.consumption > 0, Invoice.total_amount.isnot(None))
+
+
+def _load(cache: BenchmarkCache, db: Session, after_id: int = 0):
+    rows = _metered(db.query(
+        Invoice.id, Invoice.category, Invoice.consumption_unit, Invoice.vendor_name,
+        Invoice.date, Invoice.total_amount, Invoice.consumption, Invoice.updated_at
+    )).filter(Invoice.id > after_id).order_by(Invoice.id).yield_per(1000)
+    for row in rows:
+        key = (row.category or "Other", row.consumption_unit or "", row.vendor_name or "Desconocido")
+        cache.series[key].add(row.date, row.total_amount / row.consumption, row.consumption)
+        cache.max_id = max(cache.max_id, row.id)
+        cache.count += 1
+        cache.total += row.total_amount
+        cache.consumption += row.consumption
+        if row.updated_at and (cache.updated_at is None or row.updated_at > cache.updated_at):
+            cache.updated_at = row.updated_at
+
+
+def get_cache(db: Session) -> BenchmarkCache:
+    """Caché sincronizada con las facturas (carga incremental o reconstrucción)"""
+    global _cache
+    with _cache_lock:
+        # ¿Siguen igual las facturas ya cargadas? (detecta borrados y modificaciones)
+        count, total, consumption, updated_at = _metered(db.query(
+            func.count(Invoice.id), func.sum(Invoice.total_amount), func.sum(Invoice.consumption),
+            func.max(Invoice.updated_at)
+        )).filter(Invoice.id <= _cache.max_id).one()
+        unchanged = (count or 0) == _cache.count and updated_at == _cache.updated_at \
+            and abs((total or 0.0) - _cache.total) < 1e-6 and abs((consumption or 0.0) - _cache.consumption) < 1e-6
+        if not unchanged:
+            _cache = BenchmarkCache()
+        _load(_cache, db, after_id=_cache.max_id)
+        return _cache
+
+
+def benchmark_table(db: Session, category: str = None) -> list:
+    """Distribución del coste por unidad de cada proveedor, ordenada por mediana"""
+    cache = get_cache(db)
+    table = []
+    for (cat, unit, vendor), series in cache.series.items():
+        if category and cat != category:
+            continue
+        table.append({"category": cat, "unit": unit or None, "vendor": vendor, **series.stats()})
+    table.sort(key=lambda r: (r["category"], r["unit"] or "", r["median"]))
+    return table
+
+
+def compare_invoice(db: Session, vendor: str, category: str, unit: str,
+                    total: float, consumption: float) -> dict:
+    """Posición de la factura frente al resto de proveedores de su categoría y unidad"""
+    table = [r for r in benchmark_table(db, category or "Other") if (r["unit"] or "") == (unit or "")]
+    price = total / consumption if total and consumption and consumption > 0 else None
+
+    current = {"vendor": vendor, "price_per_unit": round(price, 4) if price is not None else None, "unit": unit}
+    if price is not None and table:
+        medians = np.array([r["median"] for r in table])
+        current["percentile_in_category"] = round(float((medians < price).mean() * 100), 1)
+
+    alternatives = [r for r in table if r["vendor"] != vendor and r["invoices"] >= MIN_INVOICES]
+    best = min(alternatives, key=lambda r: r["median"]) if alternatives else None
+    saving = None
+    if best and price is not None:
+        saving = round((price - best["median"]) * consumption, 2)
+        best = {**best, "potential_saving": saving}
+    return {"current": current, "table": table, "best_alternative": best, "potential_saving": saving}
@@ -0,0 +1,227 @@
+"""
+Construcción del contexto del chat con un presupuesto fijo de tokens.
+
+- Pregunta acotada (proveedor, categoría o periodo detectados con
+  query_router, o pocas facturas que contienen todos sus términos; o el
+  archivo es pequeño): fragmentos del PDF + bloque por factura seleccionada.
+- Pregunta amplia: resúmenes agregados por proveedor y por mes (recuento,
+  gasto, consumo, mín/máx) leídos de spend_rollups + fragmentos BM25.
+
+En ambos casos el tamaño del prompt queda acotado por CHAT_CONTEXT_TOKENS,
+independientemente del número de facturas.
+"""
+import os
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .database import Invoice, SpendRollup
+from .query_router import parse_intent, intent_filters
+from .search import search_invoices
+from .retrieval import retrieve_passages
+
+CHAT_CONTEXT_TOKENS = int(os.getenv("CHAT_CONTEXT_TOKENS", "4000"))
+CHAT_SEARCH_LIMIT = int(os.getenv("CHAT_SEARCH_LIMIT", "25"))
+CHAT_PASSAGES = int(os.getenv("CHAT_PASSAGES", "8"))
+CHAT_PASSAGE_CHARS = int(os.getenv("CHAT_PASSAGE_CHARS", "6000"))
+# Con archivos pequeños se detallan todas las facturas aunque la pregunta sea amplia
+CHAT_EXPAND_MAX = int(os.getenv("CHAT_EXPAND_MAX", "20"))
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación rápida (≈ 4 caracteres por token) sin depender del tokenizador del proveedor"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+class ContextBudget:
+    """Acumula secciones del contexto mientras quepan en el presupuesto"""
+
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max_tokens
+        self.parts = []
+        self.used = 0
+
+    @property
+    def remaining(self) -> int:
+        return max(self.max_tokens - self.used, 0)
+
+    def add(self, text: str) -> bool:
+        tokens = estimate_tokens(text)
+        if tokens > self.remaining:
+            return False
+        self.parts.append(text)
+        self.used += tokens
+        return True
+
+    def text(self) -> str:
+        return "".join(self.parts)
+
+
+def select_invoices(db: Session, query: str):
+    """Facturas candidatas para la pregunta. Devuelve (facturas, total, acotada)"""
+    total = db.query(Invoice).count()
+    selected = []
+    # Proveedor, categoría o periodo detectados: las más recientes de ese ámbito
+    filters = intent_filters(parse_intent(query, db)) if total else []
+    if filters:
+        selected = db.query(Invoice).filter(*filters).order_by(Invoice.date.desc()).limit(CHAT_SEARCH_LIMIT).all()
+    else:
+        # Todos los términos (nº de factura, CUPS...); palabras comunes como "factura" o "total"
+        # aparecen en casi todas: más de CHAT_SEARCH_LIMIT coincidencias es una pregunta amplia
+        hits = search_invoices(db, query, limit=CHAT_SEARCH_LIMIT + 1, match_all=True)
+        if 0 < len(hits) <= CHAT_SEARCH_LIMIT:
+            candidates = db.query(Invoice).filter(Invoice.id.in_([h["id"] for h in hits]))
+            by_id = {inv.id: inv for inv in candidates}
+            selected = [by_id[h["id"]] for h in hits if h["id"] in by_id]
+
+    narrowed = bool(selected) and len(selected) < total
+    if not narrowed:
+        if total <= CHAT_EXPAND_MAX:
+            selected = db.query(Invoice).all()
+        else:
+            selected = []
+    return selected, total, narrowed
+
+
+def vendor_rollups(db: Session) -> list:
+    """Resumen por proveedor ordenado por gasto (desde spend_rollups)"""
+    rows = db.query(
+        SpendRollup.vendor_name, SpendRollup.category, func.sum(SpendRollup.invoice_count),
+        func.sum(SpendRollup.total_amount), func.min(SpendRollup.min_amount), func.max(SpendRollup.max_amount),
+        func.min(func.nullif(SpendRollup.month, "")), func.max(func.nullif(SpendRollup.month, ""))
+    ).group_by(SpendRollup.vendor_name, SpendRollup.category).order_by(func.sum(SpendRollup.total_amount).desc()).all()
+    consumption = _consumption_by(db, SpendRollup.vendor_name, SpendRollup.category)
+    return [{
+        "vendor": vendor or None, "category": category or None, "count": count, "total": round(total or 0.0, 2),
+        "min": round(low or 0.0, 2), "max": round(high or 0.0, 2),
+        "first": first, "last": last,
+        "consumption": consumption.get((vendor, category), {})
+    } for vendor, category, count, total, low, high, first, last in rows]
+
+
+def month_rollups(db: Session) -> list:
+    """Resumen por mes, del más reciente al más antiguo (desde spend_rollups)"""
+    rows = db.query(
+        SpendRollup.month, func.sum(SpendRollup.invoice_count), func.sum(SpendRollup.total_amount),
+        func.min(SpendRollup.min_amount), func.max(SpendRollup.max_amount)
+    ).filter(SpendRollup.month != "").group_by(SpendRollup.month).order_by(SpendRollup.month.desc()).all()
+    consumption = _consumption_by(db, SpendRollup.month)
+    return [{
+        "month": month, "count": count, "total": round(total or 0.0, 2),
+        "min": round(low or 0.0, 2), "max": round(high or 0.0, 2),
+        "consumption": consumption.get((month,), {})
+    } for month, count, total, low, high in rows]
+
+
+def _consumption_by(db: Session, *keys) -> dict:
+    """{clave: {unidad: consumo}} agregando los rollups por las columnas indicadas"""
+    rows = db.query(*keys, SpendRollup.consumption_unit, func.sum(SpendRollup.total_consumption)).filter(
+        SpendRollup.total_consumption > 0
+    ).group_by(*keys, SpendRollup.consumption_unit).all()
+    result = {}
+    for row in rows:
+        *key, unit, value = row
+        result.setdefault(tuple(key), {})[unit or ""] = round(value or 0.0, 2)
+    return result
+
+
+def _consumption_text(consumption: dict) -> str:
+    return ", ".join(f"{v} {u}".strip() for u, v in consumption.items())
+
+
+def _invoice_block(inv: Invoice) -> str:
+    block = f"=== FACTURA ID {inv.id} ===\n"
+    block += "DATOS EXTRAÍDOS AUTOMÁTICAMENTE:\n"
+    block += f"  Proveedor: {inv.vendor_name}\n"
+    block += f"  Total: {inv.total_amount} {inv.currency}\n"
+    block += f"  Categoría: {inv.category}\n"
+    if inv.date:
+        block += f"  Fecha: {inv.date.strftime('%Y-%m-%d')}\n"
+    if inv.invoice_number and inv.invoice_number != "unknown":
+        block += f"  Nº Factura: {inv.invoice_number}\n"
+    else:
+        block += "  Nº Factura: (NO EXTRAÍDO - BUSCAR EN LOS FRAGMENTOS DEL PDF)\n"
+    if inv.consumption and inv.consumption > 0:
+        block += f"  Consumo: {inv.consumption} {inv.consumption_unit}\n"
+    return block + "\n"
+
+
+def _add_passages(budget: ContextBudget, db: Session, query: str, invoice_ids: list = None,
+                  share: float = 1.0) -> int:
+    char_budget = min(CHAT_PASSAGE_CHARS, int(budget.remaining * share) * CHARS_PER_TOKEN)
+    passages = retrieve_passages(db, query, k=CHAT_PASSAGES, char_budget=char_budget, invoice_ids=invoice_ids)
+    if not passages:
+        return 0
+    section = "FRAGMENTOS DEL TEXTO ORIGINAL DE LOS PDF (FUENTE PRINCIPAL - LEE ESTO PRIMERO):\n"
+    for p in passages:
+        section += f"--- Factura ID {p['invoice_id']} · fragmento {p['position'] + 1} ---\n{p['text']}\n"
+    section += "--- FIN TEXTO PDF ---\n\n"
+    return len(passages) if budget.add(section) else 0
+
+
+def _add_rollups(budget: ContextBudget, title: str, lines: list) -> int:
+    """Añade una tabla de resumen línea a línea hasta agotar el presupuesto"""
+    if not lines or not budget.add(title):
+        return 0
+    added = 0
+    for line in lines:
+        if not budget.add(line):
+            break
+        added += 1
+    if added < len(lines):
+        budget.add(f"  (… {len(lines) - added} filas más omitidas por tamaño)\n")
+    budget.add("\n")
+    return added
+
+
+def build_chat_context(db: Session, query: str, prefix: str = "",
+                       max_tokens: int = CHAT_CONTEXT_TOKENS) -> tuple:
+    """Contexto para chat_with_invoices. Devuelve (texto, estadísticas)"""
+    budget = ContextBudget(max_tokens)
+    budget.add(prefix)
+    selected, total, narrowed = select_invoices(db, query)
+    stats = {"total_invoices": total, "selected": len(selected), "narrowed": narrowed, "mode": "detail"}
+
+    if total == 0:
+        return "", {**stats, "tokens": 0}
+
+    if selected:
+        # Pregunta acotada: fragmentos de esas facturas (hasta la mitad) y después el detalle
+        stats["passages"] = _add_passages(
+            budget, db, query, invoice_ids=[inv.id for inv in selected] if narrowed else None, share=0.5
+        )
+        shown = 0
+        for inv in selected:
+            if not budget.add(_invoice_block(inv)):
+                break
+            shown += 1
+        if shown < len(selected):
+            rest = selected[shown:]
+            budget.add(f"(… {len(rest)} facturas más seleccionadas, total "
+                       f"{round(sum(inv.total_amount or 0 for inv in rest), 2)} EUR, omitidas por tamaño)\n\n")
+        stats["invoices_shown"] = shown
+    else:
+        # Pregunta amplia: agregados por proveedor y mes, después fragmentos con lo que quede
+        stats["mode"] = "rollup"
+        vendors = [
+            f"  {r['vendor']} ({r['category']}): {r['count']} facturas, total {r['total']} EUR, "
+            f"mín {r['min']} / máx {r['max']} EUR"
+            + (f", consumo {_consumption_text(r['consumption'])}" if r["consumption"] else "")
+            + (f", {r['first']} a {r['last']}" if r["first"] and r["last"] else "")
+            + "\n"
+            for r in vendor_rollups(db)
+        ]
+        months = [
+            f"  {r['month']}: {r['count']} facturas, total {r['total']} EUR, mín {r['min']} / máx {r['max']} EUR"
+            + (f", consumo {_consumption_text(r['consumption'])}" if r["consumption"] else "")
+            + "\n"
+            for r in month_rollups(db)
+        ]
+        budget.add(f"RESUMEN DEL ARCHIVO ({total} facturas; cifras agregadas en base de datos):\n\n")
+        stats["vendor_rows"] = _add_rollups(budget, "POR PROVEEDOR:\n", vendors)
+        stats["month_rows"] = _add_rollups(budget, "POR MES:\n", months)
+        stats["passages"] = _add_passages(budget, db, query)
+
+    stats["tokens"] = budget.used
+    return budget.text(), stats
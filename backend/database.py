@@ -1,8 +1,13 @@
-from sqlalchemy import Column, Integer, String, Float, Date, JSON, Text, DateTime
+from sqlalchemy import Column, Integer, String, Float, Date, JSON, DateTime, ForeignKey, LargeBinary, UniqueConstraint, Index, select
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import sessionmaker, relationship, declared_attr, column_property
 from sqlalchemy.sql import func
+from sqlalchemy.types import TypeDecorator
+from datetime import datetime
+import hashlib
 import os
+import zlib
 
 # Use SQLite for testing, PostgreSQL for production
 TESTING = os.getenv("TESTING", "false").lower() == "true"
@@ -27,18 +32,89 @@ class SystemSetting(Base):
     key = Column(String, primary_key=True, index=True)
     value = Column(String)
 
-class ExtractionLog(Base):
+class CompressedText(TypeDecorator):
+    """Texto guardado comprimido con zlib (se comprime y descomprime al escribir/leer)"""
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else zlib.compress(value.encode("utf-8"), 6)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else zlib.decompress(value).decode("utf-8")
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class Document(Base):
+    """Texto extraído de un documento, guardado una sola vez por contenido (sha256)"""
+    __tablename__ = "documents"
+    content_hash = Column(String(64), primary_key=True)
+    content = Column(CompressedText)
+    size = Column(Integer) # Nº de caracteres sin comprimir
+    created_at = Column(DateTime, server_default=func.now())
+
+class DocumentTextMixin:
+    """raw_text en la tabla documents: la fila solo guarda el hash y el texto se carga al pedirlo.
+
+    Al asignar raw_text se calcula el hash y el texto queda pendiente hasta el
+    flush, donde documents.py lo inserta (si no existía ya) antes que la fila.
+    En consultas, Invoice.raw_text es una subconsulta sobre documents.
+    """
+
+    @declared_attr
+    def document_hash(cls):
+        # active_history: el hash anterior queda en el historial para liberar su documento
+        return column_property(Column(String(64), ForeignKey("documents.content_hash"), index=True), active_history=True)
+
+    @declared_attr
+    def document(cls):
+        return relationship(Document, viewonly=True, lazy="select")
+
+    @hybrid_property
+    def raw_text(self):
+        cached = self.__dict__.get("_document_text")
+        if cached is not None and cached[0] == self.document_hash:
+            return cached[1]
+        return self.document.content if self.document_hash and self.document is not None else None
+
+    @raw_text.inplace.setter
+    def _raw_text_setter(self, value):
+        if value is None:
+            self.document_hash = None
+            self.__dict__.pop("_document_text", None)
+            return
+        self.document_hash = content_hash(value)
+        self.__dict__["_document_text"] = (self.document_hash, value)
+        self.__dict__["_document_pending"] = True
+
+    @raw_text.inplace.expression
+    @classmethod
+    def _raw_text_expression(cls):
+        return select(Document.content).where(
+            Document.content_hash == cls.document_hash
+        ).scalar_subquery().label("raw_text")
+
+class ExtractionLog(DocumentTextMixin, Base):
     __tablename__ = "extraction_logs"
     id = Column(Integer, primary_key=True, index=True)
-    timestamp = Column(DateTime, server_default=func.now())
+    timestamp = Column(DateTime, server_default=func.now(), index=True) # Retención por antigüedad
     file_name = Column(String)
-    raw_text = Column(Text)
     matching_scores = Column(JSON)
     final_json = Column(JSON)
 
-class Invoice(Base):
+class Invoice(DocumentTextMixin, Base):
     __tablename__ = "invoices"
-    
+    # Mismos índices que las migraciones (INVOICE_INDEXES, 5) para las bases de datos nuevas
+    __table_args__ = (
+        Index("ix_invoices_number_vendor", "invoice_number", "vendor_name"),
+        Index("ix_invoices_vendor_date", "vendor_name", "date"),
+        Index("ix_invoices_category_date", "category", "date"),
+        Index("ix_invoices_date", "date"),
+        Index("ix_invoices_file_path", "file_path"),
+        Index("ix_invoices_enrichment_status", "enrichment_status"),
+    )
+
     id = Column(Integer, primary_key=True, index=True)
     invoice_number = Column(String)
     date = Column(Date)
@@ -46,16 +122,87 @@ class Invoice(Base):
     total_amount = Column(Float)
     currency = Column(String)
     type = Column(String) # 'Purchase' or 'Sale'
-    file_path = Column(String)
+    # active_history: la ruta anterior queda en el historial para liberar su fichero (storage.py)
+    file_path = column_property(Column(String), active_history=True)
     category = Column(String) # 'Electricity', 'Gas', 'Telecom', 'Water', etc.
     consumption = Column(Float)
     consumption_unit = Column(String) # 'kWh', 'm3', 'min', etc.
-    raw_text = Column(Text) # Extracted raw text from PDF/Image
+    period = Column(String) # Periodo facturado (texto libre del LLM)
+    taxes = Column(Float) # Impuestos (IVA, impuesto eléctrico...)
+    # pending/running: guardada con regex, el LLM la completará (enrichment.py); done, failed, skipped (sobrecarga)
+    enrichment_status = Column(String, default="done")
+    enrichment_claimed_at = Column(DateTime) # Inicio del completado en curso (running vencido = proceso caído)
+    # Última modificación (datetime de Python: resolución de microsegundos también en SQLite);
+    # detecta cambios que no alteran importes ni consumos (caché de benchmarking)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+    # raw_text (texto extraído del PDF/imagen) vive en documents (DocumentTextMixin)
+
+class InvoiceChunk(Base):
+    """Fragmento del texto de una factura con sus estadísticas BM25 (arrays empaquetados)"""
+    __tablename__ = "invoice_chunks"
+    __table_args__ = {"sqlite_autoincrement": True} # ids monótonos para la carga incremental
+
+    id = Column(Integer, primary_key=True, index=True)
+    invoice_id = Column(Integer, ForeignKey("invoices.id", ondelete="CASCADE"), index=True)
+    position = Column(Integer) # Orden del fragmento dentro de la factura
+    start = Column(Integer) # Offsets [start, end) dentro de raw_text
+    end = Column(Integer)
+    length = Column(Integer) # Nº de términos del fragmento
+    term_hashes = Column(LargeBinary) # array('I') con el hash de cada término distinto
+    term_freqs = Column(LargeBinary) # array('H') con su frecuencia en el fragmento
+
+class SpendRollup(Base):
+    """Agregado de gasto y consumo por (proveedor, categoría, mes), mantenido en la ingesta"""
+    __tablename__ = "spend_rollups"
+    __table_args__ = (UniqueConstraint("vendor_name", "category", "month", name="uq_spend_rollup_group"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    vendor_name = Column(String, nullable=False, default="") # "" = sin proveedor
+    category = Column(String, nullable=False, default="") # "" = sin categoría
+    month = Column(String(7), nullable=False, default="") # YYYY-MM ("" = sin fecha)
+    invoice_count = Column(Integer, default=0)
+    total_amount = Column(Float, default=0.0)
+    total_consumption = Column(Float, default=0.0)
+    metered_amount = Column(Float, default=0.0) # Importe de las facturas con consumo (coste por unidad)
+    consumption_unit = Column(String)
+    min_amount = Column(Float)
+    max_amount = Column(Float)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+class ExtractionJob(Base):
+    """Trabajo de extracción en cola: lo reclama un worker (jobs.py) con un plazo de visibilidad"""
+    __tablename__ = "extraction_jobs"
+    __table_args__ = (Index("ix_extraction_jobs_claim", "status", "available_at"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    file_path = Column(String, nullable=False, index=True)
+    file_name = Column(String)
+    status = Column(String, nullable=False, default="pending") # pending, running, done, failed
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    available_at = Column(DateTime, nullable=False, default=datetime.now) # No antes de (reintentos con espera)
+    worker_id = Column(String)
+    locked_until = Column(DateTime) # Si vence sin latido, otro worker puede reclamarlo
+    heartbeat_at = Column(DateTime)
+    last_error = Column(String)
+    invoice_id = Column(Integer)
+    result = Column(JSON)
+    created_at = Column(DateTime, server_default=func.now())
+    finished_at = Column(DateTime)
+
+class StoredFile(Base):
+    """Original subido, guardado una sola vez por contenido (storage.py)"""
+    __tablename__ = "stored_files"
+    sha256 = Column(String(64), primary_key=True)
+    storage_key = Column(String, nullable=False) # ab/cd/<sha256>.pdf dentro del almacén
+    size = Column(Integer)
+    refcount = Column(Integer, nullable=False, default=0) # Facturas que apuntan al fichero
+    created_at = Column(DateTime, server_default=func.now())
 
 from sqlalchemy import create_engine
 
-# Create engine with appropriate settings
-if TESTING:
+# Create engine with appropriate settings (SQLite needs to be shared across threads)
+if DATABASE_URL.startswith("sqlite"):
     engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
 else:
     engine = create_engine(DATABASE_URL)
@@ -63,7 +210,33 @@ else:
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 def init_db():
+    # API y workers arrancan a la vez: uno solo prepara el esquema, el resto espera (migrations.schema_lock)
+    with migrations.schema_lock(engine):
+        _prepare_schema()
+
+def _prepare_schema():
     Base.metadata.create_all(bind=engine)
+    # Índices y cambios de esquema sobre tablas ya existentes
+    migrations.run_migrations(engine)
+    # Índice de texto completo (para tablas creadas antes de existir el índice)
+    with engine.begin() as conn:
+        created = search.ensure_search_index(conn)
+    if created:
+        db = SessionLocal()
+        try:
+            search.rebuild_search_index(db)
+        finally:
+            db.close()
+    # Fragmentos BM25 para facturas anteriores a la tabla de fragmentos
+    db = SessionLocal()
+    try:
+        if db.query(InvoiceChunk.id).first() is None and db.query(Invoice.id).first() is not None:
+            retrieval.rebuild_chunks(db)
+        # Agregados para facturas anteriores a la tabla de rollups
+        if db.query(SpendRollup.id).first() is None and db.query(Invoice.id).first() is not None:
+            rollups.rebuild_rollups(db)
+    finally:
+        db.close()
 
 def get_db():
     db = SessionLocal()
@@ -71,3 +244,6 @@ def get_db():
         yield db
     finally:
         db.close()
+
+# Registra el mantenimiento de los índices de búsqueda, fragmentos, rollups y ficheros (eventos ORM/DDL)
+from . import documents, search, retrieval, rollups, storage, migrations  # noqa: E402
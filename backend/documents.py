@@ -0,0 +1,118 @@
+"""
+Textos de documentos comprimidos y deduplicados por contenido.
+
+El texto extraído de cada factura (y el de su log de extracción) se guarda
+una sola vez en `documents`, comprimido con zlib y con clave sha256 del
+contenido; invoices y extraction_logs solo guardan el hash. Así los listados
+(`db.query(Invoice)`) no arrastran el texto y se carga solo al leer
+`raw_text` (chat, rescate por regex, fragmentos BM25).
+
+- Alta: antes del flush se insertan los textos pendientes (ON CONFLICT DO
+  NOTHING, el mismo texto subido dos veces ocupa una fila).
+- Borrado o cambio de texto: se elimina el documento si ya nadie lo usa.
+"""
+import logging
+
+from sqlalchemy import event, select, delete, exists, and_, inspect, text
+from sqlalchemy.orm import Session
+
+from .database import Document, DocumentTextMixin, Invoice, ExtractionLog, content_hash
+
+logger = logging.getLogger(__name__)
+
+# Tablas que referencian documents.content_hash
+REFERENCING_MODELS = (Invoice, ExtractionLog)
+
+
+def store_documents(connection, texts: dict):
+    """Inserta {hash: texto} en documents, ignorando los que ya existen"""
+    if not texts:
+        return
+    table = Document.__table__
+    rows = [{"content_hash": h, "content": t, "size": len(t)} for h, t in texts.items()]
+    dialect = connection.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        connection.execute(dialect_insert(table).on_conflict_do_nothing(index_elements=["content_hash"]), rows)
+        return
+    # Otros motores: comprobar antes de insertar
+    known = set(connection.execute(select(table.c.content_hash).where(table.c.content_hash.in_(list(texts)))).scalars())
+    missing = [r for r in rows if r["content_hash"] not in known]
+    if missing:
+        connection.execute(table.insert(), missing)
+
+
+def release_documents(connection, hashes):
+    """Borra los documentos indicados que ya no referencia ninguna fila"""
+    hashes = [h for h in set(hashes) if h]
+    if not hashes:
+        return
+    table = Document.__table__
+    unused = [~exists().where(model.__table__.c.document_hash == table.c.content_hash) for model in REFERENCING_MODELS]
+    connection.execute(delete(table).where(and_(table.c.content_hash.in_(hashes), *unused)))
+
+
+def prune_documents(db: Session) -> int:
+    """Borra todos los documentos huérfanos (p. ej. tras borrar filas fuera del ORM)"""
+    table = Document.__table__
+    unused = [~exists().where(model.__table__.c.document_hash == table.c.content_hash) for model in REFERENCING_MODELS]
+    result = db.execute(delete(table).where(and_(*unused)))
+    db.commit()
+    logger.info(f"🧹 Documentos huérfanos eliminados: {result.rowcount}")
+    return result.rowcount
+
+
+def migrate_legacy_text(connection, table_name: str, batch: int = 500) -> int:
+    """Mueve la antigua columna raw_text de table_name a documents y la elimina"""
+    columns = {c["name"] for c in inspect(connection).get_columns(table_name)}
+    if "raw_text" not in columns:
+        return 0
+    if "document_hash" not in columns:
+        connection.execute(text(f"ALTER TABLE {table_name} ADD COLUMN document_hash VARCHAR(64)"))
+    moved = 0
+    last_id = 0
+    while True:
+        rows = connection.execute(text(
+            f"SELECT id, raw_text FROM {table_name} WHERE id > :last AND raw_text IS NOT NULL ORDER BY id LIMIT :batch"
+        ), {"last": last_id, "batch": batch}).all()
+        if not rows:
+            break
+        hashes = {row.id: content_hash(row.raw_text) for row in rows}
+        store_documents(connection, {hashes[row.id]: row.raw_text for row in rows})
+        connection.execute(text(f"UPDATE {table_name} SET document_hash = :hash WHERE id = :id"),
+                           [{"hash": h, "id": i} for i, h in hashes.items()])
+        moved += len(rows)
+        last_id = rows[-1].id
+    connection.execute(text(f"ALTER TABLE {table_name} DROP COLUMN raw_text"))
+    logger.info(f"📦 {table_name}: {moved} textos movidos a documents")
+    return moved
+
+
+# --- Mantenimiento automático ---
+
+@event.listens_for(Session, "before_flush")
+def _store_pending_texts(session, flush_context, instances):
+    pending = {}
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, DocumentTextMixin) and obj.__dict__.pop("_document_pending", False):
+            document_hash, value = obj.__dict__["_document_text"]
+            pending[document_hash] = value
+    store_documents(session.connection(), pending)
+
+
+def _release_on_delete(mapper, connection, target):
+    release_documents(connection, [target.document_hash])
+
+
+def _release_on_update(mapper, connection, target):
+    history = inspect(target).attrs.document_hash.history
+    if history.deleted:
+        release_documents(connection, history.deleted)
+
+
+for _model in REFERENCING_MODELS:
+    event.listen(_model, "after_delete", _release_on_delete)
+    event.listen(_model, "after_update", _release_on_update)
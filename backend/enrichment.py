@@ -0,0 +1,187 @@
+"""
+Ingesta en dos fases: la factura se guarda con regex y el LLM la completa después.
+
+/upload guarda la factura en cuanto la regex (patrones del proveedor y
+rescate) la identifica, con enrichment_status="pending", y responde sin
+esperar al modelo. El completado con el LLM se lanza en segundo plano en el
+pool "enrich" (executors): rellena lo que la regex no encontró y añade
+consumo, periodo e impuestos.
+
+Con sobrecarga (ENRICH_MAX_BACKLOG completados en cola o en curso en este
+proceso) la factura se queda solo con los datos de regex
+(enrichment_status="skipped") en lugar de encolar más trabajo detrás del
+modelo. Las pendientes que queden (p. ej. tras un reinicio) las recogen los
+workers cuando no tienen trabajos y las omitidas o fallidas se reintentan con
+`python -m backend.admin enrich-invoices`.
+
+Si el proceso muere a mitad de un completado, la factura queda en "running"
+con su enrichment_claimed_at: pasado ENRICH_LEASE_SECONDS se considera
+abandonada y se vuelve a reclamar (workers en reposo y enrich-invoices),
+igual que el plazo de visibilidad de los trabajos (jobs.py).
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, or_, and_
+from sqlalchemy.orm import Session
+
+from .ai_service import match_provider_patterns, llm_extract, regex_only_data
+from .database import SessionLocal, Invoice
+from .executors import run_in
+from .extraction_logs import record_extraction
+from .ingestion import rescue_with_regex, parse_invoice_date
+
+logger = logging.getLogger(__name__)
+
+ENRICH_MAX_BACKLOG = int(os.getenv("ENRICH_MAX_BACKLOG", "20"))
+# Un completado en "running" más antiguo se da por abandonado (por encima del timeout del LLM)
+ENRICH_LEASE_SECONDS = int(os.getenv("ENRICH_LEASE_SECONDS", "600"))
+ENRICH_STATUSES = ("pending", "running", "done", "failed", "skipped")
+
+# Valores que la fase regex deja cuando no encuentra el dato
+PLACEHOLDERS = {
+    "invoice_number": (None, "", "unknown"),
+    "vendor_name": (None, "", "unknown", "Unknown"),
+    "category": (None, "", "Other"),
+    "total_amount": (None, 0, 0.0),
+    "date": (None, ""),
+}
+# Campos que solo aporta el LLM: se rellenan si siguen vacíos
+LLM_FIELDS = ("consumption", "consumption_unit", "period", "taxes")
+
+_background = set()  # Tareas en curso (referencia fuerte hasta que terminan)
+
+
+def _claimable(statuses, now: datetime = None):
+    """Facturas en los estados indicados o en "running" con el plazo vencido (proceso caído)"""
+    cutoff = (now or datetime.now()) - timedelta(seconds=ENRICH_LEASE_SECONDS)
+    stale = and_(Invoice.enrichment_status == "running", or_(
+        Invoice.enrichment_claimed_at.is_(None), Invoice.enrichment_claimed_at < cutoff
+    ))
+    return or_(Invoice.enrichment_status.in_(statuses), stale)
+
+
+def _claim(db: Session, invoice_id: int, statuses=("pending",)) -> bool:
+    """pending → running con un UPDATE condicional: un solo proceso completa cada factura"""
+    now = datetime.now()
+    claimed = db.query(Invoice).filter(Invoice.id == invoice_id, _claimable(statuses, now)).update(
+        {Invoice.enrichment_status: "running", Invoice.enrichment_claimed_at: now}, synchronize_session=False
+    )
+    db.commit()
+    return claimed == 1
+
+
+def apply_enrichment(db: Session, invoice: Invoice, llm_data: dict, regex_data: dict) -> list:
+    """Aplica la respuesta del LLM sin pisar lo que encontró la regex. Devuelve los campos cambiados."""
+    changed = []
+    for field, placeholders in PLACEHOLDERS.items():
+        value = llm_data.get(field)
+        if regex_data.get(field) not in placeholders or value in placeholders:
+            continue
+        if field in ("category", "vendor_name") and getattr(invoice, field) not in placeholders:
+            continue  # Valor por defecto de la carpeta de origen (watcher)
+        if field == "date":
+            value = parse_invoice_date(value)
+            if value is None:
+                continue
+        if field == "invoice_number" and db.query(Invoice.id).filter(
+            Invoice.invoice_number == value, Invoice.id != invoice.id
+        ).first():
+            logger.warning(f"⚠️ Factura {invoice.id}: el LLM propone el nº {value}, ya existente; se ignora")
+            continue
+        setattr(invoice, field, value)
+        changed.append(field)
+    for field in LLM_FIELDS:
+        value = llm_data.get(field)
+        if value not in (None, "") and getattr(invoice, field) in (None, "", 0, 0.0):
+            setattr(invoice, field, value)
+            changed.append(field)
+    return changed
+
+
+def enrich_invoice(invoice_id: int, statuses=("pending",)) -> str:
+    """Completa una factura con el LLM (sesión propia: se ejecuta en el pool "enrich" o en un worker)"""
+    db = SessionLocal()
+    try:
+        if not _claim(db, invoice_id, statuses):
+            return None
+        invoice = db.get(Invoice, invoice_id)
+        text = invoice.raw_text or ""
+        hints, scores = match_provider_patterns(text, db)
+        try:
+            llm_data = llm_extract(text, hints, db)
+        except Exception as e:
+            logger.error(f"❌ Completado de la factura {invoice_id}: {e}")
+            invoice.enrichment_status = "failed"
+            db.commit()
+            return "failed"
+        regex_data = rescue_with_regex(regex_only_data(hints), text, db=db)
+        changed = apply_enrichment(db, invoice, llm_data, regex_data)
+        invoice.enrichment_status = "done"
+        db.commit()
+        record_extraction(db, os.path.basename(invoice.file_path or ""), text, scores, llm_data)
+        logger.info(f"✨ Factura {invoice_id} completada por el LLM: {', '.join(changed) or 'sin cambios'}")
+        return "done"
+    except Exception:
+        db.rollback()
+        db.query(Invoice).filter(Invoice.id == invoice_id, Invoice.enrichment_status == "running").update(
+            {Invoice.enrichment_status: "failed"}, synchronize_session=False
+        )
+        db.commit()
+        raise
+    finally:
+        db.close()
+
+
+def _mark_skipped(invoice_id: int):
+    db = SessionLocal()
+    try:
+        db.query(Invoice).filter(Invoice.id == invoice_id, Invoice.enrichment_status == "pending").update(
+            {Invoice.enrichment_status: "skipped"}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def overloaded() -> bool:
+    return len(_background) >= ENRICH_MAX_BACKLOG
+
+
+async def schedule_enrichment(invoice_id: int) -> str:
+    """Lanza el completado en segundo plano; con sobrecarga la factura se queda con la regex"""
+    if overloaded():
+        await run_in("db", _mark_skipped, invoice_id)
+        logger.warning(f"⚠️ Sobrecarga del LLM: factura {invoice_id} solo con regex")
+        return "skipped"
+    task = asyncio.create_task(run_in("enrich", enrich_invoice, invoice_id))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return "pending"
+
+
+def enrich_pending(db: Session, limit: int = None, statuses=("pending",)) -> int:
+    """Completa las facturas en los estados indicados y las abandonadas en running (workers y admin).
+    Devuelve cuántas."""
+    query = db.query(Invoice.id).filter(_claimable(statuses)).order_by(Invoice.id)
+    if limit:
+        query = query.limit(limit)
+    ids = [row.id for row in query]
+    db.commit()
+    return sum(1 for invoice_id in ids if enrich_invoice(invoice_id, statuses) == "done")
+
+
+def retry_enrichment(db: Session) -> int:
+    """Tarea de administración: reintenta las pendientes, omitidas por sobrecarga y fallidas"""
+    return enrich_pending(db, statuses=("pending", "skipped", "failed"))
+
+
+def enrichment_stats(db: Session) -> dict:
+    counts = dict(db.query(Invoice.enrichment_status, func.count(Invoice.id)).group_by(Invoice.enrichment_status).all())
+    return {
+        **{status: counts.get(status, 0) for status in ENRICH_STATUSES},
+        "in_background": len(_background),
+        "max_backlog": ENRICH_MAX_BACKLOG,
+    }
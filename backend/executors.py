@@ -0,0 +1,117 @@
+"""
+Pools acotados para el trabajo bloqueante de la API.
+
+Los endpoints son `async def` para que el bucle de eventos solo reparta
+peticiones; todo lo que bloquea se ejecuta en un pool dedicado, así una
+petición lenta no congela el worker y cada tipo de trabajo tiene su límite:
+
+- "db":  consultas y escrituras con la sesión síncrona de SQLAlchemy
+         (DB_WORKERS; no debería superar el pool de conexiones del engine).
+- "cpu": guardado del fichero y extracción de texto (pdfplumber, Tesseract)
+         (EXTRACTION_WORKERS). Por defecto en procesos: pdfplumber es Python
+         puro y en hilos competiría por el GIL con el bucle de eventos.
+         EXTRACTION_EXECUTOR=thread lo ejecuta en hilos.
+- "llm": llamadas al LLM (Ollama, Gemini, OpenAI) y workflows que esperan
+         por ellas (LLM_WORKERS).
+- "enrich": completado con el LLM de las facturas ya guardadas con regex
+         (ENRICH_WORKERS, enrichment.py). Pool aparte para que el trabajo de
+         fondo no haga esperar al chat ni a los workflows.
+
+Uso en un endpoint (la firma se conserva para la inyección de FastAPI):
+
+    @app.post("/workflow/alertas")
+    @offload("llm")
+    def workflow_check_alerts(request: WorkflowRequest, db: Session = Depends(get_db)):
+        ...
+
+o por pasos dentro de un endpoint async: `await run_in("llm", fn, *args)`.
+Al pool "cpu" en procesos solo se le pueden pasar funciones de módulo y
+argumentos serializables (nada de sesiones ni UploadFile).
+"""
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+POOL_SIZES = {
+    "db": int(os.getenv("DB_WORKERS", "10")),
+    "cpu": int(os.getenv("EXTRACTION_WORKERS", str(min(4, os.cpu_count() or 1)))),
+    "llm": int(os.getenv("LLM_WORKERS", "8")),
+    "enrich": int(os.getenv("ENRICH_WORKERS", "2")),
+}
+EXTRACTION_EXECUTOR = os.getenv("EXTRACTION_EXECUTOR", "process").lower()
+
+_pools = {}
+_in_flight = {name: 0 for name in POOL_SIZES}
+_lock = threading.Lock()
+
+
+def _create_pool(name: str):
+    if name == "cpu" and EXTRACTION_EXECUTOR == "process":
+        # spawn: los procesos hijos no heredan hilos ni conexiones del servidor
+        return ProcessPoolExecutor(max_workers=POOL_SIZES[name], mp_context=multiprocessing.get_context("spawn"))
+    return ThreadPoolExecutor(max_workers=POOL_SIZES[name], thread_name_prefix=f"{name}-pool")
+
+
+def get_pool(name: str):
+    """Pool con nombre (se crea al primer uso)"""
+    if name not in POOL_SIZES:
+        raise ValueError(f"Pool desconocido: {name}. Opciones: {', '.join(POOL_SIZES)}")
+    pool = _pools.get(name)
+    if pool is None:
+        with _lock:
+            pool = _pools.get(name)
+            if pool is None:
+                pool = _pools[name] = _create_pool(name)
+    return pool
+
+
+async def run_in(name: str, fn, *args, **kwargs):
+    """Ejecuta fn(*args, **kwargs) en el pool indicado sin bloquear el bucle de eventos"""
+    loop = asyncio.get_running_loop()
+    pool = get_pool(name)
+    with _lock:
+        _in_flight[name] += 1
+    try:
+        return await loop.run_in_executor(pool, functools.partial(fn, *args, **kwargs))
+    finally:
+        with _lock:
+            _in_flight[name] -= 1
+
+
+def offload(name: str):
+    """Convierte un endpoint síncrono en async que se ejecuta en el pool indicado"""
+    get_pool(name)  # valida el nombre al decorar
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            return await run_in(name, fn, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def pool_stats() -> dict:
+    """Tamaño, tipo y trabajos en curso o en cola de cada pool"""
+    with _lock:
+        return {
+            name: {
+                "max_workers": size,
+                "kind": "process" if name == "cpu" and EXTRACTION_EXECUTOR == "process" else "thread",
+                "in_flight": _in_flight[name],
+            }
+            for name, size in POOL_SIZES.items()
+        }
+
+
+def shutdown_pools(wait: bool = True):
+    with _lock:
+        pools = [_pools.pop(name) for name in list(_pools)]
+    for pool in pools:
+        pool.shutdown(wait=wait)
+    logger.info("🧵 Pools de trabajo cerrados")
@@ -0,0 +1,140 @@
+"""
+Exportación de facturas a CSV o Parquet en streaming (/export).
+
+Las filas se leen por lotes (`yield_per`, cursor de servidor en PostgreSQL)
+y se escriben directamente en la respuesta: la memoria usada depende del
+tamaño del lote, no del número de facturas. Parquet requiere pyarrow, que
+se importa solo al pedir ese formato.
+"""
+import csv
+import io
+from datetime import date, datetime
+
+from sqlalchemy import Integer, Float, Date, DateTime
+
+from .database import Invoice
+
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+BATCH_ROWS = 1000
+PARQUET_ROW_GROUP = 10000
+
+
+def _cell(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return "" if value is None else value
+
+
+def stream_csv(rows, fields: list, batch_rows: int = BATCH_ROWS, close=None):
+    """CSV con BOM UTF-8 (Excel detecta la codificación) emitido cada batch_rows filas"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    try:
+        buffer.write("\ufeff")
+        writer.writerow(fields)
+        pending = 0
+        for row in rows:
+            writer.writerow([_cell(getattr(row, f)) for f in fields])
+            pending += 1
+            if pending >= batch_rows:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+                pending = 0
+        yield buffer.getvalue().encode("utf-8")
+    finally:
+        if close:
+            close()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Destino de escritura que acumula bytes hasta que se recogen con drain()"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def parquet_schema(fields: list):
+    import pyarrow as pa
+
+    types = []
+    for name in fields:
+        column_type = getattr(Invoice, name).type  # raw_text: subconsulta de texto
+        if isinstance(column_type, Integer):
+            arrow_type = pa.int64()
+        elif isinstance(column_type, Float):
+            arrow_type = pa.float64()
+        elif isinstance(column_type, DateTime):
+            arrow_type = pa.timestamp("us")
+        elif isinstance(column_type, Date):
+            arrow_type = pa.date32()
+        else:
+            arrow_type = pa.string()
+        types.append(pa.field(name, arrow_type))
+    return pa.schema(types)
+
+
+def stream_parquet(rows, fields: list, row_group: int = PARQUET_ROW_GROUP, close=None):
+    """Parquet escrito por grupos de filas; cada grupo se envía en cuanto se escribe"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = parquet_schema(fields)
+    date_fields = {f.name for f in schema if pa.types.is_date32(f.type)}
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="snappy")
+    columns = {f: [] for f in fields}
+
+    def flush():
+        writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+        for values in columns.values():
+            values.clear()
+
+    try:
+        pending = 0
+        for row in rows:
+            for f in fields:
+                value = getattr(row, f)
+                if f in date_fields and isinstance(value, datetime):
+                    value = value.date()
+                columns[f].append(value)
+            pending += 1
+            if pending >= row_group:
+                flush()
+                pending = 0
+                yield sink.drain()
+        if pending:
+            flush()
+        writer.close()
+        yield sink.drain()
+    finally:
+        if close:
+            close()
+
+
+def parquet_available() -> bool:
+    try:
+        import pyarrow.parquet  # noqa: F401
+        return True
+    except ImportError:
+        return False
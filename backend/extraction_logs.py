@@ -0,0 +1,164 @@
+"""
+Logs de extracción acotados: retención, compactación y listado ligero.
+
+Cada extracción guarda un ExtractionLog con el texto (en documents), el JSON
+final y las puntuaciones de los proveedores. Para que la tabla no crezca sin
+límite con la ingesta continua:
+- solo se guardan las LOG_TOP_SCORES mejores puntuaciones de proveedor;
+- se borran los logs más antiguos que LOG_RETENTION_DAYS y los que exceden
+  LOG_MAX_ROWS (los más recientes se conservan), por lotes;
+- la purga se lanza sola cada LOG_PURGE_EVERY logs y también con
+  `python -m backend.admin purge-logs` o POST /admin/logs/purge.
+
+/admin/logs devuelve resúmenes paginados por cursor (id descendente) y el
+detalle completo (texto incluido) se pide con /admin/logs/{id}.
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy.orm import Session
+
+from .database import ExtractionLog
+from .documents import release_documents
+from .reports import encode_cursor, decode_cursor
+
+logger = logging.getLogger(__name__)
+
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "30"))  # 0 = sin límite de antigüedad
+LOG_MAX_ROWS = int(os.getenv("LOG_MAX_ROWS", "5000"))  # 0 = sin límite de filas
+LOG_TOP_SCORES = int(os.getenv("LOG_TOP_SCORES", "3"))
+LOG_PURGE_EVERY = int(os.getenv("LOG_PURGE_EVERY", "100"))  # 0 = solo purga manual
+PURGE_BATCH = 1000
+LOG_PAGE_SIZE = 20
+MAX_LOG_PAGE_SIZE = 200
+
+
+def top_scores(scores: list, k: int = LOG_TOP_SCORES) -> list:
+    """Las k mejores puntuaciones de proveedor (de mayor a menor)"""
+    ranked = sorted(scores or [], key=lambda s: s.get("score") or 0, reverse=True)
+    return ranked[:k]
+
+
+def record_extraction(db: Session, file_name: str, raw_text: str, scores: list, final_json: dict) -> ExtractionLog:
+    """Guarda el log compactado y, cada LOG_PURGE_EVERY logs, aplica la retención"""
+    log = ExtractionLog(file_name=file_name, raw_text=raw_text,
+                        matching_scores=top_scores(scores), final_json=final_json)
+    db.add(log)
+    db.commit()
+    # Por id (y no por contador del proceso) para que funcione igual con varias réplicas
+    if LOG_PURGE_EVERY and log.id and log.id % LOG_PURGE_EVERY == 0:
+        purge_logs(db)
+    return log
+
+
+def _delete_batch(db: Session, rows: list) -> int:
+    ids = [row.id for row in rows]
+    db.query(ExtractionLog).filter(ExtractionLog.id.in_(ids)).delete(synchronize_session=False)
+    # El borrado en bloque no dispara los eventos ORM: liberar los textos a mano
+    release_documents(db.connection(), [row.document_hash for row in rows])
+    db.commit()
+    return len(ids)
+
+
+def purge_logs(db: Session, max_age_days: int = None, max_rows: int = None, batch: int = PURGE_BATCH) -> int:
+    """Borra por lotes los logs caducados y los que exceden el máximo. Devuelve cuántos."""
+    max_age_days = LOG_RETENTION_DAYS if max_age_days is None else max_age_days
+    max_rows = LOG_MAX_ROWS if max_rows is None else max_rows
+    deleted = 0
+
+    if max_age_days:
+        cutoff = datetime.now() - timedelta(days=max_age_days)
+        while True:
+            rows = db.query(ExtractionLog.id, ExtractionLog.document_hash).filter(
+                ExtractionLog.timestamp < cutoff
+            ).order_by(ExtractionLog.id).limit(batch).all()
+            if not rows:
+                break
+            deleted += _delete_batch(db, rows)
+
+    if max_rows:
+        # Id del log más antiguo que se conserva
+        keep_from = db.query(ExtractionLog.id).order_by(ExtractionLog.id.desc()).offset(max_rows - 1).limit(1).scalar()
+        while keep_from is not None:
+            rows = db.query(ExtractionLog.id, ExtractionLog.document_hash).filter(
+                ExtractionLog.id < keep_from
+            ).order_by(ExtractionLog.id).limit(batch).all()
+            if not rows:
+                break
+            deleted += _delete_batch(db, rows)
+
+    if deleted:
+        logger.info(f"🧹 Logs de extracción purgados: {deleted}")
+    return deleted
+
+
+def compact_logs(db: Session, k: int = LOG_TOP_SCORES, batch: int = PURGE_BATCH) -> int:
+    """Recorta a k las puntuaciones de los logs anteriores a la compactación"""
+    compacted = 0
+    last_id = 0
+    while True:
+        rows = db.query(ExtractionLog.id, ExtractionLog.matching_scores).filter(
+            ExtractionLog.id > last_id
+        ).order_by(ExtractionLog.id).limit(batch).all()
+        if not rows:
+            break
+        for row in rows:
+            if row.matching_scores and len(row.matching_scores) > k:
+                db.query(ExtractionLog).filter(ExtractionLog.id == row.id).update(
+                    {ExtractionLog.matching_scores: top_scores(row.matching_scores, k)}, synchronize_session=False
+                )
+                compacted += 1
+        db.commit()
+        last_id = rows[-1].id
+    return compacted
+
+
+def maintain_logs(db: Session) -> int:
+    """Tarea de mantenimiento: purga y compactación. Devuelve los logs purgados."""
+    deleted = purge_logs(db)
+    compacted = compact_logs(db)
+    logger.info(f"📝 Logs: {deleted} purgados, {compacted} compactados")
+    return deleted
+
+
+def log_summary(log) -> dict:
+    best = (top_scores(log.matching_scores, 1) or [{}])[0]
+    final = log.final_json or {}
+    return {
+        "id": log.id,
+        "timestamp": log.timestamp,
+        "file_name": log.file_name,
+        "provider": best.get("provider"),
+        "score": best.get("score"),
+        "invoice_number": final.get("invoice_number"),
+        "vendor_name": final.get("vendor_name"),
+        "total_amount": final.get("total_amount"),
+    }
+
+
+def list_logs(db: Session, limit: int = LOG_PAGE_SIZE, after: str = None) -> tuple:
+    """Resúmenes de los logs más recientes primero. Devuelve (resúmenes, cursor siguiente)"""
+    limit = max(1, min(limit, MAX_LOG_PAGE_SIZE))
+    query = db.query(
+        ExtractionLog.id, ExtractionLog.timestamp, ExtractionLog.file_name,
+        ExtractionLog.matching_scores, ExtractionLog.final_json
+    )
+    if after:
+        _, last_id = decode_cursor(after, "id")
+        query = query.filter(ExtractionLog.id < last_id)
+    rows = query.order_by(ExtractionLog.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(None, rows[limit - 1].id) if len(rows) > limit else None
+    return [log_summary(row) for row in rows[:limit]], next_cursor
+
+
+def log_detail(db: Session, log_id: int) -> dict:
+    log = db.query(ExtractionLog).filter(ExtractionLog.id == log_id).first()
+    if log is None:
+        return None
+    return {
+        **log_summary(log),
+        "matching_scores": log.matching_scores,
+        "final_json": log.final_json,
+        "raw_text": log.raw_text,
+    }
@@ -0,0 +1,294 @@
+"""
+Pipeline de ingesta de una factura: texto → LLM → rescate por regex → guardado.
+
+- /upload lo hace en dos fases: guarda la factura en cuanto la detecta la
+  regex (save_regex_invoice, enrichment_status="pending") y el LLM la
+  completa después en segundo plano (enrichment.py).
+- Los workers de la cola de trabajos (jobs.py, `python -m backend.worker`)
+  y el watcher en modo local (WATCHER_MODE=local) ya están fuera de la
+  petición HTTP y ejecutan el pipeline completo (process_file).
+"""
+import json
+import os
+import re
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError, InterfaceError
+from sqlalchemy.orm import Session
+
+from .ai_service import extract_invoice_data, extract_text, match_provider_patterns, regex_only_data
+from .database import Invoice, Provider
+from .storage import discard_original
+
+# Errores pasajeros (conexión con la base de datos, disco, red): se reintentan en vez de rechazar la factura
+TRANSIENT_ERRORS = (OperationalError, InterfaceError, ConnectionError, TimeoutError)
+
+# Campos que admiten un valor por defecto por carpeta, con el valor que la extracción pone si no lo encuentra
+DEFAULT_FIELDS = {"category": "Other", "type": "Purchase"}
+
+
+# =============================================================================
+# RESCATE POR REGEX: Busca datos faltantes directamente en el texto del PDF
+# Primero usa los patrones del proveedor (configurables desde admin.html),
+# luego usa patrones genéricos como fallback.
+# =============================================================================
+def rescue_with_regex(data: dict, raw_text: str, db: Session = None) -> dict:
+    """
+    Si la IA dejó campos como 'unknown' o vacíos, 
+    busca directamente en el raw_text con regex.
+    
+    1º Intenta con patrones específicos del proveedor (de la tabla Provider en DB).
+    2º Si no encuentra, usa patrones genéricos hardcoded como fallback.
+    """
+    if not raw_text:
+        return data
+    
+    # --- Cargar patrones específicos del proveedor desde la DB ---
+    provider_patterns = {}
+    if db:
+        providers = db.query(Provider).all()
+        for prov in providers:
+            # Buscar si algún patrón de "vendor" coincide con el texto
+            if prov.patterns and prov.patterns.get("vendor"):
+                for vendor_pattern in prov.patterns["vendor"]:
+                    try:
+                        if re.search(vendor_pattern, raw_text, re.IGNORECASE):
+                            provider_patterns = prov.patterns
+                            print(f"🔧 REGEX RESCUE: Proveedor detectado: {prov.name}")
+                            break
+                    except re.error:
+                        pass
+                if provider_patterns:
+                    break
+    
+    # --- NÚMERO DE FACTURA ---
+    if not data.get("invoice_number") or data.get("invoice_number") == "unknown":
+        # 1º: Patrones del proveedor (de la DB, configurables desde admin.html)
+        db_invoice_patterns = provider_patterns.get("invoice_number", [])
+        # 2º: Patrones genéricos (fallback)
+        generic_invoice_patterns = [
+            r'N\.?\s*º?\s*(?:de\s+)?(?:factura|fact\.?)\s*[:.]?\s*([A-Z0-9][\w\-/]{3,20})',
+            r'(?:Factura|Invoice)\s*(?:N[ºo°]?|#|número)?\s*[:.]?\s*([A-Z0-9][\w\-/]{3,20})',
+            r'(FE\d{8,12})',
+            r'(FA\d{4,}[\-/]?\d*)',
+            r'Nº\s*Factura\s*[:.]?\s*([A-Z0-9][\w\-/]{3,20})',
+        ]
+        
+        all_patterns = db_invoice_patterns + generic_invoice_patterns
+        for pattern in all_patterns:
+            try:
+                match = re.search(pattern, raw_text, re.IGNORECASE)
+                if match:
+                    invoice_num = match.group(1).strip()
+                    if len(invoice_num) >= 4:
+                        source = "DB" if pattern in db_invoice_patterns else "genérico"
+                        data["invoice_number"] = invoice_num
+                        print(f"🔧 REGEX RESCUE ({source}): Nº factura = {invoice_num}")
+                        break
+            except re.error as e:
+                print(f"⚠️ Regex inválido (invoice_number): {pattern} → {e}")
+    
+    # --- FECHA DE FACTURA ---
+    if not data.get("date") or data.get("date") == "unknown":
+        db_date_patterns = provider_patterns.get("date", [])
+        generic_date_patterns = [
+            r'[Ff]echa\s+(?:de\s+la\s+)?factura\s*[:.]?\s*(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})',
+            r'[Ff]echa\s+(?:de\s+)?emisi[oó]n\s*[:.]?\s*(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})',
+            r'[Ff]echa\s*[:.]?\s*(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})',
+        ]
+        
+        all_patterns = db_date_patterns + generic_date_patterns
+        for pattern in all_patterns:
+            try:
+                match = re.search(pattern, raw_text)
+                if match:
+                    # Handle multi-group patterns (DD)(MM)(YYYY) or single-group DD/MM/YYYY
+                    groups = [g for g in match.groups() if g]
+                    if len(groups) == 3:
+                        # Pattern captured (DD)(MM)(YYYY) separately
+                        day, month, year = groups
+                    elif len(groups) == 1:
+                        # Pattern captured DD/MM/YYYY as single group
+                        date_raw = groups[0].strip()
+                        parts = re.split(r'[/-]', date_raw)
+                        if len(parts) == 3:
+                            day, month, year = parts
+                        else:
+                            continue
+                    else:
+                        continue
+                    
+                    if len(year) == 2:
+                        year = "20" + year
+                    try:
+                        source = "DB" if pattern in db_date_patterns else "genérico"
+                        data["date"] = f"{year}-{month.zfill(2)}-{day.zfill(2)}"
+                        print(f"🔧 REGEX RESCUE ({source}): Fecha = {data['date']}")
+                        break
+                    except:
+                        pass
+            except re.error as e:
+                print(f"⚠️ Regex inválido (date): {pattern} → {e}")
+    
+    # --- CONSUMO (kWh, m³) ---
+    if not data.get("consumption") or float(data.get("consumption", 0)) == 0:
+        db_consumption_patterns = provider_patterns.get("consumption", [])
+        generic_consumption_patterns = [
+            r'Total\s+periodo\s*\(?\d?\)?\s*(\d+[\.,]?\d*)\s+(\d+[\.,]?\d*)\s+(\d+[\.,]?\d*)',
+            r'[Cc]onsumo\s+(?:total|periodo)\s*[:.]?\s*(\d+[\.,]?\d*)\s*(kWh|m[³3]|litros?)',
+            r'(\d+[\.,]?\d*)\s*kWh\s*(?:total|consumidos?)',
+        ]
+        
+        all_patterns = db_consumption_patterns + generic_consumption_patterns
+        for pattern in all_patterns:
+            try:
+                match = re.search(pattern, raw_text)
+                if match:
+                    groups = [g for g in match.groups() if g]
+                    # Sum Punta+Llano+Valle if 3 numeric groups
+                    numeric_groups = [g for g in groups if g.replace(',', '.').replace('.', '', 1).isdigit()]
+                    if len(numeric_groups) == 3:
+                        total = sum(float(g.replace(',', '.')) for g in numeric_groups)
+                        data["consumption"] = total
+                        data["consumption_unit"] = "kWh"
+                        source = "DB" if pattern in db_consumption_patterns else "genérico"
+                        print(f"🔧 REGEX RESCUE ({source}): Consumo (P+L+V) = {total} kWh")
+                        break
+                    elif len(numeric_groups) >= 1:
+                        val = float(numeric_groups[0].replace(',', '.'))
+                        if val > 0:
+                            data["consumption"] = val
+                            data["consumption_unit"] = "kWh"
+                            source = "DB" if pattern in db_consumption_patterns else "genérico"
+                            print(f"🔧 REGEX RESCUE ({source}): Consumo = {val} kWh")
+                            break
+            except re.error as e:
+                print(f"⚠️ Regex inválido (consumption): {pattern} → {e}")
+
+    return data
+
+
+def parse_invoice_date(date_str) -> datetime:
+    """Fecha extraída en los formatos habituales (None si no hay o no se reconoce)"""
+    if not date_str:
+        print(f"⚠️ No se extrajo fecha de la factura, usando fecha actual")
+        return None
+    try:
+        # Try multiple date formats
+        print(f"🔍 Intentando parsear fecha: {date_str}")
+        for fmt in ["%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%Y/%m/%d"]:
+            try:
+                invoice_date = datetime.strptime(date_str, fmt)
+                print(f"✅ Fecha parseada correctamente: {invoice_date} usando formato {fmt}")
+                return invoice_date
+            except ValueError:
+                continue
+        print(f"⚠️ No se pudo parsear la fecha '{date_str}', usando fecha actual")
+    except Exception as e:
+        print(f"❌ Error al parsear fecha: {e}")
+    return None
+
+
+def apply_defaults(data: dict, defaults: dict) -> dict:
+    """Valores por defecto de la carpeta de origen (watcher) para lo que la extracción no determinó"""
+    for field, value in (defaults or {}).items():
+        if field in DEFAULT_FIELDS and value and data.get(field) in (None, "", "unknown", "Unknown", DEFAULT_FIELDS[field]):
+            data[field] = value
+    return data
+
+
+def save_extracted_invoice(db: Session, extracted_json: str, raw_text: str, file_path: str,
+                           enrichment_status: str = "done", remove_on_error: bool = True,
+                           defaults: dict = None, raise_transient: bool = False) -> dict:
+    """Completa los datos extraídos (rescate por regex, fecha), comprueba duplicados y guarda la factura.
+
+    remove_on_error: borra el fichero si la factura no se guarda (la copia subida a /upload);
+    el watcher en modo local lo desactiva porque el fichero es el original.
+    defaults: valores por defecto de la carpeta de origen (p. ej. categoría o tipo).
+    raise_transient: relanza TRANSIENT_ERRORS (workers y watcher los reintentan); un
+    resultado con status "error" es entonces un rechazo definitivo (reason: duplicate, invalid).
+    """
+    try:
+        data = json.loads(extracted_json)
+        
+        # === RESCATE POR REGEX: Si la IA dejó campos vacíos, los buscamos en el texto ===
+        data = rescue_with_regex(data, raw_text, db=db)
+        data = apply_defaults(data, defaults)
+        
+        # Parse date from extracted data
+        invoice_date = parse_invoice_date(data.get("date")) or datetime.now()  # Default fallback
+        
+        # Check for duplicate invoice number
+        if data.get("invoice_number") and data.get("invoice_number") != "unknown":
+            existing_invoice = db.query(Invoice).filter(
+                Invoice.invoice_number == data.get("invoice_number")
+            ).first()
+            if existing_invoice:
+                if remove_on_error:
+                    discard_original(db, file_path)  # Delete uploaded file (si ninguna factura lo usa)
+                return {
+                    "status": "error",
+                    "reason": "duplicate",
+                    "message": f"Factura duplicada: Ya existe la factura Nº {data.get('invoice_number')}"
+                }
+        
+        # Save to DB
+        new_invoice = Invoice(
+            invoice_number=data.get("invoice_number", "unknown"),
+            date=invoice_date,
+            vendor_name=data.get("vendor_name", "unknown"),
+            total_amount=float(data.get("total_amount") or 0),
+            currency=data.get("currency", "EUR"),
+            type=data.get("type", "Purchase"),
+            file_path=file_path,
+            category=data.get("category", "Other"),
+            consumption=float(data.get("consumption") or 0),
+            consumption_unit=data.get("consumption_unit", ""),
+            period=data.get("period"),
+            taxes=data.get("taxes"),
+            enrichment_status=enrichment_status,
+            raw_text=raw_text
+        )
+        db.add(new_invoice)
+        db.commit()
+        db.refresh(new_invoice)
+        
+        return {
+            "status": "success",
+            "message": f"Factura procesada: {new_invoice.invoice_number}",
+            "raw_text": raw_text,
+            "invoice": {
+                "id": new_invoice.id,
+                "invoice_number": new_invoice.invoice_number,
+                "vendor": new_invoice.vendor_name,
+                "total": new_invoice.total_amount,
+                "enrichment_status": new_invoice.enrichment_status
+            }
+        }
+    except Exception as e:
+        db.rollback()
+        if raise_transient and isinstance(e, TRANSIENT_ERRORS):
+            raise
+        if remove_on_error:
+            discard_original(db, file_path)
+        return {"status": "error", "reason": "invalid", "message": str(e)}
+
+
+def save_regex_invoice(db: Session, raw_text: str, file_path: str, defaults: dict = None) -> dict:
+    """Fase 1 de /upload: guarda la factura solo con regex; el LLM la completará (enrichment.py)"""
+    hints, _ = match_provider_patterns(raw_text or "", db)
+    return save_extracted_invoice(db, json.dumps(regex_only_data(hints), ensure_ascii=False), raw_text,
+                                  file_path, enrichment_status="pending", defaults=defaults)
+
+
+def process_file(db: Session, file_path: str, file_name: str = None, remove_on_error: bool = True,
+                 defaults: dict = None) -> dict:
+    """Procesa un fichero ya guardado en disco (workers de extracción y watcher en modo local).
+
+    Los errores pasajeros se relanzan para que el llamante reintente con espera.
+    """
+    file_name = file_name or os.path.basename(file_path)
+    raw_text = extract_text(file_path)
+    extracted_json = extract_invoice_data(raw_text, db, file_name)
+    return save_extracted_invoice(db, extracted_json, raw_text, file_path, remove_on_error=remove_on_error,
+                                  defaults=defaults, raise_transient=True)
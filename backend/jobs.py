@@ -0,0 +1,176 @@
+"""
+Cola persistente de trabajos de extracción (tabla extraction_jobs).
+
+La API (POST /jobs) guarda el fichero y encola un trabajo; los workers
+(`python -m backend.worker`, una o varias réplicas) los reclaman y ejecutan
+el pipeline de ingestion.py fuera de la petición HTTP.
+
+- Reclamo: en PostgreSQL `SELECT ... FOR UPDATE SKIP LOCKED`, así varios
+  workers reclaman trabajos distintos sin esperarse. En SQLite (tests) el
+  FOR UPDATE no existe y el reclamo es un UPDATE condicional: si otro worker
+  se adelantó no cambia ninguna fila y se prueba con el siguiente.
+- Plazo de visibilidad: el trabajo reclamado queda bloqueado hasta
+  locked_until (JOB_VISIBILITY_TIMEOUT). El worker lo renueva con latidos;
+  si el worker muere, al vencer el plazo otro worker lo vuelve a reclamar.
+- Reintentos: un error devuelve el trabajo a pending con espera exponencial
+  (JOB_RETRY_BACKOFF) hasta JOB_MAX_ATTEMPTS intentos; después queda failed.
+"""
+import logging
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, func
+from sqlalchemy.orm import Session
+
+from .database import ExtractionJob
+
+logger = logging.getLogger(__name__)
+
+JOB_VISIBILITY_TIMEOUT = int(os.getenv("JOB_VISIBILITY_TIMEOUT", "300"))  # segundos
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BACKOFF = int(os.getenv("JOB_RETRY_BACKOFF", "30"))  # segundos, se duplica en cada intento
+CLAIM_RETRIES = 5
+JOB_STATUSES = ("pending", "running", "done", "failed")
+
+
+def enqueue_job(db: Session, file_path: str, file_name: str = None, max_attempts: int = None) -> ExtractionJob:
+    job = ExtractionJob(
+        file_path=file_path,
+        file_name=file_name or os.path.basename(file_path),
+        status="pending",
+        max_attempts=max_attempts or JOB_MAX_ATTEMPTS,
+        available_at=datetime.now(),
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def _claimable(now: datetime):
+    """Pendientes ya disponibles, o en curso con el plazo de visibilidad vencido"""
+    return and_(
+        or_(
+            and_(ExtractionJob.status == "pending", ExtractionJob.available_at <= now),
+            and_(ExtractionJob.status == "running", ExtractionJob.locked_until < now),
+        ),
+        ExtractionJob.attempts < ExtractionJob.max_attempts,
+    )
+
+
+def claim_job(db: Session, worker_id: str, visibility_timeout: int = None) -> ExtractionJob:
+    """Reclama el siguiente trabajo disponible para worker_id (None si no hay)"""
+    visibility_timeout = visibility_timeout or JOB_VISIBILITY_TIMEOUT
+    for _ in range(CLAIM_RETRIES):
+        now = datetime.now()
+        job_id = db.query(ExtractionJob.id).filter(_claimable(now)).order_by(
+            ExtractionJob.available_at, ExtractionJob.id
+        ).limit(1).with_for_update(skip_locked=True).scalar()
+        if job_id is None:
+            db.commit()
+            return None
+        # El filtro se repite: en SQLite es lo que evita que dos workers reclamen el mismo trabajo
+        claimed = db.query(ExtractionJob).filter(ExtractionJob.id == job_id, _claimable(now)).update({
+            ExtractionJob.status: "running",
+            ExtractionJob.worker_id: worker_id,
+            ExtractionJob.attempts: ExtractionJob.attempts + 1,
+            ExtractionJob.heartbeat_at: now,
+            ExtractionJob.locked_until: now + timedelta(seconds=visibility_timeout),
+        }, synchronize_session=False)
+        db.commit()
+        if claimed:
+            return db.get(ExtractionJob, job_id, populate_existing=True)
+    return None
+
+
+def heartbeat(db: Session, job_id: int, worker_id: str, visibility_timeout: int = None) -> bool:
+    """Renueva el plazo de visibilidad. False si el trabajo ya no pertenece a este worker."""
+    visibility_timeout = visibility_timeout or JOB_VISIBILITY_TIMEOUT
+    now = datetime.now()
+    renewed = db.query(ExtractionJob).filter(
+        ExtractionJob.id == job_id, ExtractionJob.worker_id == worker_id, ExtractionJob.status == "running"
+    ).update({
+        ExtractionJob.heartbeat_at: now,
+        ExtractionJob.locked_until: now + timedelta(seconds=visibility_timeout),
+    }, synchronize_session=False)
+    db.commit()
+    return renewed == 1
+
+
+def complete_job(db: Session, job_id: int, worker_id: str, result: dict) -> bool:
+    """Guarda el resultado del pipeline. Un resultado con status "error" es un rechazo definitivo
+    (duplicada, datos ilegibles); los errores pasajeros llegan como excepción a fail_job, que reintenta."""
+    # El texto ya está en documents: no se duplica en el resultado del trabajo
+    result = {k: v for k, v in (result or {}).items() if k != "raw_text"}
+    failed = result.get("status") == "error"
+    updated = db.query(ExtractionJob).filter(
+        ExtractionJob.id == job_id, ExtractionJob.worker_id == worker_id, ExtractionJob.status == "running"
+    ).update({
+        ExtractionJob.status: "failed" if failed else "done",
+        ExtractionJob.result: result,
+        ExtractionJob.invoice_id: (result.get("invoice") or {}).get("id"),
+        ExtractionJob.last_error: result.get("message") if failed else None,
+        ExtractionJob.locked_until: None,
+        ExtractionJob.finished_at: datetime.now(),
+    }, synchronize_session=False)
+    db.commit()
+    return updated == 1
+
+
+def fail_job(db: Session, job_id: int, worker_id: str, error: str, retry: bool = True) -> str:
+    """Registra un error: vuelve a pending con espera o queda failed. Devuelve el nuevo estado."""
+    job = db.query(ExtractionJob).filter(
+        ExtractionJob.id == job_id, ExtractionJob.worker_id == worker_id, ExtractionJob.status == "running"
+    ).first()
+    if job is None:
+        db.commit()
+        return None
+    now = datetime.now()
+    if retry and job.attempts < job.max_attempts:
+        job.status = "pending"
+        job.available_at = now + timedelta(seconds=JOB_RETRY_BACKOFF * 2 ** (job.attempts - 1))
+    else:
+        job.status = "failed"
+        job.finished_at = now
+    job.last_error = str(error)[:1000]
+    job.locked_until = None
+    db.commit()
+    logger.warning(f"⚠️ Trabajo {job_id} ({job.file_name}) → {job.status}: {job.last_error}")
+    return job.status
+
+
+def expire_jobs(db: Session) -> int:
+    """Marca failed los trabajos en curso con el plazo vencido y sin intentos restantes"""
+    expired = db.query(ExtractionJob).filter(
+        ExtractionJob.status == "running",
+        ExtractionJob.locked_until < datetime.now(),
+        ExtractionJob.attempts >= ExtractionJob.max_attempts,
+    ).update({
+        ExtractionJob.status: "failed",
+        ExtractionJob.last_error: "Plazo de visibilidad vencido sin intentos restantes",
+        ExtractionJob.locked_until: None,
+        ExtractionJob.finished_at: datetime.now(),
+    }, synchronize_session=False)
+    db.commit()
+    return expired
+
+
+def job_view(job: ExtractionJob) -> dict:
+    return {
+        "id": job.id,
+        "file_name": job.file_name,
+        "status": job.status,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "worker_id": job.worker_id,
+        "last_error": job.last_error,
+        "invoice_id": job.invoice_id,
+        "result": job.result,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+    }
+
+
+def job_stats(db: Session) -> dict:
+    counts = dict(db.query(ExtractionJob.status, func.count(ExtractionJob.id)).group_by(ExtractionJob.status).all())
+    return {status: counts.get(status, 0) for status in JOB_STATUSES}
@@ -0,0 +1,121 @@
+"""
+KPIs deterministas calculados en Python antes de llamar al LLM.
+
+Los workflows kpis-direccion y resumen-reunion reciben facturas sueltas o
+filas de spend_rollups; aquí se reducen a un resumen de tamaño fijo (gasto
+total, por categoría y proveedor, tendencia mensual, coste por unidad y
+mayores variaciones). El LLM solo redacta la narrativa sobre esas cifras.
+"""
+from collections import defaultdict
+
+KPI_TOP_N = 5
+KPI_MONTHS = 12
+
+
+def _first(record: dict, *keys, default=None):
+    for key in keys:
+        value = record.get(key)
+        if value not in (None, ""):
+            return value
+    return default
+
+
+def _month(record: dict):
+    value = _first(record, "month", "date")
+    if value is None or str(value) in ("None", ""):
+        return None
+    return str(value)[:7]
+
+
+def _number(value) -> float:
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def normalize_record(record: dict) -> dict:
+    """Acepta facturas (total_amount/vendor_name...) o rollups (total/vendor/invoices)"""
+    total = _number(_first(record, "total", "total_amount"))
+    consumption = _number(record.get("consumption"))
+    # Importe con consumo (coste por unidad): en un rollup el total incluye facturas sin consumo
+    metered = _first(record, "metered", "metered_amount")
+    return {
+        "vendor": _first(record, "vendor", "vendor_name", default="Desconocido"),
+        "category": _first(record, "category", default="Other"),
+        "month": _month(record),
+        "count": int(_first(record, "invoices", "invoice_count", default=1)),
+        "total": total,
+        "consumption": consumption,
+        "metered": _number(metered) if metered is not None else (total if consumption > 0 else 0.0),
+        "unit": _first(record, "unit", "consumption_unit"),
+    }
+
+
+def _top(totals: dict, n: int) -> dict:
+    """Los n mayores y el resto agrupado en 'Otros'"""
+    ranked = sorted(totals.items(), key=lambda item: item[1], reverse=True)
+    result = {k: round(v, 2) for k, v in ranked[:n]}
+    rest = sum(v for _, v in ranked[n:])
+    if rest:
+        result["Otros"] = round(rest, 2)
+    return result
+
+
+def _pct(current: float, previous: float):
+    return round((current - previous) / previous * 100, 1) if previous else None
+
+
+def compute_kpis(records: list, top_n: int = KPI_TOP_N, months: int = KPI_MONTHS) -> dict:
+    """Resumen de KPIs de tamaño acotado (no crece con el número de facturas)"""
+    rows = [normalize_record(r) for r in records]
+    by_category = defaultdict(float)
+    by_vendor = defaultdict(float)
+    by_month = defaultdict(float)
+    by_vendor_month = defaultdict(float)
+    metered = defaultdict(lambda: {"cost": 0.0, "units": 0.0, "unit": None})
+    count = 0
+    total = 0.0
+
+    for r in rows:
+        count += r["count"]
+        total += r["total"]
+        by_category[r["category"]] += r["total"]
+        by_vendor[r["vendor"]] += r["total"]
+        if r["month"]:
+            by_month[r["month"]] += r["total"]
+            by_vendor_month[(r["vendor"], r["month"])] += r["total"]
+        if r["consumption"] > 0:
+            entry = metered[r["category"]]
+            entry["cost"] += r["metered"]
+            entry["units"] += r["consumption"]
+            entry["unit"] = entry["unit"] or r["unit"]
+
+    timeline = sorted(by_month)
+    last, previous = (timeline[-1] if timeline else None), (timeline[-2] if len(timeline) > 1 else None)
+
+    # Proveedores con mayor variación entre los dos últimos meses con datos
+    movers = []
+    if last and previous:
+        for vendor in by_vendor:
+            now, before = by_vendor_month.get((vendor, last), 0.0), by_vendor_month.get((vendor, previous), 0.0)
+            if now or before:
+                movers.append({"proveedor": vendor, "mes_anterior": round(before, 2), "ultimo_mes": round(now, 2),
+                               "variacion": round(now - before, 2), "variacion_pct": _pct(now, before)})
+        movers.sort(key=lambda m: abs(m["variacion"]), reverse=True)
+
+    return {
+        "periodo": {"desde": timeline[0], "hasta": last} if timeline else None,
+        "numero_facturas": count,
+        "gasto_total": round(total, 2),
+        "gasto_medio_factura": round(total / count, 2) if count else 0.0,
+        "gasto_por_categoria": _top(by_category, top_n),
+        "gasto_por_proveedor": _top(by_vendor, top_n),
+        "tendencia_mensual": [{"mes": m, "gasto": round(by_month[m], 2)} for m in timeline[-months:]],
+        "variacion_ultimo_mes_pct": _pct(by_month[last], by_month[previous]) if previous else None,
+        "coste_por_unidad": {
+            category: {"coste_unitario": round(e["cost"] / e["units"], 4), "unidad": e["unit"]}
+            for category, e in sorted(metered.items(), key=lambda item: item[1]["cost"], reverse=True)[:top_n]
+        },
+        "mayores_variaciones": movers[:top_n],
+    }
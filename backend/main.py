@@ -1,24 +1,43 @@
-from fastapi import FastAPI, UploadFile, File, Response
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi import FastAPI, UploadFile, File, Form, Response
+from fastapi.responses import FileResponse, RedirectResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-import shutil
 import os
 from .ai_service import (
-    extract_invoice_data, chat_with_invoices, get_text_from_image, get_text_from_pdf,
+    chat_with_invoices, save_and_extract_text,
     validate_invoice, generate_kpis_direccion, generate_kpis_reclamacion,
-    compare_supplier, generate_meeting_summary, check_alerts
+    compare_supplier, generate_meeting_summary, check_alerts, EXTRACTION_STATS
 )
 import os
 from pydantic import BaseModel
-from .database import SessionLocal, init_db, Invoice, get_db, Provider, ExtractionLog, SystemSetting
+from .database import SessionLocal, init_db, Invoice, get_db, Provider, SystemSetting, ExtractionJob
+from .search import search_invoices
+from .chat_context import build_chat_context
+from .stats import advanced_stats
+from .rollups import rollup_rows
+from .anomalies import scan_anomalies, historical_averages
+from .benchmarking import benchmark_table, compare_invoice
+from .validation import validate_with_rules, validate_all
+from .export import EXPORT_FORMATS, stream_csv, stream_parquet, parquet_available, BATCH_ROWS as EXPORT_BATCH_ROWS
+from .reports import (
+    parse_fields, build_report_query, count_reports, encode_cursor, stream_json_array,
+    ReportQueryError, MAX_PAGE_SIZE
+)
+from .query_router import route_query, figures_context
+from .extraction_logs import list_logs, log_detail, purge_logs, compact_logs, LOG_PAGE_SIZE
+from .executors import offload, run_in, pool_stats, shutdown_pools
+from .ingestion import rescue_with_regex, save_extracted_invoice, save_regex_invoice
+from .enrichment import schedule_enrichment, enrichment_stats
+from .jobs import enqueue_job, job_view, job_stats
+from .storage import original_path, save_original, remove_unreferenced
+from sqlalchemy import func
 from sqlalchemy.orm import Session
-from fastapi import Depends
-from datetime import datetime
+from fastapi import Depends, Query
+from datetime import datetime, date
 import json
-import re
 from typing import Optional, List
 from pathlib import Path
+from contextlib import asynccontextmanager
 
 # Ensure DB is initialized (only in non-testing mode)
 if not os.getenv("TESTING", "false").lower() == "true":
@@ -67,7 +86,21 @@ class WorkflowRequest(BaseModel):
     period: Optional[str] = None
     thresholds: Optional[dict] = None
 
-app = FastAPI(title="Invoice Reader API")
+class AlertScanRequest(BaseModel):
+    thresholds: Optional[dict] = None
+    vendor: Optional[str] = None
+    category: Optional[str] = None
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+    narrate: bool = True  # Pedir al LLM la explicación de las facturas marcadas
+    max_narratives: int = 10
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    shutdown_pools(wait=False)
+
+app = FastAPI(title="Invoice Reader API", lifespan=lifespan)
 
 DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://user:password@db:5432/invoices")
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://ollama:11434/api/generate")
@@ -99,339 +132,190 @@ async def read_root():
     """Redirect to frontend application"""
     return RedirectResponse(url="/frontend/index.html")
 
-UPLOAD_DIR = "backend/uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-
-# =============================================================================
-# RESCATE POR REGEX: Busca datos faltantes directamente en el texto del PDF
-# Primero usa los patrones del proveedor (configurables desde admin.html),
-# luego usa patrones genéricos como fallback.
-# =============================================================================
-def rescue_with_regex(data: dict, raw_text: str, db: Session = None) -> dict:
-    """
-    Si la IA dejó campos como 'unknown' o vacíos, 
-    busca directamente en el raw_text con regex.
-    
-    1º Intenta con patrones específicos del proveedor (de la tabla Provider en DB).
-    2º Si no encuentra, usa patrones genéricos hardcoded como fallback.
-    """
-    if not raw_text:
-        return data
-    
-    # --- Cargar patrones específicos del proveedor desde la DB ---
-    provider_patterns = {}
-    if db:
-        providers = db.query(Provider).all()
-        for prov in providers:
-            # Buscar si algún patrón de "vendor" coincide con el texto
-            if prov.patterns and prov.patterns.get("vendor"):
-                for vendor_pattern in prov.patterns["vendor"]:
-                    try:
-                        if re.search(vendor_pattern, raw_text, re.IGNORECASE):
-                            provider_patterns = prov.patterns
-                            print(f"🔧 REGEX RESCUE: Proveedor detectado: {prov.name}")
-                            break
-                    except re.error:
-                        pass
-                if provider_patterns:
-                    break
-    
-    # --- NÚMERO DE FACTURA ---
-    if not data.get("invoice_number") or data.get("invoice_number") == "unknown":
-        # 1º: Patrones del proveedor (de la DB, configurables desde admin.html)
-        db_invoice_patterns = provider_patterns.get("invoice_number", [])
-        # 2º: Patrones genéricos (fallback)
-        generic_invoice_patterns = [
-            r'N\.?\s*º?\s*(?:de\s+)?(?:factura|fact\.?)\s*[:.]?\s*([A-Z0-9][\w\-/]{3,20})',
-            r'(?:Factura|Invoice)\s*(?:N[ºo°]?|#|número)?\s*[:.]?\s*([A-Z0-9][\w\-/]{3,20})',
-            r'(FE\d{8,12})',
-            r'(FA\d{4,}[\-/]?\d*)',
-            r'Nº\s*Factura\s*[:.]?\s*([A-Z0-9][\w\-/]{3,20})',
-        ]
-        
-        all_patterns = db_invoice_patterns + generic_invoice_patterns
-        for pattern in all_patterns:
-            try:
-                match = re.search(pattern, raw_text, re.IGNORECASE)
-                if match:
-                    invoice_num = match.group(1).strip()
-                    if len(invoice_num) >= 4:
-                        source = "DB" if pattern in db_invoice_patterns else "genérico"
-                        data["invoice_number"] = invoice_num
-                        print(f"🔧 REGEX RESCUE ({source}): Nº factura = {invoice_num}")
-                        break
-            except re.error as e:
-                print(f"⚠️ Regex inválido (invoice_number): {pattern} → {e}")
-    
-    # --- FECHA DE FACTURA ---
-    if not data.get("date") or data.get("date") == "unknown":
-        db_date_patterns = provider_patterns.get("date", [])
-        generic_date_patterns = [
-            r'[Ff]echa\s+(?:de\s+la\s+)?factura\s*[:.]?\s*(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})',
-            r'[Ff]echa\s+(?:de\s+)?emisi[oó]n\s*[:.]?\s*(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})',
-            r'[Ff]echa\s*[:.]?\s*(\d{1,2}[/-]\d{1,2}[/-]\d{2,4})',
-        ]
-        
-        all_patterns = db_date_patterns + generic_date_patterns
-        for pattern in all_patterns:
-            try:
-                match = re.search(pattern, raw_text)
-                if match:
-                    # Handle multi-group patterns (DD)(MM)(YYYY) or single-group DD/MM/YYYY
-                    groups = [g for g in match.groups() if g]
-                    if len(groups) == 3:
-                        # Pattern captured (DD)(MM)(YYYY) separately
-                        day, month, year = groups
-                    elif len(groups) == 1:
-                        # Pattern captured DD/MM/YYYY as single group
-                        date_raw = groups[0].strip()
-                        parts = re.split(r'[/-]', date_raw)
-                        if len(parts) == 3:
-                            day, month, year = parts
-                        else:
-                            continue
-                    else:
-                        continue
-                    
-                    if len(year) == 2:
-                        year = "20" + year
-                    try:
-                        source = "DB" if pattern in db_date_patterns else "genérico"
-                        data["date"] = f"{year}-{month.zfill(2)}-{day.zfill(2)}"
-                        print(f"🔧 REGEX RESCUE ({source}): Fecha = {data['date']}")
-                        break
-                    except:
-                        pass
-            except re.error as e:
-                print(f"⚠️ Regex inválido (date): {pattern} → {e}")
-    
-    # --- CONSUMO (kWh, m³) ---
-    if not data.get("consumption") or float(data.get("consumption", 0)) == 0:
-        db_consumption_patterns = provider_patterns.get("consumption", [])
-        generic_consumption_patterns = [
-            r'Total\s+periodo\s*\(?\d?\)?\s*(\d+[\.,]?\d*)\s+(\d+[\.,]?\d*)\s+(\d+[\.,]?\d*)',
-            r'[Cc]onsumo\s+(?:total|periodo)\s*[:.]?\s*(\d+[\.,]?\d*)\s*(kWh|m[³3]|litros?)',
-            r'(\d+[\.,]?\d*)\s*kWh\s*(?:total|consumidos?)',
-        ]
-        
-        all_patterns = db_consumption_patterns + generic_consumption_patterns
-        for pattern in all_patterns:
-            try:
-                match = re.search(pattern, raw_text)
-                if match:
-                    groups = [g for g in match.groups() if g]
-                    # Sum Punta+Llano+Valle if 3 numeric groups
-                    numeric_groups = [g for g in groups if g.replace(',', '.').replace('.', '', 1).isdigit()]
-                    if len(numeric_groups) == 3:
-                        total = sum(float(g.replace(',', '.')) for g in numeric_groups)
-                        data["consumption"] = total
-                        data["consumption_unit"] = "kWh"
-                        source = "DB" if pattern in db_consumption_patterns else "genérico"
-                        print(f"🔧 REGEX RESCUE ({source}): Consumo (P+L+V) = {total} kWh")
-                        break
-                    elif len(numeric_groups) >= 1:
-                        val = float(numeric_groups[0].replace(',', '.'))
-                        if val > 0:
-                            data["consumption"] = val
-                            data["consumption_unit"] = "kWh"
-                            source = "DB" if pattern in db_consumption_patterns else "genérico"
-                            print(f"🔧 REGEX RESCUE ({source}): Consumo = {val} kWh")
-                            break
-            except re.error as e:
-                print(f"⚠️ Regex inválido (consumption): {pattern} → {e}")
-
-    return data
+COMPARE_HISTORY_LIMIT = 12
 
 @app.post("/upload")
-async def upload_invoice(file: UploadFile = File(...), db: Session = Depends(get_db)):
-    file_path = os.path.join(UPLOAD_DIR, file.filename)
-    
-    # Check if file already exists
-    existing = db.query(Invoice).filter(Invoice.file_path.contains(file.filename)).first()
+async def upload_invoice(file: UploadFile = File(...), category: Optional[str] = Form(None),
+                         invoice_type: Optional[str] = Form(None), db: Session = Depends(get_db)):
+    """Sube una factura. category/invoice_type: valores por defecto de la carpeta de origen (watcher)"""
+    defaults = {"category": category, "type": invoice_type}
+    content = await file.read()
+    # Ruta por contenido (storage.py): mismo fichero, misma ruta; mismo nombre con otro contenido, otra ruta
+    file_path = original_path(content, file.filename)
+    
+    # Check if file already exists (igualdad exacta: usa ix_invoices_file_path)
+    existing = await run_in("db", db.query(Invoice).filter(Invoice.file_path == file_path).first)
     if existing:
         return {
-            "status": "error", 
+            "status": "error",
+            "reason": "duplicate",
             "message": f"Esta factura ya existe (Nº {existing.invoice_number}). No se permiten duplicados."
         }
     
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    # Real Extraction (PDF or Image)
-    if file.filename.lower().endswith(".pdf"):
-        raw_text = get_text_from_pdf(file_path)
-    else:
-        raw_text = get_text_from_image(file_path)
+    # Cada paso bloqueante en su pool: fichero + PDF/OCR (cpu), LLM (llm), guardado (db)
+    raw_text = await run_in("cpu", save_and_extract_text, content, file_path)
     
     if not raw_text or "Error" in raw_text:
         # If text extraction failed, it might be a scanned PDF image-only
         # For simplicity in this TFM, we focus on searchable PDFs or images
         pass
 
-    extracted_json = extract_invoice_data(raw_text, db, file.filename)
-    
-    try:
-        data = json.loads(extracted_json)
-        
-        # === RESCATE POR REGEX: Si la IA dejó campos vacíos, los buscamos en el texto ===
-        data = rescue_with_regex(data, raw_text, db=db)
-        
-        # Parse date from extracted data
-        invoice_date = datetime.now()  # Default fallback
-        if data.get("date"):
-            try:
-                # Try multiple date formats
-                date_str = data.get("date")
-                print(f"🔍 Intentando parsear fecha: {date_str}")
-                for fmt in ["%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%Y/%m/%d"]:
-                    try:
-                        invoice_date = datetime.strptime(date_str, fmt)
-                        print(f"✅ Fecha parseada correctamente: {invoice_date} usando formato {fmt}")
-                        break
-                    except ValueError:
-                        continue
-                else:
-                    print(f"⚠️ No se pudo parsear la fecha '{date_str}', usando fecha actual")
-            except Exception as e:
-                print(f"❌ Error al parsear fecha: {e}")
-        else:
-            print(f"⚠️ No se extrajo fecha de la factura, usando fecha actual")
-        
-        # Check for duplicate invoice number
-        if data.get("invoice_number") and data.get("invoice_number") != "unknown":
-            existing_invoice = db.query(Invoice).filter(
-                Invoice.invoice_number == data.get("invoice_number")
-            ).first()
-            if existing_invoice:
-                os.remove(file_path)  # Delete uploaded file
-                return {
-                    "status": "error",
-                    "message": f"Factura duplicada: Ya existe la factura Nº {data.get('invoice_number')}"
-                }
-        
-        # Save to DB
-        new_invoice = Invoice(
-            invoice_number=data.get("invoice_number", "unknown"),
-            date=invoice_date,
-            vendor_name=data.get("vendor_name", "unknown"),
-            total_amount=float(data.get("total_amount") or 0),
-            currency=data.get("currency", "EUR"),
-            type=data.get("type", "Purchase"),
-            file_path=file_path,
-            category=data.get("category", "Other"),
-            consumption=float(data.get("consumption") or 0),
-            consumption_unit=data.get("consumption_unit", ""),
-            raw_text=raw_text
-        )
-        db.add(new_invoice)
-        db.commit()
-        db.refresh(new_invoice)
-        
+    # Fase 1: la factura queda guardada con la regex; el LLM la completa en segundo plano
+    result = await run_in("db", save_regex_invoice, db, raw_text, file_path, defaults)
+    if result.get("status") == "success":
+        result["invoice"]["enrichment_status"] = await schedule_enrichment(result["invoice"]["id"])
+    return result
+
+@app.post("/jobs")
+async def enqueue_invoice(file: UploadFile = File(...), db: Session = Depends(get_db)):
+    """Guarda el fichero y encola su extracción para los workers (python -m backend.worker)"""
+    content = await file.read()
+    file_path = original_path(content, file.filename)
+    return await run_in("db", save_and_enqueue, db, content, file_path, file.filename)
+
+def save_and_enqueue(db: Session, content: bytes, file_path: str, file_name: str) -> dict:
+    existing = db.query(Invoice).filter(Invoice.file_path == file_path).first()
+    if existing:
         return {
-            "status": "success",
-            "message": f"Factura procesada: {new_invoice.invoice_number}",
-            "raw_text": raw_text,
-            "invoice": {
-                "id": new_invoice.id,
-                "invoice_number": new_invoice.invoice_number,
-                "vendor": new_invoice.vendor_name,
-                "total": new_invoice.total_amount
-            }
+            "status": "error",
+            "message": f"Esta factura ya existe (Nº {existing.invoice_number}). No se permiten duplicados."
         }
-    except Exception as e:
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        return {"status": "error", "message": str(e)}
+    active = db.query(ExtractionJob).filter(
+        ExtractionJob.file_path == file_path, ExtractionJob.status.in_(["pending", "running"])
+    ).first()
+    if active:
+        return {"status": "success", "job": job_view(active)}
+    save_original(content, file_name)
+    job = enqueue_job(db, file_path, file_name)
+    return {"status": "success", "job": job_view(job)}
+
+@app.get("/jobs/{job_id}")
+@offload("db")
+def get_job(job_id: int, db: Session = Depends(get_db)):
+    """Estado de un trabajo de extracción"""
+    job = db.get(ExtractionJob, job_id)
+    if job is None:
+        return {"status": "error", "message": "Trabajo no encontrado"}
+    return {"status": "success", "job": job_view(job)}
+
+@app.get("/admin/jobs")
+@offload("db")
+def get_job_stats(db: Session = Depends(get_db)):
+    """Nº de trabajos de extracción y de facturas por estado de completado con el LLM"""
+    return {"status": "success", "jobs": job_stats(db), "enrichment": enrichment_stats(db)}
+
+@app.get("/search")
+@offload("db")
+def search(q: str, limit: int = 20, offset: int = 0, db: Session = Depends(get_db)):
+    """Búsqueda de texto completo con resultados ordenados y fragmentos resaltados"""
+    limit = max(1, min(limit, 100))
+    results = search_invoices(db, q, limit=limit, offset=max(0, offset))
+    return {"status": "success", "query": q, "count": len(results), "results": results}
 
 @app.get("/reports")
-def get_reports(db: Session = Depends(get_db)):
-    invoices = db.query(Invoice).all()
-    return invoices
+@offload("db")
+def get_reports(
+    limit: Optional[int] = None, after: Optional[str] = None, fields: Optional[str] = None,
+    include_raw_text: bool = False, sort: str = "id", vendor: Optional[str] = None,
+    category: Optional[str] = None, date_from: Optional[date] = None, date_to: Optional[date] = None,
+    db: Session = Depends(get_db)
+):
+    """Listado de facturas en streaming (array JSON).
+
+    Sin `limit` devuelve todas las filas que cumplen los filtros; con `limit`
+    devuelve una página y la cabecera X-Next-Cursor para pedir la siguiente
+    con `after`. X-Total-Count lleva el total filtrado. raw_text solo se
+    incluye con include_raw_text=true o pidiéndolo en `fields`.
+    """
+    filters = {"vendor": vendor, "category": category, "date_from": date_from, "date_to": date_to}
+    try:
+        selected = parse_fields(fields, include_raw_text)
+        query = build_report_query(db, selected, sort=sort, after=after, **filters)
+    except ReportQueryError as e:
+        return JSONResponse(status_code=400, content={"status": "error", "message": str(e)})
+
+    headers = {"X-Total-Count": str(count_reports(db, **filters))}
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        rows = query.limit(limit + 1).all()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            headers["X-Next-Cursor"] = encode_cursor(rows[-1]._sort, rows[-1].id)
+        return StreamingResponse(stream_json_array(rows, selected), media_type="application/json", headers=headers)
+
+    # Sin límite: sesión propia que vive lo que dure el streaming, leyendo por lotes
+    stream_db = SessionLocal()
+    rows = build_report_query(stream_db, selected, sort=sort, **filters).yield_per(500)
+    return StreamingResponse(
+        stream_json_array(rows, selected, close=stream_db.close), media_type="application/json", headers=headers
+    )
+
+@app.get("/benchmarks")
+@offload("db")
+def get_benchmarks(category: Optional[str] = None, db: Session = Depends(get_db)):
+    """Distribución del coste por unidad de cada proveedor (percentiles, tendencia)"""
+    table = benchmark_table(db, category)
+    return {"status": "success", "count": len(table), "benchmarks": table}
+
+@app.get("/export")
+@offload("db")
+def export_invoices(
+    export_format: str = Query("csv", alias="format"), fields: Optional[str] = None,
+    include_raw_text: bool = False, sort: str = "id",
+    vendor: Optional[str] = None, category: Optional[str] = None,
+    date_from: Optional[date] = None, date_to: Optional[date] = None
+):
+    """Exporta las facturas (mismos filtros que /reports) en CSV o Parquet, en streaming"""
+    if export_format not in EXPORT_FORMATS:
+        return JSONResponse(status_code=400, content={
+            "status": "error", "message": f"Formato no soportado: {export_format}. Opciones: {', '.join(EXPORT_FORMATS)}"
+        })
+    if export_format == "parquet" and not parquet_available():
+        return JSONResponse(status_code=501, content={
+            "status": "error", "message": "Exportación Parquet no disponible: instala pyarrow"
+        })
+
+    filters = {"vendor": vendor, "category": category, "date_from": date_from, "date_to": date_to}
+    stream_db = SessionLocal()
+    try:
+        selected = parse_fields(fields, include_raw_text)
+        rows = build_report_query(stream_db, selected, sort=sort, **filters).yield_per(EXPORT_BATCH_ROWS)
+    except ReportQueryError as e:
+        stream_db.close()
+        return JSONResponse(status_code=400, content={"status": "error", "message": str(e)})
+
+    writer = stream_csv if export_format == "csv" else stream_parquet
+    filename = f"facturas_{datetime.now():%Y%m%d_%H%M%S}.{export_format}"
+    return StreamingResponse(
+        writer(rows, selected, close=stream_db.close), media_type=EXPORT_FORMATS[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
 
 @app.post("/chat")
 async def chat(request: ChatRequest, db: Session = Depends(get_db)):
-    # Improved Context Selection based on Query
-    query_lower = request.query.lower()
-    
-    # 1. Filter invoices based on keywords in query (e.g. "Som Energia", "diciembre")
-    all_invoices = db.query(Invoice).all()
-    relevant_invoices = []
-    
-    for inv in all_invoices:
-        # Check for vendor match (check if ANY word from vendor appears in query)
-        if inv.vendor_name:
-            vendor_words = inv.vendor_name.lower().replace(",", "").split()
-            # Match if at least 2 words match, or 1 word if vendor has only 1 word
-            matches = sum(1 for w in vendor_words if len(w) > 2 and w in query_lower)
-            if matches >= 1:
-                relevant_invoices.append(inv)
-                continue
-            
-        # Check for category match (e.g. "luz", "electricidad")
-        if inv.category and inv.category.lower() in query_lower:
-            relevant_invoices.append(inv)
-            continue
-            
-        # Check for month/year match in date
-        if inv.date:
-            date_str = str(inv.date)
-            # Simple check if YYYY-MM is in query
-            if date_str[:7] in request.query: 
-                relevant_invoices.append(inv)
-                continue
-    
-    # Fallback: if no specific filtering, use all invoices (but limit text size)
-    if not relevant_invoices:
-        relevant_invoices = all_invoices
-
-    context = ""
-    # ESTRATEGIA: Solo incluir RAW TEXT si el usuario pregunta por un proveedor específico
-    # para no agotar la cuota de tokens con preguntas generales.
-    include_raw_text = False
-    if relevant_invoices and len(relevant_invoices) < len(all_invoices):
-        # Si hemos filtrado (ej: "de Som Energia"), entonces sí queremos el detalle
-        include_raw_text = True
-    
-    # DEBUG LOG
-    print(f"🔍 CHAT DEBUG: Query='{request.query}', Relevant={len(relevant_invoices)}/{len(all_invoices)}, IncludeRawText={include_raw_text}")
-    
-    for inv in relevant_invoices:
-        context += f"=== FACTURA ID {inv.id} ===\n"
-        
-        # RAW TEXT FIRST (most important for the AI to read)
-        if include_raw_text and inv.raw_text:
-            context += f"TEXTO COMPLETO DEL PDF (FUENTE PRINCIPAL - LEE ESTO PRIMERO):\n"
-            context += f"{inv.raw_text[:2000]}\n"
-            context += f"--- FIN TEXTO PDF ---\n"
-        
-        # Structured data SECOND (only show non-unknown fields)
-        context += f"DATOS EXTRAÍDOS AUTOMÁTICAMENTE:\n"
-        context += f"  Proveedor: {inv.vendor_name}\n"
-        context += f"  Total: {inv.total_amount} {inv.currency}\n"
-        context += f"  Categoría: {inv.category}\n"
-        
-        if inv.invoice_number and inv.invoice_number != "unknown":
-            context += f"  Nº Factura: {inv.invoice_number}\n"
-        else:
-            context += f"  Nº Factura: (NO EXTRAÍDO - BUSCAR EN TEXTO DEL PDF ARRIBA)\n"
-            
-        if inv.consumption and inv.consumption > 0:
-            context += f"  Consumo: {inv.consumption} {inv.consumption_unit}\n"
-        
-        context += "\n"
-    
+    # 0. Aggregate questions ("¿cuánto gastamos en luz en diciembre?") are answered with SQL
+    routed = await run_in("db", route_query, db, request.query)
+    if routed and routed["direct"]:
+        print(f"⚡ CHAT ROUTER: respuesta SQL directa ({routed['scope']})")
+        return {"response": routed["answer"], "source": "sql", "figures": routed["figures"]}
+
+    # 1. Context within a fixed token budget: detail for narrow questions, rollups for broad ones
+    prefix = figures_context(routed) if routed else ""
+    context, stats = await run_in("db", build_chat_context, db, request.query, prefix=prefix)
+
     # DEBUG LOG
-    print(f"📝 CHAT DEBUG: Contexto total = {len(context)} caracteres")
-    print(f"📝 CHAT DEBUG: Contiene 'N.º de factura'? {'Sí' if 'N.º de factura' in context else 'No'}")
-    
+    print(f"🔍 CHAT DEBUG: Query='{request.query}', Modo={stats['mode']}, "
+          f"Seleccionadas={stats['selected']}/{stats['total_invoices']}, Tokens≈{stats['tokens']}")
+
     if not context:
         context = "No hay facturas procesadas todavía."
-        
-    response = chat_with_invoices(request.query, context, db=db)
+
+    response = await run_in("llm", chat_with_invoices, request.query, context, db=db)
     return {"response": response}
 
 @app.delete("/invoices/{invoice_id}")
-async def delete_invoice(invoice_id: int, db: Session = Depends(get_db)):
+@offload("db")
+def delete_invoice(invoice_id: int, db: Session = Depends(get_db)):
     invoice = db.query(Invoice).filter(Invoice.id == invoice_id).first()
     if not invoice:
         return {"status": "error", "message": "Invoice not found"}
@@ -444,11 +328,12 @@ async def delete_invoice(invoice_id: int, db: Session = Depends(get_db)):
     db.delete(invoice)
     db.commit()
     
-    # Then delete physical file if it exists
-    if file_path and os.path.exists(file_path):
+    # Then delete physical file if no other invoice uses it
+    # (los del almacén por contenido los libera storage.py al llegar su contador a 0)
+    if file_path:
         try:
-            os.remove(file_path)
-            print(f"✅ Archivo eliminado: {file_path}")
+            if remove_unreferenced(db, file_path):
+                print(f"✅ Archivo eliminado: {file_path}")
         except Exception as e:
             print(f"⚠️ Error al eliminar archivo: {str(e)}")
             # Don't fail if file deletion fails, as DB record is already deleted
@@ -459,63 +344,53 @@ async def delete_invoice(invoice_id: int, db: Session = Depends(get_db)):
     }
 
 @app.get("/advanced-stats")
-def get_advanced_stats(db: Session = Depends(get_db)):
-    invoices = db.query(Invoice).all()
-    
-    # Category distribution
-    categories = {}
-    total_cost = 0
-    
-    for inv in invoices:
-        cat = inv.category or "Other"
-        categories[cat] = categories.get(cat, 0) + inv.total_amount
-        total_cost += inv.total_amount
-    
-    distribution = [
-        {"name": cat, "value": amt, "percent": (amt/total_cost*100) if total_cost > 0 else 0}
-        for cat, amt in categories.items()
-    ]
-    
-    # Efficiency KPIs (simplified: average cost per unit by category)
-    efficiency = []
-    cat_consumption = {}
-    for inv in invoices:
-        if inv.consumption and inv.consumption > 0:
-            cat = inv.category or "Other"
-            if cat not in cat_consumption:
-                cat_consumption[cat] = {"cost": 0, "units": 0, "unit": inv.consumption_unit}
-            cat_consumption[cat]["cost"] += inv.total_amount
-            cat_consumption[cat]["units"] += inv.consumption
-            
-    for cat, data in cat_consumption.items():
-        efficiency.append({
-            "category": cat,
-            "cost_per_unit": data["cost"] / data["units"],
-            "unit": data["unit"]
-        })
-        
-    return {
-        "distribution": distribution,
-        "efficiency": efficiency,
-        "total_cost": total_cost,
-        "invoice_count": len(invoices)
-    }
+@offload("db")
+def get_advanced_stats(
+    vendor: Optional[str] = None, category: Optional[str] = None,
+    date_from: Optional[date] = None, date_to: Optional[date] = None,
+    db: Session = Depends(get_db)
+):
+    """Distribución por categoría, coste por unidad y desglose mensual (agregados SQL)"""
+    return advanced_stats(db, vendor=vendor, category=category, date_from=date_from, date_to=date_to)
 
 # ============== WORKFLOW ENDPOINTS ==============
 
 @app.post("/workflow/validar-factura")
 async def workflow_validate_invoice(request: WorkflowRequest, db: Session = Depends(get_db)):
     """Workflow: Validar factura y detectar errores"""
+    # Deterministic rules first (pool db); only the ambiguous cases hop to the llm pool
+    invoice_data, rules, context = await run_in("db", validation_rules_step, db, request)
+    if rules is None:
+        return {"status": "error", "message": "Factura no encontrada"}
+    if not rules["escalate"]:
+        return rules
+
+    result = await run_in("llm", validate_invoice, invoice_data, context, db=db)
+    # Parse JSON result if it's a string
+    if isinstance(result, str):
+        try:
+            result = json.loads(result)
+        except:
+            pass
+    if isinstance(result, dict):
+        return {**result, "source": "rules+llm", "rule_findings": rules["reasons"]}
+    return {**rules, "llm_result": result}
+
+def validation_rules_step(db: Session, request: WorkflowRequest) -> tuple:
+    """Datos de la factura, resultado de las reglas y contexto para el LLM (None si no existe la factura)"""
     # Handle different input formats from tests
     if request.invoice_id:
         invoice = db.query(Invoice).filter(Invoice.id == request.invoice_id).first()
         if not invoice:
-            return {"status": "error", "message": "Factura no encontrada"}
+            return None, None, None
         
         invoice_data = {
+            "id": invoice.id,
             "invoice_number": invoice.invoice_number,
             "vendor": invoice.vendor_name,
+            "date": str(invoice.date) if invoice.date else None,
             "total": invoice.total_amount,
+            "taxes": invoice.taxes,
             "consumption": invoice.consumption,
             "unit": invoice.consumption_unit,
             "category": invoice.category
@@ -523,41 +398,33 @@ async def workflow_validate_invoice(request: WorkflowRequest, db: Session = Depe
     elif request.invoice_data:
         invoice_data = request.invoice_data
     else:
-        invoice_data = request.data
+        invoice_data = request.data or {}
     
-    # Get context from other invoices
-    invoices = db.query(Invoice).all()
-    context = f"Histórico de {len(invoices)} facturas procesadas"
-    
-    result = validate_invoice(invoice_data, context, db=db)
-    # Parse JSON result if it's a string
-    if isinstance(result, str):
-        try:
-            result = json.loads(result)
-        except:
-            pass
-    return result if isinstance(result, dict) else {"status": "success", "result": result}
+    rules = validate_with_rules(db, invoice_data)
+    if not rules["escalate"]:
+        return invoice_data, rules, None
+
+    total_invoices = db.query(func.count(Invoice.id)).scalar()
+    context = (f"Histórico de {total_invoices} facturas procesadas. "
+               f"Dudas detectadas por las reglas: {'; '.join(rules['reasons'])}")
+    return invoice_data, rules, context
+
+@app.post("/workflow/validar-factura/bulk")
+@offload("db")
+def workflow_validate_all(only_issues: bool = True, db: Session = Depends(get_db)):
+    """Workflow: Validar todas las facturas con el motor de reglas (sin LLM)"""
+    return {"status": "success", **validate_all(db, only_issues=only_issues)}
 
 @app.post("/workflow/kpis-direccion")
-async def workflow_kpis_direccion(request: WorkflowRequest = None, db: Session = Depends(get_db)):
+@offload("llm")
+def workflow_kpis_direccion(request: WorkflowRequest = None, db: Session = Depends(get_db)):
     """Workflow: Generar KPIs para dirección"""
     # Use invoices from request if provided, otherwise from DB
     if request and request.invoices:
         invoices_data = request.invoices
     else:
-        invoices = db.query(Invoice).all()
-        invoices_data = [
-            {
-                "id": inv.id,
-                "vendor": inv.vendor_name,
-                "category": inv.category,
-                "total": inv.total_amount,
-                "consumption": inv.consumption,
-                "unit": inv.consumption_unit,
-                "date": str(inv.date)
-            }
-            for inv in invoices
-        ]
+        # Agregados por proveedor, categoría y mes (O(grupos) en vez de O(facturas))
+        invoices_data = rollup_rows(db)
     
     result = generate_kpis_direccion(invoices_data, db=db)
     # Parse JSON result if it's a string
@@ -569,7 +436,8 @@ async def workflow_kpis_direccion(request: WorkflowRequest = None, db: Session =
     return result if isinstance(result, dict) else {"status": "success", "result": result}
 
 @app.post("/workflow/kpis-reclamacion")
-async def workflow_kpis_reclamacion(request: WorkflowRequest, db: Session = Depends(get_db)):
+@offload("llm")
+def workflow_kpis_reclamacion(request: WorkflowRequest, db: Session = Depends(get_db)):
     """Workflow: Preparar base técnica para reclamación"""
     # Handle different input formats
     if request.invoice_data:
@@ -617,7 +485,8 @@ async def workflow_kpis_reclamacion(request: WorkflowRequest, db: Session = Depe
     return result if isinstance(result, dict) else {"status": "success", "result": result}
 
 @app.post("/workflow/comparar-proveedor")
-async def workflow_compare_supplier(request: WorkflowRequest, db: Session = Depends(get_db)):
+@offload("llm")
+def workflow_compare_supplier(request: WorkflowRequest, db: Session = Depends(get_db)):
     """Workflow: Comparar proveedores"""
     # Handle different input formats
     if request.current_invoice:
@@ -636,11 +505,11 @@ async def workflow_compare_supplier(request: WorkflowRequest, db: Session = Depe
             "category": invoice.category
         }
         
-        # Get historical invoices from same vendor
-        historical = db.query(Invoice).filter(
+        # Recent history of the same vendor (the full distribution goes in the benchmark)
+        historical = db.query(Invoice.total_amount, Invoice.consumption, Invoice.date).filter(
             Invoice.vendor_name == invoice.vendor_name,
             Invoice.id != invoice.id
-        ).all()
+        ).order_by(Invoice.date.desc()).limit(COMPARE_HISTORY_LIMIT).all()
         
         historical_invoices = [
             {
@@ -652,8 +521,21 @@ async def workflow_compare_supplier(request: WorkflowRequest, db: Session = Depe
         ]
     else:
         return {"status": "error", "message": "invoice_id o current_invoice requerido"}
-    
-    result = compare_supplier(current_invoice, historical_invoices, db=db)
+
+    # Cross-vendor cost-per-unit benchmark (cached, no LLM calls)
+    comparison = compare_invoice(
+        db, vendor=current_invoice.get("vendor") or current_invoice.get("vendor_name"),
+        category=current_invoice.get("category"),
+        unit=current_invoice.get("unit") or current_invoice.get("consumption_unit"),
+        total=current_invoice.get("total") or current_invoice.get("total_amount"),
+        consumption=current_invoice.get("consumption")
+    )
+    current_invoice = {**current_invoice, **{k: v for k, v in comparison["current"].items() if k != "vendor"}}
+
+    result = compare_supplier(
+        current_invoice, historical_invoices, alternative_supplier=comparison["best_alternative"],
+        benchmark=comparison["table"], db=db
+    )
     # Parse JSON result if it's a string
     if isinstance(result, str):
         try:
@@ -663,22 +545,15 @@ async def workflow_compare_supplier(request: WorkflowRequest, db: Session = Depe
     return result if isinstance(result, dict) else {"status": "success", "result": result}
 
 @app.post("/workflow/resumen-reunion")
-async def workflow_meeting_summary(request: WorkflowRequest = None, db: Session = Depends(get_db)):
+@offload("llm")
+def workflow_meeting_summary(request: WorkflowRequest = None, db: Session = Depends(get_db)):
     """Workflow: Generar resumen para reunión ejecutiva"""
     # Use invoices from request if provided, otherwise from DB
     if request and request.invoices is not None:
         invoices_data = request.invoices
     else:
-        invoices = db.query(Invoice).all()
-        invoices_data = [
-            {
-                "vendor": inv.vendor_name,
-                "category": inv.category,
-                "total": inv.total_amount,
-                "date": str(inv.date)
-            }
-            for inv in invoices
-        ]
+        # Agregados por proveedor, categoría y mes (O(grupos) en vez de O(facturas))
+        invoices_data = rollup_rows(db)
     
     result = generate_meeting_summary(invoices_data, db=db)
     # Parse JSON result if it's a string
@@ -690,7 +565,8 @@ async def workflow_meeting_summary(request: WorkflowRequest = None, db: Session
     return result if isinstance(result, dict) else {"status": "success", "result": result}
 
 @app.post("/workflow/alertas")
-async def workflow_check_alerts(request: WorkflowRequest, db: Session = Depends(get_db)):
+@offload("llm")
+def workflow_check_alerts(request: WorkflowRequest, db: Session = Depends(get_db)):
     """Workflow: Detectar alertas y anomalías"""
     # Handle different input formats
     if request.invoices:
@@ -709,25 +585,12 @@ async def workflow_check_alerts(request: WorkflowRequest, db: Session = Depends(
             "category": invoice.category
         }
         
-        # Calculate historical average
-        historical = db.query(Invoice).filter(
-            Invoice.category == invoice.category,
-            Invoice.id != invoice.id
-        ).all()
-        
-        if historical:
-            avg_consumption = sum(h.consumption or 0 for h in historical) / len(historical)
-            avg_total = sum(h.total_amount for h in historical) / len(historical)
-            historical_avg = {
-                "avg_consumption": avg_consumption,
-                "avg_total": avg_total
-            }
-        else:
-            historical_avg = None
+        # Historical average of the category (SQL AVG, without loading the history)
+        historical_avg = historical_averages(db, invoice)
     else:
         return {"status": "error", "message": "invoice_id o invoices requerido"}
     
-    result = check_alerts(invoice_data, historical_avg, db=db)
+    result = check_alerts(invoice_data, historical_avg, thresholds=request.thresholds, db=db)
     # Parse JSON result if it's a string
     if isinstance(result, str):
         try:
@@ -736,9 +599,30 @@ async def workflow_check_alerts(request: WorkflowRequest, db: Session = Depends(
             pass
     return result if isinstance(result, dict) else {"status": "success", "result": result}
 
+@app.post("/workflow/alertas/scan")
+@offload("llm")
+def workflow_scan_alerts(request: AlertScanRequest = None, db: Session = Depends(get_db)):
+    """Workflow: Escaneo masivo de anomalías (NumPy) y narrativa del LLM solo para las marcadas"""
+    request = request or AlertScanRequest()
+    scan = scan_anomalies(
+        db, thresholds=request.thresholds, vendor=request.vendor, category=request.category,
+        date_from=request.date_from, date_to=request.date_to
+    )
+    print(f"🔔 ALERT SCAN: {scan['flagged']}/{scan['scanned']} facturas marcadas")
+
+    if request.narrate:
+        llm_thresholds = {k: scan["thresholds"][k] for k in ("consumption_increase_pct", "price_deviation_pct")}
+        for alert in scan["alerts"][:max(0, request.max_narratives)]:
+            historical_avg = {"avg_total": alert["vendor_avg_total"], "avg_price_per_unit": alert["vendor_avg_price"]}
+            invoice_data = {k: alert[k] for k in ("invoice_id", "vendor", "category", "date", "total",
+                                                  "consumption", "unit", "price_per_unit", "reasons")}
+            alert["narrative"] = check_alerts(invoice_data, historical_avg, thresholds=llm_thresholds, db=db)
+    return {"status": "success", **scan}
+
 # Endpoints para gestionar patrones de proveedores (ahora en DB)
 @app.get("/admin/patterns")
-async def get_patterns(db: Session = Depends(get_db)):
+@offload("db")
+def get_patterns(db: Session = Depends(get_db)):
     """Obtiene la configuración actual de los proveedores desde la DB"""
     try:
         providers = db.query(Provider).all()
@@ -755,7 +639,8 @@ async def get_patterns(db: Session = Depends(get_db)):
         return {"status": "error", "message": str(e)}
 
 @app.post("/admin/patterns")
-async def save_patterns(payload: dict, db: Session = Depends(get_db)):
+@offload("db")
+def save_patterns(payload: dict, db: Session = Depends(get_db)):
     """Guarda la configuración de proveedores en la DB"""
     try:
         # Por simplicidad, truncamos y recreamos (o actualizamos si prefieres)
@@ -776,15 +661,42 @@ async def save_patterns(payload: dict, db: Session = Depends(get_db)):
         return {"status": "error", "message": str(e)}
 
 @app.get("/admin/logs")
-async def get_extraction_logs(db: Session = Depends(get_db)):
-    """Obtiene los últimos registros de extracción para depuración"""
-    logs = db.query(ExtractionLog).order_by(ExtractionLog.timestamp.desc()).limit(10).all()
-    return {"status": "success", "logs": logs}
+@offload("db")
+def get_extraction_logs(limit: int = LOG_PAGE_SIZE, after: Optional[str] = None, db: Session = Depends(get_db)):
+    """Resúmenes de los registros de extracción, más recientes primero (paginados con `after`)"""
+    try:
+        logs, next_cursor = list_logs(db, limit=limit, after=after)
+    except ReportQueryError as e:
+        return JSONResponse(status_code=400, content={"status": "error", "message": str(e)})
+    return {"status": "success", "logs": logs, "next_cursor": next_cursor}
+
+@app.get("/admin/logs/{log_id}")
+@offload("db")
+def get_extraction_log(log_id: int, db: Session = Depends(get_db)):
+    """Detalle de un registro: puntuaciones, JSON final y texto extraído"""
+    detail = log_detail(db, log_id)
+    if detail is None:
+        return {"status": "error", "message": "Registro no encontrado"}
+    return {"status": "success", "log": detail}
+
+@app.post("/admin/logs/purge")
+@offload("db")
+def purge_extraction_logs(db: Session = Depends(get_db)):
+    """Aplica la retención (antigüedad y nº máximo) y compacta las puntuaciones"""
+    deleted = purge_logs(db)
+    compacted = compact_logs(db)
+    return {"status": "success", "deleted": deleted, "compacted": compacted}
+
+@app.get("/admin/extraction-stats")
+async def get_extraction_stats():
+    """Contadores de extracción (llamadas al LLM, respuestas reparadas y fallidas) y estado de los pools"""
+    return {"status": "success", "stats": EXTRACTION_STATS, "pools": pool_stats()}
 
 # ============== SETTINGS ENDPOINTS ==============
 
 @app.get("/api/settings")
-async def get_settings(db: Session = Depends(get_db)):
+@offload("db")
+def get_settings(db: Session = Depends(get_db)):
     """Obtiene la configuración de IA de la base de datos"""
     settings = db.query(SystemSetting).all()
     result = {s.key: s.value for s in settings}
@@ -800,7 +712,8 @@ async def get_settings(db: Session = Depends(get_db)):
     return {"status": "success", "settings": result}
 
 @app.post("/api/settings")
-async def save_settings(payload: dict, db: Session = Depends(get_db)):
+@offload("db")
+def save_settings(payload: dict, db: Session = Depends(get_db)):
     """Guarda la configuración de IA en la base de datos"""
     try:
         for key, value in payload.items():
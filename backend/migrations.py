@@ -0,0 +1,178 @@
+"""
+Migraciones de esquema versionadas para bases de datos existentes.
+
+`create_all` solo crea tablas que no existen; no añade índices ni columnas a
+tablas ya creadas. Cada migración tiene un número de versión y se registra
+en `schema_migrations` al aplicarse, así `init_db` puede ejecutarlas en cada
+arranque y solo se aplican las pendientes.
+
+La API y cada réplica del worker llaman a `init_db` al arrancar: en
+PostgreSQL todo el proceso (create_all, migraciones) se serializa con un
+advisory lock (`schema_lock`), así los procesos que llegan después esperan
+y encuentran el esquema ya al día.
+
+Para añadir una migración: nueva función y entrada al final de MIGRATIONS.
+Los índices se declaran también en el modelo (__table_args__) para que las
+bases de datos nuevas los tengan desde `create_all`.
+"""
+import logging
+from contextlib import contextmanager
+
+from sqlalchemy import text, inspect
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS_TABLE = "schema_migrations"
+SCHEMA_LOCK_ID = 7_301_991  # Clave del advisory lock de init_db (PostgreSQL)
+
+# (nombre, tabla, columnas): rutas de acceso de las consultas más frecuentes
+INVOICE_INDEXES = [
+    # Duplicados en /upload (nº) y en validar-factura (nº + proveedor)
+    ("ix_invoices_number_vendor", "invoices", ("invoice_number", "vendor_name")),
+    # Histórico de un proveedor ordenado por fecha (comparar-proveedor, rollups, anomalías)
+    ("ix_invoices_vendor_date", "invoices", ("vendor_name", "date")),
+    # Histórico de una categoría (alertas, reclamación, enrutador del chat)
+    ("ix_invoices_category_date", "invoices", ("category", "date")),
+    # Filtros y orden por fecha (/reports, /export, /advanced-stats)
+    ("ix_invoices_date", "invoices", ("date",)),
+    # Duplicado por nombre de fichero en /upload
+    ("ix_invoices_file_path", "invoices", ("file_path",)),
+]
+
+
+def _create_indexes(connection, indexes):
+    concurrently = "CONCURRENTLY " if connection.dialect.name == "postgresql" else ""
+    for name, table, columns in indexes:
+        connection.execute(text(
+            f"CREATE INDEX {concurrently}IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+        ))
+
+
+def m001_invoice_indexes(connection):
+    _create_indexes(connection, INVOICE_INDEXES)
+
+
+def m002_documents(connection):
+    """raw_text de invoices y extraction_logs pasa a documents (comprimido y por hash)"""
+    from .database import Document
+    from .documents import migrate_legacy_text
+
+    Document.__table__.create(connection, checkfirst=True)
+    tables = set(inspect(connection).get_table_names())
+    for table in ("invoices", "extraction_logs"):
+        if table in tables:
+            migrate_legacy_text(connection, table)
+            connection.execute(text(
+                f"CREATE INDEX IF NOT EXISTS ix_{table}_document_hash ON {table} (document_hash)"
+            ))
+
+
+def m003_extraction_log_timestamp(connection):
+    if "extraction_logs" in inspect(connection).get_table_names():
+        _create_indexes(connection, [("ix_extraction_logs_timestamp", "extraction_logs", ("timestamp",))])
+
+
+def m004_invoice_enrichment(connection):
+    """Columnas de la ingesta en dos fases; las facturas existentes ya pasaron por el LLM"""
+    if "invoices" not in inspect(connection).get_table_names():
+        return
+    columns = {c["name"] for c in inspect(connection).get_columns("invoices")}
+    for name, ddl in (("period", "VARCHAR"), ("taxes", "FLOAT"), ("enrichment_status", "VARCHAR")):
+        if name not in columns:
+            connection.execute(text(f"ALTER TABLE invoices ADD COLUMN {name} {ddl}"))
+    connection.execute(text("UPDATE invoices SET enrichment_status = 'done' WHERE enrichment_status IS NULL"))
+
+
+def m005_enrichment_status_index(connection):
+    if "invoices" in inspect(connection).get_table_names():
+        _create_indexes(connection, [("ix_invoices_enrichment_status", "invoices", ("enrichment_status",))])
+
+
+def m006_invoice_updated_at(connection):
+    if "invoices" not in inspect(connection).get_table_names():
+        return
+    if "updated_at" not in {c["name"] for c in inspect(connection).get_columns("invoices")}:
+        ddl = "TIMESTAMP" if connection.dialect.name == "postgresql" else "DATETIME"
+        connection.execute(text(f"ALTER TABLE invoices ADD COLUMN updated_at {ddl}"))
+
+
+def m007_enrichment_claimed_at(connection):
+    if "invoices" not in inspect(connection).get_table_names():
+        return
+    if "enrichment_claimed_at" not in {c["name"] for c in inspect(connection).get_columns("invoices")}:
+        ddl = "TIMESTAMP" if connection.dialect.name == "postgresql" else "DATETIME"
+        connection.execute(text(f"ALTER TABLE invoices ADD COLUMN enrichment_claimed_at {ddl}"))
+
+
+# (versión, descripción, función, transaccional). Las no transaccionales se
+# ejecutan en autocommit (p. ej. CREATE INDEX CONCURRENTLY en PostgreSQL, que
+# no bloquea las escrituras mientras se construye el índice).
+MIGRATIONS = [
+    (1, "Índices compuestos de invoices para las consultas frecuentes", m001_invoice_indexes, False),
+    (2, "Texto de los documentos comprimido en la tabla documents", m002_documents, True),
+    (3, "Índice por fecha de extraction_logs para la retención", m003_extraction_log_timestamp, False),
+    (4, "Columnas period, taxes y enrichment_status de invoices", m004_invoice_enrichment, True),
+    (5, "Índice por enrichment_status de invoices", m005_enrichment_status_index, False),
+    (6, "Columna updated_at de invoices", m006_invoice_updated_at, True),
+    (7, "Columna enrichment_claimed_at de invoices", m007_enrichment_claimed_at, True),
+]
+
+
+@contextmanager
+def schema_lock(engine):
+    """Un solo proceso a la vez crea tablas y aplica migraciones (sin efecto fuera de PostgreSQL)"""
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    # Conexión propia en autocommit: sin transacción abierta que bloquee CREATE INDEX CONCURRENTLY
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_ID})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_ID})
+
+
+def _ensure_table(engine):
+    with engine.begin() as conn:
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} ("
+            "version INTEGER PRIMARY KEY, description VARCHAR, "
+            "applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+        ))
+
+
+def applied_versions(engine) -> set:
+    if not inspect(engine).has_table(MIGRATIONS_TABLE):
+        return set()
+    with engine.connect() as conn:
+        return {row[0] for row in conn.execute(text(f"SELECT version FROM {MIGRATIONS_TABLE}"))}
+
+
+def run_migrations(engine, migrations: list = None) -> list:
+    """Aplica las migraciones pendientes en orden. Devuelve las versiones aplicadas."""
+    migrations = MIGRATIONS if migrations is None else migrations
+    _ensure_table(engine)
+    done = applied_versions(engine)
+    applied = []
+    for version, description, step, transactional in sorted(migrations, key=lambda m: m[0]):
+        if version in done:
+            continue
+        logger.info(f"🛠️ Migración {version}: {description}")
+        if transactional:
+            with engine.begin() as conn:
+                step(conn)
+                _record(conn, version, description)
+        else:
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                step(conn)
+            with engine.begin() as conn:
+                _record(conn, version, description)
+        applied.append(version)
+    return applied
+
+
+def _record(connection, version: int, description: str):
+    connection.execute(text(
+        f"INSERT INTO {MIGRATIONS_TABLE} (version, description) VALUES (:version, :description)"
+    ), {"version": version, "description": description})
@@ -0,0 +1,253 @@
+"""
+Enrutador de preguntas del chat: responde agregados con SQL sin llamar al LLM.
+
+Reconoce intención de proveedor, categoría, periodo y métrica en preguntas
+como "¿cuánto gastamos en luz en diciembre?" o "total Som Energia 2024",
+calcula la cifra con agregados en la base de datos y:
+- la devuelve directamente si la pregunta es un agregado puro, o
+- la entrega al LLM como cifra ya calculada si la pregunta pide análisis o
+  un dato de una factura concreta (nº, última, IVA, precio por kWh...) que
+  los agregados no responden.
+"""
+import re
+import unicodedata
+from datetime import date
+
+from sqlalchemy import func, extract
+from sqlalchemy.orm import Session
+
+from .database import Invoice
+
+MONTHS = {
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6, "julio": 7,
+    "agosto": 8, "septiembre": 9, "setiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12
+}
+MONTH_NAMES = {v: k for k, v in MONTHS.items() if k != "setiembre"}
+
+# Sinónimos en castellano → categoría almacenada
+CATEGORY_SYNONYMS = {
+    "Electricity": ["luz", "electricidad", "electrica", "electrico", "electricity"],
+    "Gas": ["gas", "butano"],
+    "Water": ["agua", "water"],
+    "Telecom": ["telefono", "telefonia", "movil", "internet", "fibra", "telecom"],
+}
+
+# Métricas: (clave, patrones)
+METRICS = [
+    ("count", [r"\bcuant[ao]s facturas\b", r"\bnumero de facturas\b", r"\bcuant[ao]s\b.*\bfacturas\b"]),
+    ("avg", [r"\bmedi[ao]\b", r"\bpromedio\b"]),
+    ("max", [r"\bmaxim[ao]\b", r"\bmayor\b", r"\bmas car[ao]\b"]),
+    ("min", [r"\bminim[ao]\b", r"\bmenor\b", r"\bmas barat[ao]\b"]),
+    ("consumption", [r"\bconsum", r"\bkwh\b", r"\bm3\b"]),
+    ("sum", [r"\bcuanto\b", r"\bgast", r"\btotal\b", r"\bimporte\b", r"\bpagad", r"\bcoste\b", r"\bcosto\b"]),
+]
+
+# Señales de que la pregunta pide algo más que una cifra (→ LLM con cifras calculadas)
+ANALYSIS_CUES = [
+    r"\bpor que\b", r"\bexplica", r"\bcompar", r"\brecomiend", r"\banaliz", r"\bdeberiamos\b",
+    r"\bnumero de factura\b", r"\bpotencia\b", r"\blectura\b", r"\bfecha\b", r"\bperiodo\b",
+    r"\bahorr", r"\breclam", r"\btendencia\b", r"\bevolucion\b", r"\b(que|cual) proveedor\b"
+]
+
+# Preguntas sobre una factura concreta o un dato que no es un agregado (→ LLM con cifras calculadas)
+SPECIFIC_CUES = [
+    r"\b[a-z]+[-/]?\d{3,}[a-z0-9/-]*\b",  # Nº de factura (FE023456, SE-2025-001)
+    r"\bid\b", r"\b(la|esa|esta) factura\b", r"\bultim[ao]s?\b", r"\bprimer[ao]?\b",
+    r"\biva\b", r"\bimpuestos?\b", r"\bpotencia\b",
+    r"\bpor (kwh|m3|kw|unidad|litro|gb)\b", r"\bprecio\b", r"\btarifa\b",
+]
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
+
+
+def detect_metric(q: str):
+    for metric, patterns in METRICS:
+        if any(re.search(p, q) for p in patterns):
+            return metric
+    return None
+
+
+def detect_category(q: str):
+    for category, words in CATEGORY_SYNONYMS.items():
+        if any(re.search(rf"\b{w}\b", q) for w in words):
+            return category
+    return None
+
+
+def detect_vendor(q: str, db: Session):
+    """Proveedor cuyo nombre completo (o una palabra significativa) aparece en la pregunta"""
+    vendors = [v for (v,) in db.query(Invoice.vendor_name).distinct() if v and v != "unknown"]
+    best = None
+    best_hits = 0
+    for vendor in vendors:
+        name = normalize(vendor).replace(",", "")
+        if re.search(rf"\b{re.escape(name)}\b", q):
+            return vendor
+        hits = sum(1 for w in name.split() if len(w) > 2 and re.search(rf"\b{re.escape(w)}\b", q))
+        if hits > best_hits:
+            best, best_hits = vendor, hits
+    return best
+
+
+def detect_period(q: str, db: Session, today: date = None):
+    """Devuelve (inicio, fin, etiqueta) o None. Fin es exclusivo."""
+    today = today or date.today()
+
+    iso = re.search(r"\b(20\d{2})-(\d{2})\b", q)
+    if iso:
+        year, month = int(iso.group(1)), int(iso.group(2))
+        return _month_range(year, month)
+
+    year_match = re.search(r"\b(20\d{2})\b", q)
+    year = int(year_match.group(1)) if year_match else None
+
+    if "este mes" in q:
+        return _month_range(today.year, today.month)
+    if "mes pasado" in q:
+        month = today.month - 1 or 12
+        return _month_range(today.year - (today.month == 1), month)
+    if "este ano" in q:
+        year = today.year
+    elif "ano pasado" in q:
+        year = today.year - 1
+
+    month = next((num for name, num in MONTHS.items() if re.search(rf"\b{name}\b", q)), None)
+    if month:
+        if year is None:
+            # Mes sin año: el último año con facturas en ese mes
+            latest = db.query(func.max(Invoice.date)).filter(extract("month", Invoice.date) == month).scalar()
+            year = latest.year if latest else today.year
+        return _month_range(year, month)
+    if year:
+        return date(year, 1, 1), date(year + 1, 1, 1), str(year)
+    return None
+
+
+def _month_range(year: int, month: int):
+    end = date(year + (month == 12), month % 12 + 1, 1)
+    return date(year, month, 1), end, f"{MONTH_NAMES[month]} {year}"
+
+
+def parse_intent(query: str, db: Session, today: date = None) -> dict:
+    q = normalize(query)
+    return {
+        "metric": detect_metric(q),
+        "vendor": detect_vendor(q, db),
+        "category": detect_category(q),
+        "period": detect_period(q, db, today),
+        "analysis": any(re.search(p, q) for p in ANALYSIS_CUES),
+        "specific": any(re.search(p, q) for p in SPECIFIC_CUES),
+    }
+
+
+def intent_filters(intent: dict) -> list:
+    """Condiciones SQL para el proveedor, la categoría y el periodo detectados (vacía si no hay ninguno)"""
+    filters = []
+    if intent["vendor"]:
+        filters.append(Invoice.vendor_name == intent["vendor"])
+    if intent["category"]:
+        filters.append(Invoice.category == intent["category"])
+    if intent["period"]:
+        start, end, _ = intent["period"]
+        filters.append(Invoice.date >= start)
+        filters.append(Invoice.date < end)
+    return filters
+
+
+def compute_figures(db: Session, intent: dict) -> dict:
+    """Agregados en SQL para los filtros detectados"""
+    filters = intent_filters(intent)
+
+    count, total, avg, max_amount, min_amount = db.query(
+        func.count(Invoice.id), func.sum(Invoice.total_amount), func.avg(Invoice.total_amount),
+        func.max(Invoice.total_amount), func.min(Invoice.total_amount)
+    ).filter(*filters).one()
+
+    consumption = db.query(Invoice.consumption_unit, func.sum(Invoice.consumption)).filter(
+        *filters, Invoice.consumption > 0
+    ).group_by(Invoice.consumption_unit).all()
+
+    return {
+        "count": count or 0,
+        "sum": round(total or 0.0, 2),
+        "avg": round(avg or 0.0, 2),
+        "max": round(max_amount or 0.0, 2),
+        "min": round(min_amount or 0.0, 2),
+        "consumption": {unit or "": round(value or 0.0, 2) for unit, value in consumption}
+    }
+
+
+def _fmt(value: float) -> str:
+    """Formato numérico español: 1.234,56"""
+    return f"{value:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+
+
+def describe_scope(intent: dict) -> str:
+    parts = []
+    if intent["category"]:
+        parts.append(f"en {intent['category']}")
+    if intent["vendor"]:
+        parts.append(f"de {intent['vendor']}")
+    if intent["period"]:
+        parts.append(f"en {intent['period'][2]}")
+    return " ".join(parts) if parts else "en todas las facturas"
+
+
+def format_answer(intent: dict, figures: dict) -> str:
+    scope = describe_scope(intent)
+    n = figures["count"]
+    if n == 0:
+        return f"No hay facturas registradas {scope}."
+    metric = intent["metric"]
+    suffix = f" ({n} factura{'s' if n != 1 else ''})"
+    if metric == "count":
+        return f"Hay {n} factura{'s' if n != 1 else ''} {scope}."
+    if metric == "avg":
+        return f"Importe medio {scope}: {_fmt(figures['avg'])} EUR{suffix}."
+    if metric == "max":
+        return f"Factura de mayor importe {scope}: {_fmt(figures['max'])} EUR{suffix}."
+    if metric == "min":
+        return f"Factura de menor importe {scope}: {_fmt(figures['min'])} EUR{suffix}."
+    if metric == "consumption":
+        if not figures["consumption"]:
+            return f"No hay consumos registrados {scope}{suffix}."
+        parts = ", ".join(f"{_fmt(v)} {u}".strip() for u, v in figures["consumption"].items())
+        return f"Consumo total {scope}: {parts}{suffix}."
+    return f"Gasto total {scope}: {_fmt(figures['sum'])} EUR{suffix}."
+
+
+def route_query(db: Session, query: str, today: date = None):
+    """Clasifica la pregunta. Devuelve None si no es un agregado.
+
+    Si lo es, devuelve {"intent", "figures", "answer", "direct"}; direct=False
+    indica que la cifra debe pasarse al LLM como contexto ya calculado (solo
+    se responde sin LLM cuando toda la pregunta es un agregado soportado).
+    """
+    intent = parse_intent(query, db, today)
+    if intent["metric"] is None:
+        return None
+    figures = compute_figures(db, intent)
+    return {
+        "intent": {**intent, "period": intent["period"][2] if intent["period"] else None},
+        "scope": describe_scope(intent),
+        "figures": figures,
+        "answer": format_answer(intent, figures),
+        "direct": not (intent["analysis"] or intent["specific"])
+    }
+
+
+def figures_context(routed: dict) -> str:
+    """Bloque de contexto con cifras exactas para el LLM"""
+    f = routed["figures"]
+    consumption = ", ".join(f"{_fmt(v)} {u}".strip() for u, v in f["consumption"].items()) or "sin datos"
+    return (
+        "CIFRAS CALCULADAS EN BASE DE DATOS (exactas, úsalas sin recalcular):\n"
+        f"  Ámbito: {routed['scope']}\n"
+        f"  Nº facturas: {f['count']}\n"
+        f"  Gasto total: {_fmt(f['sum'])} EUR | Medio: {_fmt(f['avg'])} EUR | "
+        f"Máx: {_fmt(f['max'])} EUR | Mín: {_fmt(f['min'])} EUR\n"
+        f"  Consumo: {consumption}\n\n"
+    )
@@ -0,0 +1,151 @@
+"""
+Listado de facturas para /reports (y exportaciones): filtros, proyección de
+campos, orden y paginación por cursor (keyset), serializado en streaming.
+
+El cursor es opaco (base64 de [valor de orden, id]) y la página siguiente se
+pide con `after=<cursor>`, así el coste no crece con la profundidad de la
+paginación como ocurre con OFFSET.
+"""
+import base64
+import json
+from datetime import date, datetime
+
+from sqlalchemy import func, literal, or_, and_, Date, Float, String
+from sqlalchemy.orm import Session
+
+from .database import Invoice
+
+# Campos disponibles; raw_text (en documents) solo se devuelve si se pide explícitamente
+REPORT_FIELDS = [c.name for c in Invoice.__table__.columns if c.name != "document_hash"] + ["raw_text"]
+DEFAULT_FIELDS = [f for f in REPORT_FIELDS if f != "raw_text"]
+
+# Columnas ordenables y valor con el que se sustituyen los NULL para el cursor
+SORT_COLUMNS = {
+    "id": None,
+    "date": date(1, 1, 1),
+    "total_amount": -1e18,
+    "vendor_name": "",
+    "invoice_number": "",
+    "category": "",
+}
+MAX_PAGE_SIZE = 1000
+
+
+class ReportQueryError(ValueError):
+    """Parámetros de listado no válidos (campo, orden o cursor)"""
+
+
+def parse_fields(fields: str = None, include_raw_text: bool = False) -> list:
+    if fields:
+        requested = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in requested if f not in REPORT_FIELDS]
+        if unknown:
+            raise ReportQueryError(f"Campos desconocidos: {', '.join(unknown)}")
+        # El id siempre se incluye (lo usa el cursor y el frontend)
+        selected = ["id"] + [f for f in requested if f != "id"]
+    else:
+        selected = list(DEFAULT_FIELDS)
+    if include_raw_text and "raw_text" not in selected:
+        selected.append("raw_text")
+    return list(dict.fromkeys(selected))
+
+
+def apply_filters(query, vendor: str = None, category: str = None,
+                  date_from: date = None, date_to: date = None):
+    """Filtros comunes de listados y exportaciones (date_to inclusivo)"""
+    if vendor:
+        query = query.filter(Invoice.vendor_name.ilike(f"%{vendor}%"))
+    if category:
+        query = query.filter(Invoice.category == category)
+    if date_from:
+        query = query.filter(Invoice.date >= date_from)
+    if date_to:
+        query = query.filter(Invoice.date <= date_to)
+    return query
+
+
+def _sort_key(column_name: str):
+    column = getattr(Invoice, column_name)
+    sentinel = SORT_COLUMNS[column_name]
+    if sentinel is None:
+        return column
+    sql_type = Date() if isinstance(sentinel, date) else Float() if isinstance(sentinel, float) else String()
+    return func.coalesce(column, literal(sentinel, sql_type))
+
+
+def parse_sort(sort: str = "id"):
+    """'campo' o '-campo' → (nombre, descendente)"""
+    descending = sort.startswith("-")
+    name = sort.lstrip("-+")
+    if name not in SORT_COLUMNS:
+        raise ReportQueryError(f"No se puede ordenar por '{name}'. Opciones: {', '.join(SORT_COLUMNS)}")
+    return name, descending
+
+
+def encode_cursor(sort_value, invoice_id: int) -> str:
+    if isinstance(sort_value, (date, datetime)):
+        sort_value = sort_value.isoformat()
+    raw = json.dumps([sort_value, invoice_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort_name: str):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort_value, invoice_id = json.loads(base64.urlsafe_b64decode(padded))
+        if isinstance(SORT_COLUMNS[sort_name], date):
+            sort_value = date.fromisoformat(sort_value[:10])
+        return sort_value, int(invoice_id)
+    except (ValueError, TypeError) as e:
+        raise ReportQueryError("Cursor no válido") from e
+
+
+def build_report_query(db: Session, fields: list, sort: str = "id", after: str = None, **filters):
+    """Consulta proyectada (solo columnas pedidas), filtrada, ordenada y posicionada tras el cursor"""
+    sort_name, descending = parse_sort(sort)
+    key = _sort_key(sort_name)
+    columns = [getattr(Invoice, f) for f in fields]
+    query = apply_filters(db.query(*columns, key.label("_sort")), **filters)
+
+    if after:
+        value, last_id = decode_cursor(after, sort_name)
+        if sort_name == "id":
+            query = query.filter(Invoice.id < last_id if descending else Invoice.id > last_id)
+        elif descending:
+            query = query.filter(or_(key < value, and_(key == value, Invoice.id < last_id)))
+        else:
+            query = query.filter(or_(key > value, and_(key == value, Invoice.id > last_id)))
+
+    if sort_name == "id":
+        return query.order_by(Invoice.id.desc() if descending else Invoice.id)
+    if descending:
+        return query.order_by(key.desc(), Invoice.id.desc())
+    return query.order_by(key, Invoice.id)
+
+
+def count_reports(db: Session, **filters) -> int:
+    return apply_filters(db.query(func.count(Invoice.id)), **filters).scalar() or 0
+
+
+def row_to_dict(row, fields: list) -> dict:
+    return {f: getattr(row, f) for f in fields}
+
+
+def _json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Tipo no serializable: {type(value).__name__}")
+
+
+def stream_json_array(rows, fields: list, close=None):
+    """Genera un array JSON fila a fila sin materializar la lista completa"""
+    try:
+        yield "["
+        first = True
+        for row in rows:
+            yield ("" if first else ",") + json.dumps(row_to_dict(row, fields), default=_json_default, ensure_ascii=False)
+            first = False
+        yield "]"
+    finally:
+        if close:
+            close()
@@ -0,0 +1,243 @@
+"""
+Recuperación BM25 de fragmentos del texto original de las facturas.
+
+En la ingesta el raw_text se divide en fragmentos por líneas y se guardan
+sus estadísticas de términos como arrays empaquetados (hash crc32 del
+término + frecuencia). Las consultas puntúan con BM25 sobre un índice
+invertido en memoria que se carga desde esas filas y se actualiza de forma
+incremental cuando aparecen fragmentos nuevos.
+"""
+import heapq
+import logging
+import math
+import os
+import re
+import threading
+import unicodedata
+import zlib
+from array import array
+from collections import Counter
+
+from sqlalchemy import event, func, inspect, insert, delete
+from sqlalchemy.orm import Session
+
+from .database import Invoice, InvoiceChunk
+
+logger = logging.getLogger(__name__)
+
+CHUNK_CHARS = int(os.getenv("CHUNK_CHARS", "600"))
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Palabras vacías (sin tildes, igual que los tokens)
+STOPWORDS = {
+    "de", "del", "la", "las", "el", "los", "en", "y", "o", "a", "al", "un", "una", "que", "es", "por",
+    "para", "con", "se", "su", "sus", "mi", "me", "lo", "le", "hay", "este", "esta", "cual", "cuanto",
+    "cuanta", "cuantos", "cuantas", "como", "cuando", "donde", "hemos", "han", "ha", "fue", "son"
+}
+
+
+def tokenize(text: str) -> list:
+    """Tokens en minúsculas y sin tildes (≥ 2 caracteres, sin palabras vacías)"""
+    normalized = unicodedata.normalize("NFKD", text.lower())
+    normalized = "".join(c for c in normalized if not unicodedata.combining(c))
+    return [t for t in re.findall(r"\w+", normalized) if len(t) >= 2 and t not in STOPWORDS]
+
+
+def term_hash(term: str) -> int:
+    return zlib.crc32(term.encode("utf-8"))
+
+
+def split_chunks(raw_text: str, target_chars: int = CHUNK_CHARS) -> list:
+    """Divide el texto en fragmentos de líneas completas; devuelve [(start, end)]"""
+    spans = []
+    start = None
+    pos = 0
+    for line in raw_text.splitlines(keepends=True):
+        if start is None:
+            start = pos
+        pos += len(line)
+        if pos - start >= target_chars:
+            spans.append((start, pos))
+            start = None
+    if start is not None and raw_text[start:pos].strip():
+        spans.append((start, pos))
+    return spans
+
+
+def build_chunk_rows(invoice_id: int, raw_text: str) -> list:
+    """Filas de invoice_chunks para una factura (sin texto: solo offsets y términos)"""
+    rows = []
+    for position, (start, end) in enumerate(split_chunks(raw_text or "")):
+        counts = Counter(term_hash(t) for t in tokenize(raw_text[start:end]))
+        if not counts:
+            continue
+        hashes = array("I", counts.keys())
+        freqs = array("H", (min(c, 0xFFFF) for c in counts.values()))
+        rows.append({
+            "invoice_id": invoice_id,
+            "position": position,
+            "start": start,
+            "end": end,
+            "length": sum(counts.values()),
+            "term_hashes": hashes.tobytes(),
+            "term_freqs": freqs.tobytes()
+        })
+    return rows
+
+
+class BM25Index:
+    """Índice invertido en memoria sobre los fragmentos (arrays compactos)"""
+
+    def __init__(self):
+        self.chunk_ids = array("I")
+        self.invoice_ids = array("I")
+        self.lengths = array("I")
+        self.postings = {}  # hash -> (array de posiciones, array de frecuencias)
+        self.total_length = 0
+        self.max_chunk_id = 0
+
+    def __len__(self):
+        return len(self.chunk_ids)
+
+    def add(self, chunk_id: int, invoice_id: int, length: int, term_hashes: bytes, term_freqs: bytes):
+        doc = len(self.chunk_ids)
+        self.chunk_ids.append(chunk_id)
+        self.invoice_ids.append(invoice_id)
+        self.lengths.append(length)
+        self.total_length += length
+        self.max_chunk_id = max(self.max_chunk_id, chunk_id)
+        hashes = array("I")
+        hashes.frombytes(term_hashes)
+        freqs = array("H")
+        freqs.frombytes(term_freqs)
+        for h, tf in zip(hashes, freqs):
+            entry = self.postings.get(h)
+            if entry is None:
+                entry = self.postings[h] = (array("I"), array("H"))
+            entry[0].append(doc)
+            entry[1].append(tf)
+
+    def top_k(self, query: str, k: int = 8, invoice_ids: set = None) -> list:
+        """[(score, chunk_id, invoice_id)] de los k fragmentos más relevantes"""
+        n = len(self.chunk_ids)
+        if not n:
+            return []
+        avgdl = self.total_length / n
+        scores = {}
+        for h in {term_hash(t) for t in tokenize(query)}:
+            entry = self.postings.get(h)
+            if entry is None:
+                continue
+            docs, freqs = entry
+            idf = math.log((n - len(docs) + 0.5) / (len(docs) + 0.5) + 1)
+            for doc, tf in zip(docs, freqs):
+                if invoice_ids is not None and self.invoice_ids[doc] not in invoice_ids:
+                    continue
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc] / avgdl)
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(score, self.chunk_ids[doc], self.invoice_ids[doc]) for doc, score in best]
+
+
+_index = BM25Index()
+_index_signature = (0, 0, 0)
+_index_lock = threading.Lock()
+
+
+def get_index(db: Session) -> BM25Index:
+    """Devuelve el índice en memoria sincronizado con la tabla de fragmentos.
+
+    Si solo hay fragmentos nuevos se cargan de forma incremental; si hubo
+    borrados (el recuento no cuadra) se reconstruye completo.
+    """
+    global _index, _index_signature
+    count, max_id, total_length = db.query(
+        func.count(InvoiceChunk.id), func.max(InvoiceChunk.id), func.sum(InvoiceChunk.length)
+    ).one()
+    signature = (count or 0, max_id or 0, total_length or 0)
+    with _index_lock:
+        if signature == _index_signature:
+            return _index
+        columns = (InvoiceChunk.id, InvoiceChunk.invoice_id, InvoiceChunk.length,
+                   InvoiceChunk.term_hashes, InvoiceChunk.term_freqs)
+        new_rows = db.query(*columns).filter(InvoiceChunk.id > _index.max_chunk_id)
+        if len(_index) + new_rows.count() != signature[0] or _index_signature[1] > signature[1]:
+            _index = BM25Index()
+            new_rows = db.query(*columns)
+        for row in new_rows.order_by(InvoiceChunk.id).yield_per(1000):
+            _index.add(row.id, row.invoice_id, row.length, row.term_hashes, row.term_freqs)
+        _index_signature = signature
+        return _index
+
+
+def retrieve_passages(db: Session, query: str, k: int = 8, char_budget: int = 6000,
+                      invoice_ids: list = None) -> list:
+    """Top-k fragmentos (de todas las facturas o de las indicadas) que caben en char_budget"""
+    index = get_index(db)
+    hits = index.top_k(query, k=k, invoice_ids=set(invoice_ids) if invoice_ids is not None else None)
+    if not hits:
+        return []
+
+    chunk_rows = {
+        c.id: c for c in db.query(InvoiceChunk.id, InvoiceChunk.position, InvoiceChunk.start, InvoiceChunk.end)
+        .filter(InvoiceChunk.id.in_([chunk_id for _, chunk_id, _ in hits]))
+    }
+    texts = dict(db.query(Invoice.id, Invoice.raw_text).filter(
+        Invoice.id.in_({invoice_id for _, _, invoice_id in hits})
+    ))
+
+    passages = []
+    used = 0
+    for score, chunk_id, invoice_id in hits:
+        chunk = chunk_rows.get(chunk_id)
+        raw_text = texts.get(invoice_id)
+        if chunk is None or not raw_text:
+            continue
+        passage = raw_text[chunk.start:chunk.end].strip()
+        if used + len(passage) > char_budget:
+            continue
+        used += len(passage)
+        passages.append({
+            "invoice_id": invoice_id,
+            "chunk_id": chunk_id,
+            "position": chunk.position,
+            "score": round(score, 4),
+            "text": passage
+        })
+    return passages
+
+
+def rebuild_chunks(db: Session) -> int:
+    """Regenera los fragmentos de todas las facturas (para datos anteriores al índice)"""
+    db.execute(delete(InvoiceChunk))
+    count = 0
+    for row in db.query(Invoice.id, Invoice.raw_text).yield_per(200):
+        rows = build_chunk_rows(row.id, row.raw_text)
+        if rows:
+            db.execute(insert(InvoiceChunk), rows)
+        count += len(rows)
+    db.commit()
+    logger.info(f"🧩 Fragmentos BM25 regenerados: {count}")
+    return count
+
+
+# --- Mantenimiento automático en la ingesta ---
+
+@event.listens_for(Invoice, "after_insert")
+def _chunk_on_insert(mapper, connection, target):
+    rows = build_chunk_rows(target.id, target.raw_text)
+    if rows:
+        connection.execute(insert(InvoiceChunk.__table__), rows)
+
+
+@event.listens_for(Invoice, "after_update")
+def _rechunk_on_update(mapper, connection, target):
+    if inspect(target).attrs.document_hash.history.has_changes():  # cambió raw_text
+        _unchunk_on_delete(mapper, connection, target)
+        _chunk_on_insert(mapper, connection, target)
+
+
+@event.listens_for(Invoice, "after_delete")
+def _unchunk_on_delete(mapper, connection, target):
+    connection.execute(delete(InvoiceChunk.__table__).where(InvoiceChunk.invoice_id == target.id))
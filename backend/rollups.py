@@ -0,0 +1,274 @@
+"""
+Agregados de gasto y consumo por (proveedor, categoría, mes).
+
+La tabla spend_rollups se mantiene con eventos ORM dentro de la misma
+transacción que da de alta, modifica o borra la factura (upload, delete,
+watcher, tests...):
+- alta: suma incremental (upsert con contador + importe) del grupo;
+- borrado o cambio de campos agregados: se recalcula el grupo afectado
+  bajo bloqueo de su fila (SELECT ... FOR UPDATE en PostgreSQL).
+
+Consistencia ante escrituras concurrentes en el mismo grupo: el upsert de
+un alta y el recálculo se serializan en la fila del grupo. Si el alta llega
+antes, el recálculo espera a su commit y, en READ COMMITTED, ya cuenta la
+factura; si llega después, suma sobre el valor recalculado. SQLite serializa
+todas las escrituras. Queda sin cubrir el primer alta de un grupo que aún no
+tiene fila mientras otra transacción lo recalcula (no hay fila que
+bloquear); rebuild-rollups lo corrige.
+
+Los dashboards y workflows leen de aquí en O(grupos) en vez de O(facturas).
+Se reconstruye completa con `python -m backend.admin rebuild-rollups`.
+"""
+import logging
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import event, func, select, case, delete, insert, update, and_, inspect, extract
+from sqlalchemy.orm import Session
+
+from .database import Invoice, SpendRollup
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_FIELDS = ("vendor_name", "category", "date", "total_amount", "consumption", "consumption_unit")
+GROUP_COLUMNS = ("vendor_name", "category", "month")
+
+
+def month_key(value) -> str:
+    """YYYY-MM de una fecha ('' si no hay fecha)"""
+    if value is None:
+        return ""
+    if isinstance(value, (date, datetime)):
+        return f"{value:%Y-%m}"
+    return str(value)[:7]
+
+
+def group_key(vendor_name, category, when) -> tuple:
+    return (vendor_name or "", category or "", month_key(when))
+
+
+def month_bounds(month: str) -> tuple:
+    year, mon = int(month[:4]), int(month[5:7])
+    return date(year, mon, 1), date(year + (mon == 12), mon % 12 + 1, 1)
+
+
+def _aggregate_columns(table):
+    metered = table.c.consumption > 0
+    return (
+        func.count(table.c.id).label("invoice_count"),
+        func.coalesce(func.sum(table.c.total_amount), 0.0).label("total_amount"),
+        func.coalesce(func.sum(case((metered, table.c.consumption), else_=0.0)), 0.0).label("total_consumption"),
+        func.coalesce(func.sum(case((metered, table.c.total_amount), else_=0.0)), 0.0).label("metered_amount"),
+        func.max(case((metered, table.c.consumption_unit))).label("consumption_unit"),
+        func.min(table.c.total_amount).label("min_amount"),
+        func.max(table.c.total_amount).label("max_amount"),
+    )
+
+
+def _group_filter(table, key: tuple):
+    vendor, category, month = key
+    conditions = [
+        func.coalesce(table.c.vendor_name, "") == vendor,
+        func.coalesce(table.c.category, "") == category,
+    ]
+    if month:
+        start, end = month_bounds(month)
+        conditions += [table.c.date >= start, table.c.date < end]
+    else:
+        conditions.append(table.c.date.is_(None))
+    return and_(*conditions)
+
+
+def _upsert(connection, values: dict, additive: bool):
+    """Inserta el grupo o lo actualiza (sumando si additive, reemplazando si no)"""
+    table = SpendRollup.__table__
+    dialect = connection.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+            least, greatest = func.min, func.max  # min()/max() escalares con varios argumentos
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+            least, greatest = func.least, func.greatest
+        stmt = dialect_insert(table).values(**values)
+        new = stmt.excluded
+        if additive:
+            set_ = {
+                "invoice_count": table.c.invoice_count + new.invoice_count,
+                "total_amount": table.c.total_amount + new.total_amount,
+                "total_consumption": table.c.total_consumption + new.total_consumption,
+                "metered_amount": table.c.metered_amount + new.metered_amount,
+                "consumption_unit": func.coalesce(table.c.consumption_unit, new.consumption_unit),
+                "min_amount": least(func.coalesce(table.c.min_amount, new.min_amount),
+                                    func.coalesce(new.min_amount, table.c.min_amount)),
+                "max_amount": greatest(func.coalesce(table.c.max_amount, new.max_amount),
+                                       func.coalesce(new.max_amount, table.c.max_amount)),
+            }
+        else:
+            set_ = {name: getattr(new, name) for name in values if name not in GROUP_COLUMNS}
+        set_["updated_at"] = func.now()
+        connection.execute(stmt.on_conflict_do_update(index_elements=list(GROUP_COLUMNS), set_=set_))
+        return
+
+    # Otros motores: leer y escribir (sin garantías ante altas concurrentes del mismo grupo)
+    where = and_(*(table.c[c] == values[c] for c in GROUP_COLUMNS))
+    current = connection.execute(select(table).where(where)).mappings().first()
+    if current is None:
+        connection.execute(insert(table).values(**values))
+        return
+    if additive:
+        values = {
+            **values,
+            **{c: current[c] + values[c] for c in ("invoice_count", "total_amount", "total_consumption", "metered_amount")},
+            "consumption_unit": current["consumption_unit"] or values["consumption_unit"],
+            "min_amount": min(v for v in (current["min_amount"], values["min_amount"]) if v is not None)
+            if values["min_amount"] is not None or current["min_amount"] is not None else None,
+            "max_amount": max(v for v in (current["max_amount"], values["max_amount"]) if v is not None)
+            if values["max_amount"] is not None or current["max_amount"] is not None else None,
+        }
+    connection.execute(update(table).where(where).values(**values))
+
+
+def add_invoice(connection, target: Invoice):
+    """Suma una factura nueva a su grupo"""
+    metered = bool(target.consumption and target.consumption > 0)
+    vendor, category, month = group_key(target.vendor_name, target.category, target.date)
+    _upsert(connection, {
+        "vendor_name": vendor,
+        "category": category,
+        "month": month,
+        "invoice_count": 1,
+        "total_amount": target.total_amount or 0.0,
+        "total_consumption": target.consumption if metered else 0.0,
+        "metered_amount": (target.total_amount or 0.0) if metered else 0.0,
+        "consumption_unit": target.consumption_unit if metered else None,
+        "min_amount": target.total_amount,
+        "max_amount": target.total_amount,
+    }, additive=True)
+
+
+def lock_group_statement(key: tuple):
+    rollups = SpendRollup.__table__
+    return select(rollups.c.id).where(and_(
+        *(rollups.c[c] == v for c, v in zip(GROUP_COLUMNS, key))
+    )).with_for_update()
+
+
+def recompute_group(connection, key: tuple):
+    """Recalcula un grupo desde las facturas (tras borrados o modificaciones)"""
+    if connection.dialect.name == "postgresql":
+        # Bloquea la fila antes de agregar: un alta concurrente del grupo espera o ya está confirmada
+        connection.execute(lock_group_statement(key))
+    invoices = Invoice.__table__
+    row = connection.execute(
+        select(*_aggregate_columns(invoices)).where(_group_filter(invoices, key))
+    ).mappings().one()
+    rollups = SpendRollup.__table__
+    if not row["invoice_count"]:
+        connection.execute(delete(rollups).where(and_(
+            *(rollups.c[c] == v for c, v in zip(GROUP_COLUMNS, key))
+        )))
+        return
+    _upsert(connection, {**dict(zip(GROUP_COLUMNS, key)), **row}, additive=False)
+
+
+def rebuild_rollups(db: Session) -> int:
+    """Regenera toda la tabla agrupando las facturas en SQL"""
+    invoices = Invoice.__table__
+    vendor = func.coalesce(invoices.c.vendor_name, "")
+    category = func.coalesce(invoices.c.category, "")
+    year = extract("year", invoices.c.date)
+    month = extract("month", invoices.c.date)
+    rows = db.execute(
+        select(vendor.label("vendor_name"), category.label("category"), year.label("year"),
+               month.label("mon"), *_aggregate_columns(invoices))
+        .group_by(vendor, category, year, month)
+    ).mappings().all()
+
+    db.execute(delete(SpendRollup))
+    values = []
+    for row in rows:
+        values.append({
+            **{k: v for k, v in row.items() if k not in ("year", "mon")},
+            "month": f"{int(row['year']):04d}-{int(row['mon']):02d}" if row["year"] is not None else "",
+        })
+    if values:
+        db.execute(insert(SpendRollup), values)
+    db.commit()
+    logger.info(f"📊 Rollups de gasto regenerados: {len(values)} grupos")
+    return len(values)
+
+
+# --- Lectura ---
+
+def month_aligned(date_from: date = None, date_to: date = None) -> bool:
+    """True si el rango coincide con meses completos (se puede responder con rollups)"""
+    if date_from and date_from.day != 1:
+        return False
+    if date_to and (date_to + timedelta(days=1)).day != 1:
+        return False
+    return True
+
+
+def filter_rollups(query, vendor: str = None, category: str = None,
+                   date_from: date = None, date_to: date = None):
+    """Mismos filtros que reports.apply_filters, a granularidad de mes"""
+    if vendor:
+        query = query.filter(SpendRollup.vendor_name.ilike(f"%{vendor}%"))
+    if category:
+        query = query.filter(SpendRollup.category == category)
+    if date_from:
+        query = query.filter(SpendRollup.month != "", SpendRollup.month >= month_key(date_from))
+    if date_to:
+        query = query.filter(SpendRollup.month != "", SpendRollup.month <= month_key(date_to))
+    return query
+
+
+def rollup_rows(db: Session, **filters) -> list:
+    """Grupos como diccionarios (entrada compacta para los workflows del LLM)"""
+    query = filter_rollups(db.query(SpendRollup), **filters).order_by(
+        SpendRollup.month, SpendRollup.vendor_name, SpendRollup.category
+    )
+    return [{
+        "vendor": r.vendor_name or None,
+        "category": r.category or None,
+        "month": r.month or None,
+        "invoices": r.invoice_count,
+        "total": round(r.total_amount or 0.0, 2),
+        "consumption": round(r.total_consumption or 0.0, 2),
+        "metered": round(r.metered_amount or 0.0, 2),
+        "unit": r.consumption_unit
+    } for r in query]
+
+
+# --- Mantenimiento automático en la ingesta ---
+
+def _keep_old_value(target, value, oldvalue, initiator):
+    return value
+
+
+# Conservamos el valor anterior de la clave del grupo para poder recalcular el grupo de origen
+for _field in ("vendor_name", "category", "date"):
+    event.listen(getattr(Invoice, _field), "set", _keep_old_value, active_history=True)
+
+@event.listens_for(Invoice, "after_insert")
+def _rollup_on_insert(mapper, connection, target):
+    add_invoice(connection, target)
+
+
+@event.listens_for(Invoice, "after_update")
+def _rollup_on_update(mapper, connection, target):
+    state = inspect(target)
+    changed = [f for f in ROLLUP_FIELDS if state.attrs[f].history.has_changes()]
+    if not changed:
+        return
+    old = {f: (state.attrs[f].history.deleted or [getattr(target, f)])[0] for f in ("vendor_name", "category", "date")}
+    old_key = group_key(old["vendor_name"], old["category"], old["date"])
+    new_key = group_key(target.vendor_name, target.category, target.date)
+    # Orden fijo al bloquear dos grupos: evita interbloqueos entre cambios cruzados
+    for key in sorted({old_key, new_key}):
+        recompute_group(connection, key)
+
+
+@event.listens_for(Invoice, "after_delete")
+def _rollup_on_delete(mapper, connection, target):
+    recompute_group(connection, group_key(target.vendor_name, target.category, target.date))
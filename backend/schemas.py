@@ -0,0 +1,175 @@
+"""
+Esquemas de salida estructurada del LLM y parser JSON tolerante.
+
+El esquema de extracción se define una sola vez (InvoiceExtraction) y se
+traduce al formato que espera cada proveedor:
+- Ollama: `format` = JSON schema
+- Gemini: `response_schema` = modelo Pydantic
+- OpenAI: `response_format` = json_schema estricto
+"""
+import copy
+import json
+import re
+from typing import Optional
+
+from pydantic import BaseModel, ValidationError, field_validator
+
+
+class InvoiceExtraction(BaseModel):
+    """Campos que el workflow extraer-factura pide al modelo"""
+    invoice_number: Optional[str] = None
+    date: Optional[str] = None  # YYYY-MM-DD
+    vendor_name: Optional[str] = None
+    total_amount: Optional[float] = None
+    currency: Optional[str] = "EUR"
+    type: Optional[str] = "Purchase"
+    category: Optional[str] = None  # Telecom, Electricity, Gas, Water u Other
+    consumption: Optional[float] = None
+    consumption_unit: Optional[str] = None
+    unit_price: Optional[float] = None
+    period: Optional[str] = None
+    taxes: Optional[float] = None
+    power: Optional[float] = None
+    observations: Optional[str] = None
+
+    @field_validator("total_amount", "consumption", "unit_price", "taxes", "power", mode="before")
+    @classmethod
+    def _parse_decimal(cls, value):
+        """Acepta números con coma decimal, separador de miles o unidades ('1.234,56 €')"""
+        if value is None or isinstance(value, (int, float)):
+            return value
+        if not isinstance(value, str):
+            return None
+        number = re.sub(r"[^\d,.\-]", "", value)
+        if "," in number and "." in number:
+            # El último separador es el decimal
+            if number.rfind(",") > number.rfind("."):
+                number = number.replace(".", "").replace(",", ".")
+            else:
+                number = number.replace(",", "")
+        else:
+            number = number.replace(",", ".")
+        try:
+            return float(number)
+        except ValueError:
+            return None
+
+    @field_validator("invoice_number", "date", "vendor_name", "currency", "type", "category",
+                     "consumption_unit", "period", "observations", mode="before")
+    @classmethod
+    def _stringify(cls, value):
+        if value is None or isinstance(value, str):
+            return value
+        return str(value)
+
+
+def json_schema_for(model: type) -> dict:
+    """JSON schema compacto (sin títulos) para `format` de Ollama"""
+    schema = model.model_json_schema()
+    return _strip_titles(schema)
+
+
+def openai_response_format(model: type) -> dict:
+    """response_format de OpenAI en modo estricto (todos los campos requeridos, nullables)"""
+    schema = json_schema_for(model)
+    schema["required"] = list(schema.get("properties", {}).keys())
+    schema["additionalProperties"] = False
+    for prop in schema.get("properties", {}).values():
+        prop.pop("default", None)
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": model.__name__.lower(), "schema": schema, "strict": True}
+    }
+
+
+def _strip_titles(node):
+    if isinstance(node, dict):
+        return {k: _strip_titles(v) for k, v in node.items() if k != "title"}
+    if isinstance(node, list):
+        return [_strip_titles(v) for v in node]
+    return copy.deepcopy(node)
+
+
+def parse_json_tolerant(text: str) -> dict:
+    """Parsea el primer objeto JSON de una respuesta del LLM.
+
+    Tolera bloques markdown, texto antes/después del objeto y salidas
+    truncadas (cierra cadenas y llaves abiertas). Lanza ValueError si no
+    hay ningún objeto recuperable.
+    """
+    if not text:
+        raise ValueError("Respuesta vacía")
+    start = text.find("{")
+    if start == -1:
+        raise ValueError("La respuesta no contiene un objeto JSON")
+    text = text[start:]
+
+    try:
+        obj, _ = json.JSONDecoder().raw_decode(text)
+        if isinstance(obj, dict):
+            return obj
+    except json.JSONDecodeError:
+        pass
+
+    repaired = _close_truncated(text)
+    try:
+        obj = json.loads(repaired)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"JSON irrecuperable: {e}") from e
+    if not isinstance(obj, dict):
+        raise ValueError("La respuesta no es un objeto JSON")
+    return obj
+
+
+def _close_truncated(text: str) -> str:
+    """Recorre el texto una vez y cierra las estructuras que quedaron abiertas"""
+    stack = []
+    in_string = False
+    escaped = False
+    safe_cut = (len(text), [])  # último punto donde cortar sin dejar un par clave/valor a medias
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            safe_cut = (i + 1, list(stack))
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                return text[:i + 1]
+        elif ch == ",":
+            safe_cut = (i, list(stack))
+
+    if in_string:
+        text += '"'
+    body = re.sub(r"(\d)\.$", r"\1", text.rstrip())
+    # Si el último par clave/valor quedó a medias, volvemos al último corte seguro
+    if body.endswith((":", ",")) or re.search(r'[{,]\s*"[^"]*"$', body):
+        cut, stack = safe_cut
+        body = text[:cut]
+    return body + "".join(reversed(stack))
+
+
+def validate_extraction(data: dict) -> dict:
+    """Valida contra InvoiceExtraction descartando campos inválidos en lugar de fallar"""
+    try:
+        model = InvoiceExtraction.model_validate(data)
+    except ValidationError as e:
+        bad_fields = {err["loc"][0] for err in e.errors() if err.get("loc")}
+        cleaned = {k: v for k, v in data.items() if k not in bad_fields}
+        model = InvoiceExtraction.model_validate(cleaned)
+    result = model.model_dump(exclude_none=True)
+    # Conservamos claves extra que el modelo haya añadido (p. ej. 'notes')
+    for key, value in data.items():
+        if key not in InvoiceExtraction.model_fields:
+            result[key] = value
+    return result
@@ -0,0 +1,205 @@
+"""
+Índice de texto completo sobre las facturas (raw_text, proveedor, nº y categoría).
+
+- PostgreSQL: columna `search_vector` (tsvector ponderado) con índice GIN.
+- SQLite (tests): tabla virtual FTS5 `invoices_fts` con rowid = invoices.id.
+
+El índice se mantiene con eventos ORM (alta, modificación y borrado de
+Invoice), así cualquier ruta de ingesta (API, watcher, tests) lo actualiza.
+"""
+import re
+import logging
+
+from sqlalchemy import event, text, inspect
+from sqlalchemy.orm import Session
+
+from .database import Invoice
+
+logger = logging.getLogger(__name__)
+
+SEARCH_LANGUAGE = "spanish"
+FTS_TABLE = "invoices_fts"
+
+# Palabras vacías que no aportan a la selección de facturas en el chat
+STOPWORDS = {
+    "de", "del", "la", "las", "el", "los", "en", "y", "o", "a", "al", "un", "una", "que", "qué",
+    "es", "por", "para", "con", "se", "su", "sus", "mi", "me", "lo", "le", "hay", "este", "esta",
+    "cual", "cuál", "cuanto", "cuánto", "cuanta", "cuánta", "cuantos", "cuántos", "cuantas", "cuántas",
+    "como", "cómo", "cuando", "cuándo", "donde", "dónde", "hemos", "han", "ha", "fue", "son", "tenemos",
+    "gastado", "gastamos", "gasto", "factura", "facturas", "dime", "dame", "muestra", "total"
+}
+
+
+def _dialect(bind) -> str:
+    return bind.dialect.name
+
+
+def tokenize_query(query: str, drop_stopwords: bool = False) -> list:
+    """Términos alfanuméricos de la consulta (sin operadores de FTS)"""
+    terms = [t for t in re.findall(r"\w+", query.lower()) if len(t) >= 2]
+    if drop_stopwords:
+        terms = [t for t in terms if t not in STOPWORDS]
+    return list(dict.fromkeys(terms))
+
+
+def ensure_search_index(connection) -> bool:
+    """Crea la estructura del índice si no existe. Devuelve True si se creó ahora."""
+    dialect = _dialect(connection)
+    if dialect == "sqlite":
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"
+        ), {"name": FTS_TABLE}).first()
+        if exists:
+            return False
+        connection.execute(text(
+            f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+            "vendor_name, invoice_number, category, raw_text, "
+            "tokenize='unicode61 remove_diacritics 2')"
+        ))
+        return True
+    if dialect == "postgresql":
+        columns = {c["name"] for c in inspect(connection).get_columns("invoices")}
+        if "search_vector" in columns:
+            return False
+        connection.execute(text("ALTER TABLE invoices ADD COLUMN search_vector tsvector"))
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_invoices_search_vector ON invoices USING GIN (search_vector)"
+        ))
+        return True
+    logger.warning(f"⚠️ Búsqueda de texto completo no soportada en {dialect}")
+    return False
+
+
+def index_invoice(connection, invoice_id: int, vendor_name: str = None, invoice_number: str = None,
+                  category: str = None, raw_text: str = None):
+    """Inserta o reemplaza la entrada de una factura en el índice"""
+    params = {
+        "id": invoice_id,
+        "vendor": vendor_name or "",
+        "number": invoice_number or "",
+        "category": category or "",
+        "raw": raw_text or ""
+    }
+    dialect = _dialect(connection)
+    if dialect == "sqlite":
+        connection.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), params)
+        connection.execute(text(
+            f"INSERT INTO {FTS_TABLE}(rowid, vendor_name, invoice_number, category, raw_text) "
+            "VALUES (:id, :vendor, :number, :category, :raw)"
+        ), params)
+    elif dialect == "postgresql":
+        connection.execute(text(
+            "UPDATE invoices SET search_vector = "
+            f"setweight(to_tsvector('{SEARCH_LANGUAGE}', :vendor), 'A') || "
+            "setweight(to_tsvector('simple', :number), 'A') || "
+            f"setweight(to_tsvector('{SEARCH_LANGUAGE}', :category), 'B') || "
+            f"setweight(to_tsvector('{SEARCH_LANGUAGE}', :raw), 'D') "
+            "WHERE id = :id"
+        ), params)
+
+
+def remove_invoice(connection, invoice_id: int):
+    """Elimina una factura del índice (en PostgreSQL se va con la fila)"""
+    if _dialect(connection) == "sqlite":
+        connection.execute(text(f"DELETE FROM {FTS_TABLE} WHERE rowid = :id"), {"id": invoice_id})
+
+
+def rebuild_search_index(db: Session) -> int:
+    """Reindexa todas las facturas (tras crear el índice sobre datos existentes)"""
+    connection = db.connection()
+    if _dialect(connection) == "sqlite":
+        connection.execute(text(f"DELETE FROM {FTS_TABLE}"))
+    count = 0
+    rows = db.query(
+        Invoice.id, Invoice.vendor_name, Invoice.invoice_number, Invoice.category, Invoice.raw_text
+    ).yield_per(500)
+    for row in rows:
+        index_invoice(connection, row.id, row.vendor_name, row.invoice_number, row.category, row.raw_text)
+        count += 1
+    db.commit()
+    logger.info(f"🔎 Índice de búsqueda reconstruido: {count} facturas")
+    return count
+
+
+def search_invoices(db: Session, query: str, limit: int = 20, offset: int = 0,
+                    match_all: bool = True) -> list:
+    """Busca facturas por texto completo, ordenadas por relevancia y con fragmento resaltado.
+
+    match_all=True exige todos los términos (búsqueda del usuario);
+    match_all=False acepta cualquiera y elimina palabras vacías (selección para el chat).
+    """
+    terms = tokenize_query(query, drop_stopwords=not match_all)
+    if not terms:
+        return []
+    connection = db.connection()
+    dialect = _dialect(connection)
+    params = {"limit": limit, "offset": offset}
+
+    if dialect == "sqlite":
+        joiner = " AND " if match_all else " OR "
+        params["q"] = joiner.join(f'"{t}"*' for t in terms)
+        rows = connection.execute(text(
+            "SELECT i.id, i.invoice_number, i.vendor_name, i.category, i.date, i.total_amount, "
+            f"bm25({FTS_TABLE}, 10.0, 10.0, 5.0, 1.0) AS score, "
+            f"snippet({FTS_TABLE}, -1, '<mark>', '</mark>', '…', 16) AS snippet "
+            f"FROM {FTS_TABLE} JOIN invoices i ON i.id = {FTS_TABLE}.rowid "
+            f"WHERE {FTS_TABLE} MATCH :q ORDER BY score LIMIT :limit OFFSET :offset"
+        ), params).mappings().all()
+        # bm25() devuelve valores negativos (más negativo = más relevante)
+        return [{**dict(r), "score": round(-r["score"], 4), "date": str(r["date"]) if r["date"] else None} for r in rows]
+
+    if dialect == "postgresql":
+        joiner = " & " if match_all else " | "
+        params["q"] = joiner.join(f"{t}:*" for t in terms)
+        rows = connection.execute(text(
+            "SELECT id, invoice_number, vendor_name, category, date, total_amount, "
+            "ts_rank(search_vector, q) AS score "
+            f"FROM invoices, to_tsquery('{SEARCH_LANGUAGE}', :q) AS q "
+            "WHERE search_vector @@ q ORDER BY score DESC LIMIT :limit OFFSET :offset"
+        ), params).mappings().all()
+        # El texto está comprimido en documents: se descomprime solo para la página y
+        # los fragmentos resaltados se calculan en una única consulta
+        texts = dict(db.query(Invoice.id, Invoice.raw_text).filter(Invoice.id.in_([r["id"] for r in rows])))
+        snippets = connection.execute(text(
+            f"SELECT ts_headline('{SEARCH_LANGUAGE}', t, to_tsquery('{SEARCH_LANGUAGE}', :q), "
+            "'StartSel=<mark>, StopSel=</mark>, MaxWords=24, MinWords=8, MaxFragments=1') "
+            "FROM unnest(CAST(:texts AS text[])) WITH ORDINALITY AS u(t, n) ORDER BY n"
+        ), {"q": params["q"], "texts": [texts.get(r["id"]) or "" for r in rows]}).scalars().all() if rows else []
+        return [{**dict(r), "score": round(float(r["score"]), 4), "snippet": snippet,
+                 "date": str(r["date"]) if r["date"] else None} for r, snippet in zip(rows, snippets)]
+
+    return []
+
+
+# --- Mantenimiento automático del índice ---
+
+@event.listens_for(Invoice.__table__, "after_create")
+def _create_index_with_table(target, connection, **kw):
+    ensure_search_index(connection)
+
+
+@event.listens_for(Invoice.__table__, "before_drop")
+def _drop_index_with_table(target, connection, **kw):
+    if _dialect(connection) == "sqlite":
+        connection.execute(text(f"DROP TABLE IF EXISTS {FTS_TABLE}"))
+
+
+INDEXED_FIELDS = ("vendor_name", "invoice_number", "category", "document_hash")  # document_hash = raw_text
+
+
+@event.listens_for(Invoice, "after_insert")
+def _index_on_insert(mapper, connection, target):
+    index_invoice(connection, target.id, target.vendor_name, target.invoice_number,
+                  target.category, target.raw_text)
+
+
+@event.listens_for(Invoice, "after_update")
+def _reindex_on_update(mapper, connection, target):
+    state = inspect(target)
+    if any(state.attrs[f].history.has_changes() for f in INDEXED_FIELDS):
+        _index_on_insert(mapper, connection, target)
+
+
+@event.listens_for(Invoice, "after_delete")
+def _unindex_on_delete(mapper, connection, target):
+    remove_invoice(connection, target.id)
@@ -0,0 +1,94 @@
+"""
+Estadísticas del dashboard (/advanced-stats) calculadas con agregados SQL.
+
+Todas las cifras salen de GROUP BY en la base de datos: sobre la tabla de
+rollups (proveedor, categoría, mes) cuando el rango es de meses completos, y
+sobre las facturas cuando el rango corta un mes.
+"""
+from datetime import date
+
+from sqlalchemy import func, extract, case
+from sqlalchemy.orm import Session
+
+from .database import Invoice, SpendRollup
+from .reports import apply_filters
+from .rollups import month_aligned, filter_rollups
+
+
+def advanced_stats(db: Session, vendor: str = None, category: str = None,
+                   date_from: date = None, date_to: date = None) -> dict:
+    filters = {"vendor": vendor, "category": category, "date_from": date_from, "date_to": date_to}
+    if month_aligned(date_from, date_to):
+        return _stats_from_rollups(db, filters)
+    return _stats_from_invoices(db, filters)
+
+
+def _build_result(by_category: list, efficiency: list, monthly: list) -> dict:
+    total_cost = sum(total or 0.0 for _, _, total in by_category)
+    return {
+        "distribution": [
+            {"name": name, "value": total or 0.0, "count": count,
+             "percent": ((total or 0.0) / total_cost * 100) if total_cost > 0 else 0}
+            for name, count, total in by_category
+        ],
+        "efficiency": efficiency,
+        "monthly": monthly,
+        "total_cost": total_cost,
+        "invoice_count": sum(count for _, count, _ in by_category)
+    }
+
+
+def _stats_from_rollups(db: Session, filters: dict) -> dict:
+    cat = case((SpendRollup.category == "", "Other"), else_=SpendRollup.category)
+    by_category = filter_rollups(
+        db.query(cat, func.sum(SpendRollup.invoice_count), func.sum(SpendRollup.total_amount)), **filters
+    ).group_by(cat).all()
+
+    by_consumption = filter_rollups(
+        db.query(cat, func.sum(SpendRollup.metered_amount), func.sum(SpendRollup.total_consumption),
+                 func.max(SpendRollup.consumption_unit)), **filters
+    ).filter(SpendRollup.total_consumption > 0).group_by(cat).all()
+    efficiency = [
+        {"category": name, "cost_per_unit": cost / units, "unit": unit}
+        for name, cost, units, unit in by_consumption if units
+    ]
+
+    by_month = filter_rollups(
+        db.query(SpendRollup.month, func.sum(SpendRollup.invoice_count), func.sum(SpendRollup.total_amount)),
+        **filters
+    ).filter(SpendRollup.month != "").group_by(SpendRollup.month).order_by(SpendRollup.month).all()
+    monthly = [{"month": m, "count": count, "total": round(total or 0.0, 2)} for m, count, total in by_month]
+
+    return _build_result([(n, c or 0, t) for n, c, t in by_category], efficiency, monthly)
+
+
+def _stats_from_invoices(db: Session, filters: dict) -> dict:
+    amount = func.coalesce(Invoice.total_amount, 0.0)
+    cat = func.coalesce(Invoice.category, "Other")
+
+    # Distribución por categoría
+    by_category = apply_filters(
+        db.query(cat, func.count(Invoice.id), func.sum(amount)), **filters
+    ).group_by(cat).all()
+
+    # Eficiencia: coste medio por unidad consumida en cada categoría
+    by_consumption = apply_filters(
+        db.query(cat, func.sum(amount), func.sum(Invoice.consumption), func.max(Invoice.consumption_unit)),
+        **filters
+    ).filter(Invoice.consumption > 0).group_by(cat).all()
+    efficiency = [
+        {"category": name, "cost_per_unit": cost / units, "unit": unit}
+        for name, cost, units, unit in by_consumption if units
+    ]
+
+    # Desglose mensual
+    year, month = extract("year", Invoice.date), extract("month", Invoice.date)
+    by_month = apply_filters(
+        db.query(year, month, func.count(Invoice.id), func.sum(amount)), **filters
+    ).filter(Invoice.date.isnot(None)).group_by(year, month).order_by(year, month).all()
+    monthly = [
+        {"month": f"{int(y):04d}-{int(m):02d}", "count": count, "total": round(total or 0.0, 2)}
+        for y, m, count, total in by_month
+    ]
+
+    return _build_result(by_category, efficiency, monthly)
@@ -0,0 +1,260 @@
+"""
+Originales subidos guardados por contenido, con contador de referencias.
+
+/upload y /jobs guardan cada fichero una sola vez con clave sha256 del
+contenido, repartido en subcarpetas (`ab/cd/<sha256>.pdf`): dos proveedores
+con un `factura.pdf` no se pisan y el mismo fichero subido dos veces no ocupa
+el doble. invoices.file_path apunta a la ruta del fichero en el almacén.
+
+- Alta de factura: stored_files.refcount + 1 (misma transacción, eventos ORM).
+- Borrado o cambio de file_path: refcount - 1; al llegar a 0 se borra la fila
+  y, tras el commit, el fichero si nadie lo ha vuelto a guardar.
+
+El almacén es un directorio local (STORAGE_DIR). Para pasar a un almacén de
+objetos basta otra clase con los mismos métodos que LocalStore (put, exists,
+delete, local_path) asignada a `store`. Los huérfanos (p. ej. trabajos
+fallidos o filas borradas fuera del ORM) se limpian con
+`python -m backend.admin prune-files`.
+"""
+import hashlib
+import logging
+import os
+import re
+import tempfile
+
+from sqlalchemy import event, select, update, delete, inspect, func
+from sqlalchemy.orm import Session, object_session
+
+from .database import Invoice, ExtractionJob, StoredFile
+
+logger = logging.getLogger(__name__)
+
+STORAGE_DIR = os.getenv("STORAGE_DIR", "backend/storage")
+KEY_PATTERN = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})(\.[a-z0-9]+)?$")
+
+
+def blob_key(digest: str, filename: str = "") -> str:
+    """ab/cd/<sha256><ext>: dos niveles de 256 carpetas para no acumular miles de ficheros en una"""
+    ext = os.path.splitext(filename or "")[1].lower()
+    return f"{digest[:2]}/{digest[2:4]}/{digest}{ext}"
+
+
+def write_atomic(path: str, content: bytes):
+    """Escribe en un temporal y renombra: nunca queda un fichero a medias con el nombre final"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class LocalStore:
+    """Almacén en un directorio local; las claves son rutas relativas con '/'"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def local_path(self, key: str) -> str:
+        """Ruta para leer el fichero (un almacén de objetos lo descargaría a una caché local)"""
+        return os.path.join(self.root, *key.split("/"))
+
+    def key_for_path(self, path: str):
+        """Clave de una ruta del almacén (None si la ruta no es del almacén)"""
+        if not path:
+            return None
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(self.root))
+        key = relative.replace(os.sep, "/")
+        return key if KEY_PATTERN.match(key) else None
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.local_path(key))
+
+    def put(self, key: str, content: bytes):
+        if not self.exists(key):  # Mismo contenido, misma clave: ya está guardado
+            write_atomic(self.local_path(key), content)
+
+    def delete(self, key: str):
+        path = self.local_path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def keys(self):
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                key = self.key_for_path(os.path.join(directory, name))
+                if key:
+                    yield key
+
+
+store = LocalStore(STORAGE_DIR)
+
+
+def original_path(content: bytes, filename: str = "") -> str:
+    """Ruta que tendrá el contenido en el almacén (sin guardarlo)"""
+    return store.local_path(blob_key(hashlib.sha256(content).hexdigest(), filename))
+
+
+def save_original(content: bytes, filename: str = "") -> str:
+    """Guarda el contenido (si no estaba ya) y devuelve su ruta. Sin referencias hasta que una factura la use."""
+    key = blob_key(hashlib.sha256(content).hexdigest(), filename)
+    store.put(key, content)
+    return store.local_path(key)
+
+
+def is_stored(path: str) -> bool:
+    return store.key_for_path(path) is not None
+
+
+def discard_original(db: Session, path: str):
+    """Fichero de una factura que no se llegó a guardar: se borra solo si nada más lo usa"""
+    key = store.key_for_path(path)
+    if key is None:
+        if path and os.path.exists(path):
+            os.remove(path)  # Ruta fuera del almacén (instalaciones anteriores)
+        return
+    digest = KEY_PATTERN.match(key).group(1)
+    referenced = db.query(StoredFile.refcount).filter(StoredFile.sha256 == digest, StoredFile.refcount > 0).first()
+    queued = db.query(ExtractionJob.id).filter(
+        ExtractionJob.file_path == path, ExtractionJob.status.in_(["pending", "running"])
+    ).first()
+    if not referenced and not queued:
+        store.delete(key)
+
+
+def remove_unreferenced(db: Session, path: str) -> bool:
+    """Tras borrar una factura: los ficheros del almacén ya los liberan los eventos;
+    los de fuera (instalaciones anteriores, watcher en modo local) se borran si ninguna otra factura los usa"""
+    if not path or is_stored(path) or not os.path.exists(path):
+        return False
+    if db.query(Invoice.id).filter(Invoice.file_path == path).first():
+        return False
+    os.remove(path)
+    return True
+
+
+def prune_files(db: Session) -> int:
+    """Recalcula los contadores desde invoices y borra los ficheros sin facturas ni trabajos en curso"""
+    counts = {}
+    for (path,) in db.query(Invoice.file_path).filter(Invoice.file_path.isnot(None)):
+        key = store.key_for_path(path)
+        if key:
+            counts[key] = counts.get(key, 0) + 1
+    queued = {store.key_for_path(path) for (path,) in db.query(ExtractionJob.file_path).filter(
+        ExtractionJob.status.in_(["pending", "running"]))}
+
+    table = StoredFile.__table__
+    known = {row.sha256: row for row in db.execute(select(table))}
+    for key, count in counts.items():
+        digest = KEY_PATTERN.match(key).group(1)
+        if digest in known:
+            db.execute(update(table).where(table.c.sha256 == digest).values(refcount=count))
+        else:
+            db.execute(table.insert().values(sha256=digest, storage_key=key, size=_size(key), refcount=count))
+    stale = [digest for digest, row in known.items() if row.storage_key not in counts]
+    if stale:
+        db.execute(delete(table).where(table.c.sha256.in_(stale)))
+    db.commit()
+
+    removed = 0
+    for key in list(store.keys()):
+        if key not in counts and key not in queued:
+            store.delete(key)
+            removed += 1
+    logger.info(f"🧹 Ficheros sin referencias eliminados: {removed}")
+    return removed
+
+
+def _size(key: str):
+    try:
+        return os.path.getsize(store.local_path(key))
+    except OSError:
+        return None
+
+
+# --- Contadores de referencias (eventos ORM) ---
+
+def acquire(connection, path: str):
+    key = store.key_for_path(path)
+    if key is None:
+        return
+    digest = KEY_PATTERN.match(key).group(1)
+    table = StoredFile.__table__
+    row = {"sha256": digest, "storage_key": key, "size": _size(key), "refcount": 1}
+    dialect = connection.dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        stmt = dialect_insert(table).values(**row)
+        connection.execute(stmt.on_conflict_do_update(
+            index_elements=["sha256"], set_={"refcount": table.c.refcount + 1}
+        ))
+        return
+    # Otros motores: actualizar y, si no existía, insertar
+    if connection.execute(update(table).where(table.c.sha256 == digest).values(refcount=table.c.refcount + 1)).rowcount == 0:
+        connection.execute(table.insert().values(**row))
+
+
+def release(connection, path: str, session: Session = None):
+    """refcount - 1; a 0 se borra la fila y el fichero queda pendiente de borrar tras el commit"""
+    key = store.key_for_path(path)
+    if key is None:
+        return
+    digest = KEY_PATTERN.match(key).group(1)
+    table = StoredFile.__table__
+    connection.execute(update(table).where(table.c.sha256 == digest).values(refcount=table.c.refcount - 1))
+    if connection.execute(delete(table).where(table.c.sha256 == digest, table.c.refcount <= 0)).rowcount:
+        if session is not None:
+            session.info.setdefault("storage_unlink", set()).add((digest, key))
+
+
+def _on_insert(mapper, connection, target):
+    acquire(connection, target.file_path)
+
+
+def _on_delete(mapper, connection, target):
+    release(connection, target.file_path, object_session(target))
+
+
+def _on_update(mapper, connection, target):
+    history = inspect(target).attrs.file_path.history
+    if not history.has_changes():
+        return
+    for path in history.deleted:
+        release(connection, path, object_session(target))
+    for path in history.added:
+        acquire(connection, path)
+
+
+event.listen(Invoice, "after_insert", _on_insert)
+event.listen(Invoice, "after_delete", _on_delete)
+event.listen(Invoice, "after_update", _on_update)
+
+
+@event.listens_for(Session, "after_commit")
+def _unlink_released(session):
+    pending = session.info.pop("storage_unlink", None)
+    if not pending:
+        return
+    table = StoredFile.__table__
+    # Sesión fuera de transacción: se comprueba con una conexión propia si alguien lo ha vuelto a usar
+    with session.get_bind().connect() as connection:
+        for digest, key in pending:
+            if connection.execute(select(func.count()).select_from(table).where(table.c.sha256 == digest)).scalar():
+                continue
+            try:
+                store.delete(key)
+            except OSError as e:
+                logger.warning(f"⚠️ No se pudo borrar {key}: {e}")
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_released(session, previous_transaction):
+    session.info.pop("storage_unlink", None)
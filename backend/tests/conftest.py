@@ -3,8 +3,11 @@ import os
 
 # Set testing mode BEFORE any imports
 os.environ["TESTING"] = "true"
+# Extracción en hilos: los mocks de los tests no se pueden enviar a otro proceso
+os.environ.setdefault("EXTRACTION_EXECUTOR", "thread")
 
 from backend.database import Base, engine, init_db
+from backend import storage
 
 
 @pytest.fixture(scope="function", autouse=True)
@@ -17,3 +20,9 @@ def setup_test_database():
     
     # Clean up - drop all tables after test
     Base.metadata.drop_all(bind=engine)
+
+
+@pytest.fixture(autouse=True)
+def isolated_storage(tmp_path, monkeypatch):
+    """Originales subidos en una carpeta temporal por test (no en backend/storage)"""
+    monkeypatch.setattr(storage, "store", storage.LocalStore(str(tmp_path / "storage")))
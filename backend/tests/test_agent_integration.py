@@ -24,7 +24,7 @@ class TestAgentConfig(unittest.TestCase):
             patch('backend.ai_service.pytesseract'),
             patch('backend.ai_service.pdfplumber'),
             patch('backend.ai_service.Provider'),
-            patch('backend.ai_service.ExtractionLog')
+            patch('backend.ai_service.record_extraction')
         ]
         for p in cls.patches:
             p.start()
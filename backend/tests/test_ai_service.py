@@ -209,6 +209,37 @@ class TestExtractInvoiceData:
                 assert data['date'] == f'2025-{month_num}-10', f"Failed for {month_name}"
 
 
+    def test_extract_sends_json_schema_to_ollama(self):
+        """El esquema de extracción se pasa como `format` a Ollama"""
+        with patch('backend.ai_service.requests.post') as mock_post:
+            mock_post.return_value.json.return_value = {"response": '{"total_amount": 10}'}
+            mock_post.return_value.raise_for_status = Mock()
+
+            mock_db = MagicMock()
+            mock_db.query.return_value.all.return_value = []
+            extract_invoice_data("Factura", mock_db)
+
+            payload = mock_post.call_args.kwargs["json"]
+            assert isinstance(payload["format"], dict)
+            assert "invoice_number" in payload["format"]["properties"]
+
+    def test_extract_repairs_fenced_truncated_response(self):
+        """Una respuesta con markdown y truncada no desperdicia la llamada"""
+        with patch('backend.ai_service.requests.post') as mock_post:
+            mock_post.return_value.json.return_value = {
+                "response": '```json\n{"consumption": "312,5", "consumption_unit": "kWh", "period": "dic'
+            }
+            mock_post.return_value.raise_for_status = Mock()
+
+            mock_db = MagicMock()
+            mock_db.query.return_value.all.return_value = []
+            data = json.loads(extract_invoice_data("Factura", mock_db))
+
+            assert data["consumption"] == 312.5
+            assert data["consumption_unit"] == "kWh"
+            assert "notes" not in data
+
+
 class TestValidateInvoice:
     """Tests para validación de facturas"""
     
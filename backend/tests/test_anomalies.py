@@ -0,0 +1,90 @@
+import pytest
+from datetime import datetime
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+
+from backend.main import app
+from backend.database import SessionLocal, Invoice
+from backend.anomalies import scan_anomalies, historical_averages
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    # Som Energia: consumo y precio estables salvo un salto en junio
+    monthly = [(300, 60.0), (310, 62.0), (305, 61.0), (295, 59.0), (300, 60.0), (600, 180.0), (305, 61.0)]
+    for month, (kwh, total) in enumerate(monthly, start=1):
+        session.add(Invoice(invoice_number=f"SE{month}", vendor_name="Som Energia", category="Electricity",
+                            date=datetime(2025, month, 1), total_amount=total, consumption=float(kwh),
+                            consumption_unit="kWh", file_path=f"se{month}.pdf"))
+    for month in range(1, 5):
+        session.add(Invoice(invoice_number=f"O{month}", vendor_name="O2", category="Telecom",
+                            date=datetime(2025, month, 3), total_amount=45.0, file_path=f"o{month}.pdf"))
+    session.commit()
+    yield session
+    session.close()
+
+
+def _by_number(db, scan):
+    numbers = dict(db.query(Invoice.id, Invoice.invoice_number))
+    return {numbers[a["invoice_id"]]: a for a in scan["alerts"]}
+
+
+class TestScanAnomalies:
+    """Tests para el escaneo vectorizado"""
+
+    def test_flags_jump_and_outlier(self, db):
+        scan = scan_anomalies(db)
+        assert scan["scanned"] == 11
+        alerts = _by_number(db, scan)
+        june = alerts["SE6"]
+        assert june["severity"] == "ALTA"
+        assert {"salto_consumo", "salto_precio", "desviacion_precio"} <= set(june["reasons"])
+        assert june["consumption_jump_pct"] == pytest.approx(100.0)
+        assert june["price_per_unit"] == pytest.approx(0.3)
+        # La bajada de julio cambia el precio (salto), pero no es un aumento de consumo
+        assert "salto_consumo" not in alerts["SE7"]["reasons"]
+        # Facturas estables y proveedores sin variación no se marcan
+        assert "SE2" not in alerts
+        assert not any(number.startswith("O") for number in alerts)
+        assert scan["alerts"][0]["invoice_id"] == june["invoice_id"]
+
+    def test_thresholds_override(self, db):
+        relaxed = scan_anomalies(db, thresholds={"consumption_increase_pct": 150, "price_deviation_pct": 300, "zscore": 10})
+        assert relaxed["flagged"] == 0
+
+    def test_filters_and_empty(self, db):
+        assert scan_anomalies(db, vendor="O2")["scanned"] == 4
+        assert scan_anomalies(db, vendor="nadie") == {
+            "scanned": 0, "flagged": 0, "thresholds": scan_anomalies(db)["thresholds"], "alerts": []
+        }
+
+    def test_historical_averages_sql(self, db):
+        invoice = db.query(Invoice).filter_by(invoice_number="O1").one()
+        assert historical_averages(db, invoice) == {"avg_consumption": 0.0, "avg_total": 45.0}
+
+
+class TestScanEndpoint:
+    """Tests para /workflow/alertas/scan"""
+
+    @patch('backend.main.check_alerts')
+    def test_only_flagged_invoices_reach_llm(self, mock_alerts, db):
+        mock_alerts.return_value = "## ALERTAS DETECTADAS"
+        data = client.post("/workflow/alertas/scan", json={"max_narratives": 1}).json()
+        assert data["status"] == "success"
+        assert data["flagged"] >= 1
+        assert mock_alerts.call_count == 1
+        assert data["alerts"][0]["narrative"] == "## ALERTAS DETECTADAS"
+        assert mock_alerts.call_args.args[0]["reasons"]
+
+    @patch('backend.main.check_alerts')
+    def test_scan_without_narrative(self, mock_alerts, db):
+        data = client.post("/workflow/alertas/scan", json={"narrate": False}).json()
+        assert data["flagged"] >= 1
+        mock_alerts.assert_not_called()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -1,7 +1,7 @@
 
 import pytest
 from fastapi.testclient import TestClient
-from unittest.mock import Mock, patch
+from unittest.mock import Mock, AsyncMock, patch
 import json
 import os
 from io import BytesIO
@@ -64,6 +64,62 @@ class TestReportsEndpoint:
         assert len(data) == 1
         assert data[0]["invoice_number"] == "INV001"
         assert data[0]["vendor_name"] == "O2"
+        assert "raw_text" not in data[0]
+        assert response.headers["X-Total-Count"] == "1"
+
+    def _insert_invoices(self, count=7):
+        from backend.database import SessionLocal, Invoice
+        from datetime import datetime
+
+        db = SessionLocal()
+        try:
+            for i in range(count):
+                db.add(Invoice(
+                    invoice_number=f"R{i:03d}", date=datetime(2025, i % 3 + 1, 10),
+                    vendor_name="O2" if i % 2 else "Som Energia", total_amount=float(100 - i),
+                    category="Telecom" if i % 2 else "Electricity", currency="EUR",
+                    file_path=f"r{i}.pdf", raw_text=f"texto {i}"
+                ))
+            db.commit()
+        finally:
+            db.close()
+
+    def test_reports_keyset_pagination(self):
+        """Recorre todas las páginas con el cursor sin repetir ni perder filas"""
+        self._insert_invoices()
+        seen = []
+        cursor = None
+        while True:
+            params = {"limit": 3, "sort": "-date"}
+            if cursor:
+                params["after"] = cursor
+            response = client.get("/reports", params=params)
+            assert response.headers["X-Total-Count"] == "7"
+            seen.extend(response.json())
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+        assert len(seen) == 7
+        assert len({inv["id"] for inv in seen}) == 7
+        dates = [inv["date"] for inv in seen]
+        assert dates == sorted(dates, reverse=True)
+
+    def test_reports_filters_and_projection(self):
+        """Filtra por proveedor y fecha y devuelve solo los campos pedidos"""
+        self._insert_invoices()
+        response = client.get("/reports", params={
+            "vendor": "o2", "date_from": "2025-02-01", "fields": "invoice_number,total_amount,raw_text"
+        })
+        data = response.json()
+        assert response.headers["X-Total-Count"] == str(len(data))
+        assert data and all(set(inv) == {"id", "invoice_number", "total_amount", "raw_text"} for inv in data)
+        assert all(inv["raw_text"].startswith("texto") for inv in data)
+
+    def test_reports_invalid_sort(self):
+        """Un orden no permitido devuelve 400"""
+        response = client.get("/reports", params={"sort": "raw_text"})
+        assert response.status_code == 400
+        assert response.json()["status"] == "error"
 
 
 class TestAdvancedStatsEndpoint:
@@ -77,13 +133,76 @@ class TestAdvancedStatsEndpoint:
         assert data["invoice_count"] == 0
         assert data["total_cost"] == 0
 
+    def test_advanced_stats_filters_and_monthly(self):
+        """Agrega por categoría y mes respetando los filtros"""
+        from backend.database import SessionLocal, Invoice
+        from datetime import datetime
+
+        db = SessionLocal()
+        try:
+            db.add_all([
+                Invoice(invoice_number="A1", date=datetime(2025, 1, 10), vendor_name="O2", category="Telecom",
+                        total_amount=40.0, consumption=20.0, consumption_unit="GB", file_path="a1.pdf"),
+                Invoice(invoice_number="A2", date=datetime(2025, 2, 10), vendor_name="O2", category="Telecom",
+                        total_amount=60.0, consumption=20.0, consumption_unit="GB", file_path="a2.pdf"),
+                Invoice(invoice_number="A3", date=datetime(2025, 2, 12), vendor_name="Som Energia",
+                        category=None, total_amount=100.0, file_path="a3.pdf"),
+            ])
+            db.commit()
+        finally:
+            db.close()
+
+        data = client.get("/advanced-stats").json()
+        assert data["invoice_count"] == 3
+        assert data["total_cost"] == 200.0
+        assert {d["name"]: d["percent"] for d in data["distribution"]} == {"Telecom": 50.0, "Other": 50.0}
+        assert data["efficiency"] == [{"category": "Telecom", "cost_per_unit": 2.5, "unit": "GB"}]
+        assert data["monthly"] == [
+            {"month": "2025-01", "count": 1, "total": 40.0},
+            {"month": "2025-02", "count": 2, "total": 160.0}
+        ]
+
+        filtered = client.get("/advanced-stats", params={"vendor": "O2", "date_from": "2025-02-01"}).json()
+        assert filtered["invoice_count"] == 1
+        assert filtered["total_cost"] == 60.0
+
 
 class TestWorkflowEndpoints:
     """Tests para los endpoints de workflows"""
     
     @patch('backend.main.validate_invoice')
     def test_workflow_validar_factura(self, mock_validate):
-        """Prueba el workflow de validación"""
+        """Prueba el workflow de validación (las reglas resuelven sin LLM)"""
+        response = client.post("/workflow/validar-factura", json={
+            "invoice_data": {
+                "invoice_number": "TEST123",
+                "total_amount": 100
+            }
+        })
+        
+        assert response.status_code == 200
+        data = response.json()
+        assert data["status"] == "REVISAR"
+        assert set(data["missing_fields"]) == {"vendor", "date"}
+        mock_validate.assert_not_called()
+
+    @patch('backend.main.validate_invoice')
+    def test_workflow_validar_factura_pools(self, mock_validate):
+        """Las reglas corren en el pool db; solo los casos ambiguos pasan al pool llm"""
+        from backend import main
+        mock_validate.return_value = json.dumps({"validacion": "OK"})
+        with patch('backend.main.run_in', wraps=main.run_in) as pools:
+            client.post("/workflow/validar-factura", json={"invoice_data": {"invoice_number": "TEST123"}})
+            assert [c.args[0] for c in pools.call_args_list] == ["db"]
+            pools.reset_mock()
+            client.post("/workflow/validar-factura", json={"invoice_data": {
+                "invoice_number": "TEST123", "vendor": "O2", "date": "2025-01-15", "total_amount": 100, "taxes": 30
+            }})
+            assert [c.args[0] for c in pools.call_args_list] == ["db", "llm"]
+
+    @patch('backend.main.validate_invoice')
+    def test_workflow_validar_factura_escalates_ambiguous(self, mock_validate):
+        """Prueba que los casos ambiguos se escalan al LLM"""
         mock_validate.return_value = json.dumps({
             "validacion": "OK",
             "errores_detectados": []
@@ -91,14 +210,15 @@ class TestWorkflowEndpoints:
         
         response = client.post("/workflow/validar-factura", json={
             "invoice_data": {
-                "invoice_number": "TEST123",
-                "total_amount": 100
+                "invoice_number": "TEST123", "vendor": "O2", "date": "2025-01-15",
+                "total_amount": 100, "taxes": 30
             }
         })
         
-        assert response.status_code == 200
         data = response.json()
         assert "validacion" in data
+        assert data["source"] == "rules+llm"
+        mock_validate.assert_called_once()
     
     @patch('backend.main.generate_kpis_direccion')
     def test_workflow_kpis_direccion(self, mock_kpis):
@@ -192,25 +312,14 @@ class TestWorkflowEndpoints:
 class TestUploadEndpoint:
     """Tests para el endpoint de carga de archivos"""
     
-    @patch('backend.main.extract_invoice_data')
-    @patch('backend.main.get_text_from_pdf')
+    @patch('backend.main.schedule_enrichment', new_callable=AsyncMock)
+    @patch('backend.main.save_and_extract_text')
     @patch('backend.main.os.path.exists')
-    def test_upload_pdf_success(self, mock_exists, mock_get_text, mock_extract):
-        """Prueba carga exitosa de PDF"""
+    def test_upload_pdf_success(self, mock_exists, mock_get_text, mock_enrich):
+        """Prueba carga exitosa de PDF: se guarda con regex y el LLM la completa después"""
         mock_exists.return_value = True  # File will be created
-        mock_get_text.return_value = "Factura de prueba O2"
-        
-        mock_extract.return_value = json.dumps({
-            "invoice_number": "TEST123",
-            "date": "2025-01-15",
-            "vendor_name": "O2",
-            "total_amount": 45.50,
-            "currency": "EUR",
-            "type": "Purchase",
-            "category": "Telecom",
-            "consumption": 100,
-            "consumption_unit": "GB"
-        })
+        mock_get_text.return_value = "Factura de prueba O2\nNº Factura: TEST123\nTotal: 45,50 €"
+        mock_enrich.return_value = "pending"
         
         # Crear un archivo de prueba
         file_content = b"PDF content"
@@ -220,7 +329,9 @@ class TestUploadEndpoint:
         
         assert response.status_code == 200
         data = response.json()
-        assert "message" in data or "status" in data
+        assert data["status"] == "success"
+        assert data["invoice"]["enrichment_status"] == "pending"
+        mock_enrich.assert_awaited_once_with(data["invoice"]["id"])
     
     def test_upload_no_file(self):
         """Prueba carga sin archivo"""
@@ -0,0 +1,71 @@
+import pytest
+import json
+from io import BytesIO
+from fastapi.testclient import TestClient
+
+from backend.bench.fake_llm import FakeLLMConfig, create_app
+from backend.bench.loadtest import percentile, synthetic_pdf, synthetic_invoice_text, LoadTest
+
+
+class TestFakeLLM:
+    """Tests para el servidor LLM falso (protocolo Ollama)"""
+
+    def setup_method(self):
+        self.client = TestClient(create_app(FakeLLMConfig(latency_ms=0, tokens_per_sec=0)))
+
+    def test_generate_json_format(self):
+        """Con format=json devuelve el JSON enlatado y métricas de tokens"""
+        response = self.client.post("/api/generate", json={"prompt": "Factura A", "format": "json", "stream": False})
+        assert response.status_code == 200
+        body = response.json()
+        data = json.loads(body["response"])
+        assert data["invoice_number"].startswith("FAKE-")
+        assert body["done"] is True
+        assert body["eval_count"] > 0
+
+    def test_generate_is_deterministic(self):
+        """El mismo prompt produce la misma respuesta; prompts distintos, facturas distintas"""
+        payload = {"prompt": "Factura A", "format": "json", "stream": False}
+        first = self.client.post("/api/generate", json=payload).json()["response"]
+        second = self.client.post("/api/generate", json=payload).json()["response"]
+        other = self.client.post("/api/generate", json={**payload, "prompt": "Factura B"}).json()["response"]
+        assert first == second
+        assert json.loads(first)["invoice_number"] != json.loads(other)["invoice_number"]
+
+    def test_generate_stream_ndjson(self):
+        """En modo streaming concatena fragmentos y termina con done=True"""
+        response = self.client.post("/api/generate", json={"prompt": "Hola"})
+        lines = [json.loads(l) for l in response.text.strip().split("\n")]
+        assert lines[-1]["done"] is True
+        assert "".join(l["response"] for l in lines).startswith("## KPIs")
+
+
+class TestLoadTestHelpers:
+    """Tests para las utilidades del generador de carga"""
+
+    def test_percentile_nearest_rank(self):
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50
+        assert percentile(values, 95) == 95
+        assert percentile(values, 99) == 99
+        assert percentile([], 99) == 0.0
+
+    def test_synthetic_pdf_is_readable(self):
+        """El PDF sintético se puede leer con pdfplumber"""
+        import pdfplumber
+        import random
+        text = synthetic_invoice_text(3, random.Random(3))
+        with pdfplumber.open(BytesIO(synthetic_pdf(text))) as pdf:
+            extracted = pdf.pages[0].extract_text()
+        assert "Importe total" in extracted
+
+    def test_report_aggregates_errors(self):
+        test = LoadTest("http://localhost")
+        test.samples = [("chat", "/chat", 0.1, True), ("chat", "/chat", 0.3, False)]
+        result = test.report(1.0)
+        assert result["scenarios"]["chat"]["error_rate"] == 0.5
+        assert result["scenarios"]["total"]["requests"] == 2
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
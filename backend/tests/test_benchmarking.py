@@ -0,0 +1,106 @@
+import pytest
+from datetime import datetime
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+
+from backend.main import app
+from backend.database import SessionLocal, Invoice
+from backend import benchmarking
+from backend.benchmarking import benchmark_table, compare_invoice
+
+client = TestClient(app)
+
+# (proveedor, [precio por kWh por mes])
+PRICES = [
+    ("Som Energia", [0.20, 0.20, 0.21, 0.22, 0.24, 0.26]),
+    ("Iberdrola", [0.15, 0.15, 0.16, 0.15]),
+    ("Endesa", [0.30]),
+]
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    for vendor, prices in PRICES:
+        for month, price in enumerate(prices, start=1):
+            session.add(Invoice(invoice_number=f"{vendor[:3]}{month}", vendor_name=vendor, category="Electricity",
+                                date=datetime(2025, month, 1), total_amount=round(price * 100, 2), consumption=100.0,
+                                consumption_unit="kWh", file_path=f"{vendor}{month}.pdf"))
+    session.add(Invoice(invoice_number="W1", vendor_name="Canal", category="Water", date=datetime(2025, 1, 1),
+                        total_amount=30.0, consumption=10.0, consumption_unit="m3", file_path="w1.pdf"))
+    session.commit()
+    benchmarking._cache = benchmarking.BenchmarkCache()
+    yield session
+    session.close()
+
+
+class TestBenchmarkTable:
+    """Tests para la distribución de coste por unidad"""
+
+    def test_distribution_and_trend(self, db):
+        table = {r["vendor"]: r for r in benchmark_table(db, "Electricity")}
+        assert set(table) == {"Som Energia", "Iberdrola", "Endesa"}
+        som = table["Som Energia"]
+        assert som["invoices"] == 6
+        assert som["median"] == pytest.approx(0.215)
+        assert som["last"] == pytest.approx(0.26)
+        assert som["trend_pct"] > 10
+        assert table["Iberdrola"]["trend_pct"] is None
+        assert benchmark_table(db)[0]["category"] == "Electricity"
+
+    def test_incremental_refresh(self, db):
+        benchmark_table(db)
+        db.add(Invoice(invoice_number="Ibe5", vendor_name="Iberdrola", category="Electricity",
+                       date=datetime(2025, 5, 1), total_amount=15.0, consumption=100.0, consumption_unit="kWh",
+                       file_path="ibe5.pdf"))
+        db.commit()
+        with patch.object(benchmarking, "BenchmarkCache", wraps=benchmarking.BenchmarkCache) as rebuilt:
+            table = {r["vendor"]: r for r in benchmark_table(db, "Electricity")}
+            rebuilt.assert_not_called()
+        assert table["Iberdrola"]["invoices"] == 5
+
+    def test_rebuild_after_delete(self, db):
+        benchmark_table(db)
+        db.query(Invoice).filter_by(vendor_name="Endesa").delete()
+        db.commit()
+        assert "Endesa" not in {r["vendor"] for r in benchmark_table(db, "Electricity")}
+
+    def test_rebuild_after_vendor_or_category_change(self, db):
+        """Un cambio que no toca importes ni consumos (p. ej. el completado del LLM) también invalida la caché"""
+        benchmark_table(db)
+        invoice = db.query(Invoice).filter_by(invoice_number="End1").one()
+        invoice.vendor_name = "Naturgy"
+        db.commit()
+        vendors = {r["vendor"] for r in benchmark_table(db, "Electricity")}
+        assert "Naturgy" in vendors and "Endesa" not in vendors
+
+
+class TestCompareInvoice:
+    """Tests para la comparación de una factura"""
+
+    def test_best_alternative_and_saving(self, db):
+        result = compare_invoice(db, "Som Energia", "Electricity", "kWh", total=26.0, consumption=100.0)
+        assert result["current"]["price_per_unit"] == 0.26
+        # Endesa solo tiene una factura: no cuenta como alternativa
+        assert result["best_alternative"]["vendor"] == "Iberdrola"
+        assert result["potential_saving"] == pytest.approx(11.0)
+        assert result["current"]["percentile_in_category"] == pytest.approx(66.7)
+
+    @patch('backend.main.compare_supplier')
+    def test_workflow_receives_benchmark(self, mock_compare, db):
+        mock_compare.return_value = "## COMPARATIVA DE PRECIOS"
+        invoice_id = db.query(Invoice.id).filter_by(invoice_number="Som6").scalar()
+        client.post("/workflow/comparar-proveedor", json={"invoice_id": invoice_id})
+        kwargs = mock_compare.call_args.kwargs
+        assert kwargs["alternative_supplier"]["vendor"] == "Iberdrola"
+        assert len(kwargs["benchmark"]) == 3
+        assert mock_compare.call_args.args[0]["price_per_unit"] == 0.26
+
+    def test_benchmarks_endpoint(self, db):
+        data = client.get("/benchmarks", params={"category": "Water"}).json()
+        assert data["count"] == 1
+        assert data["benchmarks"][0]["median"] == 3.0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
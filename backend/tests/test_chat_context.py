@@ -0,0 +1,92 @@
+import pytest
+from datetime import datetime
+
+from backend.database import SessionLocal, Invoice
+from backend import chat_context
+from backend.chat_context import build_chat_context, vendor_rollups, month_rollups, estimate_tokens
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    vendors = [("Som Energia", "Electricity", "kWh"), ("O2", "Telecom", "GB"), ("Canal Agua", "Water", "m3")]
+    for i in range(60):
+        vendor, category, unit = vendors[i % 3]
+        session.add(Invoice(
+            invoice_number=f"C-{i}", vendor_name=vendor, category=category,
+            date=datetime(2024, i % 12 + 1, 5), total_amount=10.0 + i, consumption=float(i), consumption_unit=unit,
+            currency="EUR", file_path=f"c{i}.pdf",
+            raw_text=f"Factura {vendor} número C-{i}\nTérmino de potencia contratada\nTotal {10 + i} EUR\n"
+        ))
+    session.commit()
+    yield session
+    session.close()
+
+
+class TestRollups:
+    """Tests para los agregados por proveedor y mes"""
+
+    def test_vendor_rollups(self, db):
+        rows = {r["vendor"]: r for r in vendor_rollups(db)}
+        assert rows["Som Energia"]["count"] == 20
+        assert rows["Som Energia"]["min"] == 10.0
+        assert rows["Som Energia"]["max"] == 67.0
+        assert rows["O2"]["consumption"] == {"GB": sum(float(i) for i in range(1, 60, 3))}
+
+    def test_month_rollups_newest_first(self, db):
+        rows = month_rollups(db)
+        assert rows[0]["month"] == "2024-12"
+        assert sum(r["count"] for r in rows) == 60
+
+
+class TestBuildChatContext:
+    """Tests para el contexto del chat con presupuesto de tokens"""
+
+    def test_broad_question_uses_rollups(self, db):
+        context, stats = build_chat_context(db, "resumen general del año")
+        assert stats["mode"] == "rollup"
+        assert "POR PROVEEDOR" in context
+        assert "=== FACTURA ID" not in context
+
+    def test_broad_question_with_common_words_uses_rollups(self, db):
+        """Palabras que aparecen en todas las facturas no acotan la pregunta"""
+        for question in ("¿Cuál es el gasto total de las facturas?", "factura total potencia contratada"):
+            context, stats = build_chat_context(db, question)
+            assert stats["mode"] == "rollup"
+            assert "POR PROVEEDOR" in context
+
+    def test_invoice_number_narrows(self, db):
+        context, stats = build_chat_context(db, "número C-45")
+        assert stats["narrowed"] is True
+        assert "Nº Factura: C-45" in context
+
+    def test_narrow_question_expands_invoices(self, db):
+        context, stats = build_chat_context(db, "facturas de O2")
+        assert stats["mode"] == "detail"
+        assert stats["narrowed"] is True
+        assert "Proveedor: O2" in context
+        assert "Proveedor: Som Energia" not in context
+
+    def test_context_stays_within_budget(self, db):
+        for max_tokens in (200, 800):
+            context, stats = build_chat_context(db, "resumen general", max_tokens=max_tokens)
+            assert estimate_tokens(context) <= max_tokens
+            context, stats = build_chat_context(db, "potencia Som Energia", max_tokens=max_tokens)
+            assert estimate_tokens(context) <= max_tokens
+
+    def test_small_archive_expands_everything(self, db, monkeypatch):
+        monkeypatch.setattr(chat_context, "CHAT_EXPAND_MAX", 100)
+        context, stats = build_chat_context(db, "resumen general", max_tokens=100000)
+        assert stats["mode"] == "detail"
+        assert stats["invoices_shown"] == 60
+
+    def test_empty_archive(self):
+        session = SessionLocal()
+        try:
+            assert build_chat_context(session, "hola")[0] == ""
+        finally:
+            session.close()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,80 @@
+import pytest
+import zlib
+from sqlalchemy import text
+
+from backend.database import SessionLocal, Invoice, ExtractionLog, Document, content_hash
+from backend.documents import prune_documents
+
+TEXT = "FACTURA Som Energia\nConsumo 300 kWh\nTotal 80,00 EUR\n" * 20
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    yield session
+    session.close()
+
+
+class TestDocumentStorage:
+    """Tests para el texto de los documentos en la tabla documents"""
+
+    def test_invoice_row_has_no_text_column(self):
+        """La fila de invoices solo guarda el hash del documento"""
+        columns = {c.name for c in Invoice.__table__.columns}
+        assert "raw_text" not in columns and "document_hash" in columns
+
+    def test_text_is_compressed_and_deduplicated(self, db):
+        """El mismo texto (factura y su log) se guarda una vez y comprimido"""
+        db.add_all([
+            Invoice(invoice_number="F1", raw_text=TEXT),
+            Invoice(invoice_number="F2", raw_text=TEXT),
+            ExtractionLog(file_name="f1.pdf", raw_text=TEXT),
+        ])
+        db.commit()
+        assert db.query(Document).count() == 1
+        stored = db.execute(text("SELECT content, size FROM documents")).one()
+        assert len(stored.content) < len(TEXT) / 4
+        assert zlib.decompress(stored.content).decode("utf-8") == TEXT
+        assert stored.size == len(TEXT)
+
+    def test_text_is_loaded_on_demand(self, db):
+        """Los listados no cargan el texto; se lee al acceder a raw_text o proyectarlo"""
+        db.add(Invoice(invoice_number="F1", raw_text=TEXT))
+        db.commit()
+        db.expire_all()
+        invoice = db.query(Invoice).one()
+        assert "document" not in invoice.__dict__
+        assert invoice.document_hash == content_hash(TEXT)
+        assert invoice.raw_text == TEXT
+        assert db.query(Invoice.raw_text).scalar() == TEXT
+
+    def test_unused_documents_are_released(self, db):
+        """Al borrar o cambiar el texto se elimina el documento si nadie más lo usa"""
+        first, second = Invoice(invoice_number="F1", raw_text=TEXT), Invoice(invoice_number="F2", raw_text=TEXT)
+        db.add_all([first, second])
+        db.commit()
+
+        db.delete(first)
+        db.commit()
+        assert db.query(Document).count() == 1
+
+        second.raw_text = "otro texto"
+        db.commit()
+        assert [d.content for d in db.query(Document)] == ["otro texto"]
+
+        second.raw_text = None
+        db.commit()
+        assert db.query(Document).count() == 0
+
+    def test_prune_documents(self, db):
+        """prune_documents borra los documentos que quedaron sin referencias"""
+        db.add(Invoice(invoice_number="F1", raw_text=TEXT))
+        db.commit()
+        db.execute(text("DELETE FROM invoices"))
+        db.commit()
+        assert prune_documents(db) == 1
+        assert db.query(Document).count() == 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
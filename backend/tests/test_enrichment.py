@@ -0,0 +1,136 @@
+import pytest
+import asyncio
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from backend.database import SessionLocal, Invoice, ExtractionLog
+from backend import enrichment
+from backend.enrichment import enrich_invoice, schedule_enrichment, retry_enrichment, enrichment_stats
+from backend.ingestion import save_regex_invoice
+
+TEXT = "Factura Som Energia\nNº Factura: SE-2025-001\nTotal: 61,20 €\nConsumo: 150 kWh"
+LLM_DATA = {
+    "invoice_number": "OTRO-1", "vendor_name": "Som Energia", "total_amount": 99.0,
+    "date": "2025-03-01", "consumption": 150.0, "consumption_unit": "kWh",
+    "period": "01/02/2025 - 28/02/2025", "taxes": 10.62,
+}
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    yield session
+    session.close()
+
+
+def _regex_invoice(db, text=TEXT, file_path="/tmp/f.pdf"):
+    with patch("backend.ingestion.os.remove"):
+        result = save_regex_invoice(db, text, file_path)
+    assert result["status"] == "success"
+    return result["invoice"]["id"]
+
+
+class TestRegexPhase:
+    """Tests para la fase 1 (guardado solo con regex)"""
+
+    def test_saved_pending_without_llm(self, db):
+        """La factura queda guardada al momento con lo que encuentra la regex"""
+        with patch("backend.ai_service.call_ai_service") as llm:
+            invoice_id = _regex_invoice(db)
+        llm.assert_not_called()
+        invoice = db.get(Invoice, invoice_id)
+        assert invoice.enrichment_status == "pending"
+        assert invoice.invoice_number == "SE-2025-001"
+        assert invoice.raw_text == TEXT
+
+
+class TestEnrichment:
+    """Tests para el completado con el LLM"""
+
+    def test_fills_gaps_without_overwriting_regex(self, db):
+        """El LLM añade consumo, periodo e impuestos; lo encontrado por regex se conserva"""
+        invoice_id = _regex_invoice(db)
+        with patch("backend.enrichment.llm_extract", return_value=LLM_DATA):
+            assert enrich_invoice(invoice_id) == "done"
+        db.expire_all()
+        invoice = db.get(Invoice, invoice_id)
+        assert invoice.enrichment_status == "done"
+        assert invoice.invoice_number == "SE-2025-001"  # regex
+        assert (invoice.vendor_name, invoice.total_amount) == ("Som Energia", 99.0)  # no los encontró la regex
+        assert (invoice.period, invoice.taxes) == ("01/02/2025 - 28/02/2025", 10.62)
+        assert db.query(ExtractionLog).count() == 1
+
+    def test_runs_once(self, db):
+        """Una factura ya completada no se vuelve a mandar al LLM"""
+        invoice_id = _regex_invoice(db)
+        with patch("backend.enrichment.llm_extract", return_value=LLM_DATA) as llm:
+            enrich_invoice(invoice_id)
+            assert enrich_invoice(invoice_id) is None
+        assert llm.call_count == 1
+
+    def test_duplicate_number_is_ignored(self, db):
+        """Si el LLM propone un nº que ya tiene otra factura, no se asigna"""
+        db.add(Invoice(invoice_number="OTRO-1", vendor_name="X"))
+        db.commit()
+        invoice_id = _regex_invoice(db, "Factura sin número reconocible")
+        with patch("backend.enrichment.llm_extract", return_value=LLM_DATA):
+            enrich_invoice(invoice_id)
+        db.expire_all()
+        assert db.get(Invoice, invoice_id).invoice_number == "unknown"
+
+    def test_llm_failure_then_retry(self, db):
+        """Si el LLM falla la factura queda failed con los datos de regex y se puede reintentar"""
+        invoice_id = _regex_invoice(db)
+        with patch("backend.enrichment.llm_extract", side_effect=TimeoutError("180s")):
+            assert enrich_invoice(invoice_id) == "failed"
+        with patch("backend.enrichment.llm_extract", return_value=LLM_DATA):
+            assert retry_enrichment(db) == 1
+        db.expire_all()
+        assert db.get(Invoice, invoice_id).enrichment_status == "done"
+
+    def test_abandoned_running_is_reclaimed(self, db):
+        """Una factura en running de un proceso caído se recupera pasado el plazo; una reciente no"""
+        invoice_id = _regex_invoice(db)
+        assert enrichment._claim(db, invoice_id)  # El proceso muere sin terminar
+        with patch("backend.enrichment.llm_extract", return_value=LLM_DATA) as llm:
+            assert enrich_invoice(invoice_id) is None
+            assert retry_enrichment(db) == 0
+            llm.assert_not_called()
+
+            invoice = db.get(Invoice, invoice_id)
+            invoice.enrichment_claimed_at = datetime.now() - timedelta(seconds=enrichment.ENRICH_LEASE_SECONDS + 1)
+            db.commit()
+            assert retry_enrichment(db) == 1
+        db.expire_all()
+        assert db.get(Invoice, invoice_id).enrichment_status == "done"
+
+
+class TestScheduling:
+    """Tests para el completado en segundo plano y la degradación con sobrecarga"""
+
+    def test_background_enrichment(self, db):
+        """schedule_enrichment responde al momento y el completado sigue en el pool enrich"""
+        invoice_id = _regex_invoice(db)
+
+        async def scenario():
+            status = await schedule_enrichment(invoice_id)
+            await asyncio.gather(*enrichment._background)
+            return status
+
+        with patch("backend.enrichment.llm_extract", return_value=LLM_DATA):
+            assert asyncio.run(scenario()) == "pending"
+        db.expire_all()
+        assert db.get(Invoice, invoice_id).enrichment_status == "done"
+
+    def test_overload_degrades_to_regex(self, db):
+        """Con la cola llena la factura se queda solo con regex, sin esperar al modelo"""
+        invoice_id = _regex_invoice(db)
+        with patch.object(enrichment, "ENRICH_MAX_BACKLOG", 0):
+            assert asyncio.run(schedule_enrichment(invoice_id)) == "skipped"
+        db.expire_all()
+        assert db.get(Invoice, invoice_id).enrichment_status == "skipped"
+        assert enrichment_stats(db)["skipped"] == 1
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,80 @@
+import pytest
+import asyncio
+import threading
+import time
+from fastapi import Depends, FastAPI
+from fastapi.testclient import TestClient
+
+from backend import executors
+from backend.executors import offload, run_in, pool_stats
+from backend.main import app
+from backend.bench.concurrency import summarize
+
+
+def _thread_name():
+    return threading.current_thread().name
+
+
+class TestExecutors:
+    """Tests para los pools acotados de trabajo bloqueante"""
+
+    def test_run_in_uses_named_pool(self):
+        """Cada tipo de trabajo se ejecuta en los hilos de su pool"""
+        assert asyncio.run(run_in("db", _thread_name)).startswith("db-pool")
+        assert asyncio.run(run_in("llm", _thread_name)).startswith("llm-pool")
+
+    def test_unknown_pool(self):
+        """Un nombre de pool desconocido falla al decorar"""
+        with pytest.raises(ValueError):
+            offload("gpu")
+
+    def test_blocking_work_does_not_freeze_event_loop(self):
+        """Mientras un trabajo bloqueante duerme en el pool, el bucle sigue atendiendo"""
+        async def scenario():
+            slow = asyncio.ensure_future(run_in("llm", time.sleep, 0.3))
+            await asyncio.sleep(0)
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lag = time.perf_counter() - started
+            await slow
+            return lag
+
+        assert asyncio.run(scenario()) < 0.1
+
+    def test_offload_keeps_fastapi_signature(self):
+        """El endpoint decorado conserva parámetros y dependencias"""
+        demo = FastAPI()
+
+        def get_value():
+            return 40
+
+        @demo.get("/sum")
+        @offload("db")
+        def add(extra: int, value: int = Depends(get_value)):
+            return {"total": value + extra, "thread": _thread_name()}
+
+        body = TestClient(demo).get("/sum?extra=2").json()
+        assert body["total"] == 42
+        assert body["thread"].startswith("db-pool")
+
+    def test_pool_sizes_in_stats(self):
+        """/admin/extraction-stats informa del tamaño y la carga de cada pool"""
+        stats = TestClient(app).get("/admin/extraction-stats").json()["pools"]
+        assert set(stats) == set(executors.POOL_SIZES)
+        assert stats["llm"]["max_workers"] == executors.POOL_SIZES["llm"]
+        assert pool_stats()["db"]["in_flight"] == 0
+
+
+class TestConcurrencyBench:
+    """Tests para el informe del benchmark de concurrencia"""
+
+    def test_summarize(self):
+        """Percentiles y máximo de las latencias del health check"""
+        summary = summarize([0.2, 0.4, 0.3, 5.0])
+        assert summary["samples"] == 4
+        assert summary["p50_ms"] == 0.3
+        assert summary["max_ms"] == 5.0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
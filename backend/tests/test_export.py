@@ -0,0 +1,92 @@
+import pytest
+import csv
+import io
+from datetime import datetime, date
+from fastapi.testclient import TestClient
+
+from backend.main import app
+from backend.database import SessionLocal, Invoice
+from backend.export import stream_csv
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def invoices():
+    db = SessionLocal()
+    try:
+        for i in range(25):
+            db.add(Invoice(
+                invoice_number=f"E{i:03d}", date=datetime(2025, i % 4 + 1, 3), vendor_name="Iberdrola" if i % 2 else "O2",
+                category="Electricity" if i % 2 else "Telecom", total_amount=10.0 * i, currency="EUR",
+                consumption=float(i), consumption_unit="kWh" if i % 2 else "GB", file_path=f"e{i}.pdf",
+                raw_text=f"Factura E{i:03d}, señal ñ"
+            ))
+        db.commit()
+    finally:
+        db.close()
+
+
+class TestExportCSV:
+    """Tests para la exportación CSV"""
+
+    def test_export_csv_all_rows(self, invoices):
+        response = client.get("/export", params={"format": "csv"})
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+        assert "attachment" in response.headers["content-disposition"]
+        rows = list(csv.DictReader(io.StringIO(response.content.decode("utf-8-sig"))))
+        assert len(rows) == 25
+        assert "raw_text" not in rows[0]
+        assert rows[0]["invoice_number"] == "E000"
+
+    def test_export_csv_filters_and_fields(self, invoices):
+        response = client.get("/export", params={
+            "vendor": "iberdrola", "date_from": "2025-02-01", "date_to": "2025-02-28",
+            "fields": "invoice_number,total_amount,raw_text"
+        })
+        rows = list(csv.DictReader(io.StringIO(response.content.decode("utf-8-sig"))))
+        assert rows and all(r["invoice_number"] in {"E001", "E005", "E009", "E013", "E017", "E021"} for r in rows)
+        assert rows[0]["raw_text"].endswith("ñ")
+
+    def test_stream_csv_emits_batches(self):
+        class Row:
+            def __init__(self, i):
+                self.id, self.date = i, date(2025, 1, 1)
+        chunks = list(stream_csv((Row(i) for i in range(10)), ["id", "date"], batch_rows=3))
+        assert len(chunks) == 4
+        assert b"".join(chunks).decode("utf-8-sig").splitlines()[1] == "0,2025-01-01"
+
+    def test_export_invalid_format(self):
+        response = client.get("/export", params={"format": "xlsx"})
+        assert response.status_code == 400
+
+
+class TestExportParquet:
+    """Tests para la exportación Parquet"""
+
+    def test_export_parquet(self, invoices):
+        pq = pytest.importorskip("pyarrow.parquet")
+        response = client.get("/export", params={"format": "parquet", "category": "Telecom"})
+        assert response.status_code == 200
+        table = pq.read_table(io.BytesIO(response.content))
+        assert table.num_rows == 13
+        assert str(table.schema.field("date").type) == "date32[day]"
+        assert table.column("total_amount").to_pylist()[1] == 20.0
+
+    def test_parquet_row_groups(self, invoices):
+        pq = pytest.importorskip("pyarrow.parquet")
+        from backend.export import stream_parquet
+        db = SessionLocal()
+        try:
+            rows = db.query(Invoice.id, Invoice.total_amount).order_by(Invoice.id).yield_per(5)
+            data = b"".join(stream_parquet(rows, ["id", "total_amount"], row_group=10))
+        finally:
+            db.close()
+        parquet_file = pq.ParquetFile(io.BytesIO(data))
+        assert parquet_file.metadata.num_row_groups == 3
+        assert parquet_file.metadata.num_rows == 25
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,123 @@
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+
+from backend.main import app
+from backend.database import SessionLocal, ExtractionLog, Document
+from backend import extraction_logs
+from backend.extraction_logs import record_extraction, purge_logs, compact_logs, top_scores
+
+client = TestClient(app)
+
+SCORES = [{"provider": f"P{i}", "score": i, "matches": [f"m{i}"]} for i in range(10)]
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    yield session
+    session.close()
+
+
+def _add_logs(db, n, age_days=0):
+    when = datetime.now() - timedelta(days=age_days)
+    for i in range(n):
+        db.add(ExtractionLog(file_name=f"f{i}.pdf", raw_text=f"texto {i} {age_days}", timestamp=when,
+                             matching_scores=SCORES, final_json={"invoice_number": f"N{i}"}))
+    db.commit()
+
+
+class TestCompaction:
+    """Tests para la compactación de puntuaciones"""
+
+    def test_top_scores(self):
+        """Solo se conservan las k mejores puntuaciones, de mayor a menor"""
+        assert [s["provider"] for s in top_scores(SCORES, 3)] == ["P9", "P8", "P7"]
+        assert top_scores(None) == []
+
+    def test_record_extraction_keeps_top_scores(self, db):
+        """El log nuevo guarda solo las LOG_TOP_SCORES mejores puntuaciones"""
+        log = record_extraction(db, "f.pdf", "texto", SCORES, {"invoice_number": "N1"})
+        assert len(log.matching_scores) == extraction_logs.LOG_TOP_SCORES
+        assert log.matching_scores[0]["provider"] == "P9"
+
+    def test_compact_existing_logs(self, db):
+        """compact_logs recorta los logs guardados antes de la compactación"""
+        _add_logs(db, 3)
+        assert compact_logs(db, k=2) == 3
+        db.expire_all()
+        assert all(len(log.matching_scores) == 2 for log in db.query(ExtractionLog))
+        assert compact_logs(db, k=2) == 0
+
+
+class TestRetention:
+    """Tests para la retención de logs"""
+
+    def test_purge_by_age(self, db):
+        """Se borran los logs más antiguos que la retención y sus textos"""
+        _add_logs(db, 3, age_days=60)
+        _add_logs(db, 2)
+        assert purge_logs(db, max_age_days=30, max_rows=0) == 3
+        assert db.query(ExtractionLog).count() == 2
+        assert db.query(Document).count() == 2
+
+    def test_purge_by_count_keeps_newest(self, db):
+        """Con más de max_rows logs se conservan los más recientes"""
+        _add_logs(db, 7)
+        assert purge_logs(db, max_age_days=0, max_rows=3, batch=2) == 4
+        assert [log.file_name for log in db.query(ExtractionLog).order_by(ExtractionLog.id)] == \
+            ["f4.pdf", "f5.pdf", "f6.pdf"]
+
+    def test_purge_runs_automatically(self, db):
+        """Cada LOG_PURGE_EVERY logs se aplica la retención al guardar"""
+        with patch.object(extraction_logs, "LOG_PURGE_EVERY", 5), patch.object(extraction_logs, "LOG_MAX_ROWS", 2):
+            for i in range(5):
+                record_extraction(db, f"f{i}.pdf", f"texto {i}", SCORES, {})
+        assert db.query(ExtractionLog).count() == 2
+
+
+class TestAdminLogsEndpoints:
+    """Tests para /admin/logs"""
+
+    def test_list_is_paginated_summary(self, db):
+        """El listado devuelve resúmenes sin texto, paginados por cursor"""
+        _add_logs(db, 5)
+        response = client.get("/admin/logs?limit=2")
+        data = response.json()
+        assert data["status"] == "success"
+        assert [log["file_name"] for log in data["logs"]] == ["f4.pdf", "f3.pdf"]
+        assert "raw_text" not in data["logs"][0] and "matching_scores" not in data["logs"][0]
+        assert data["logs"][0]["provider"] == "P9" and data["logs"][0]["invoice_number"] == "N4"
+
+        seen = [log["file_name"] for log in data["logs"]]
+        cursor = data["next_cursor"]
+        while cursor:
+            data = client.get(f"/admin/logs?limit=2&after={cursor}").json()
+            seen += [log["file_name"] for log in data["logs"]]
+            cursor = data["next_cursor"]
+        assert seen == ["f4.pdf", "f3.pdf", "f2.pdf", "f1.pdf", "f0.pdf"]
+
+    def test_bad_cursor(self):
+        """Un cursor no válido devuelve 400"""
+        assert client.get("/admin/logs?after=xx").status_code == 400
+
+    def test_detail(self, db):
+        """El detalle incluye puntuaciones, JSON final y texto"""
+        _add_logs(db, 1)
+        log_id = db.query(ExtractionLog.id).scalar()
+        data = client.get(f"/admin/logs/{log_id}").json()
+        assert data["log"]["raw_text"] == "texto 0 0"
+        assert len(data["log"]["matching_scores"]) == len(SCORES)
+        assert client.get("/admin/logs/9999").json()["status"] == "error"
+
+    def test_purge_endpoint(self, db):
+        """POST /admin/logs/purge aplica retención y compactación"""
+        _add_logs(db, 2, age_days=400)
+        _add_logs(db, 1)
+        data = client.post("/admin/logs/purge").json()
+        assert data == {"status": "success", "deleted": 2, "compacted": 1}
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
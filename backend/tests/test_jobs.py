@@ -0,0 +1,192 @@
+import pytest
+import threading
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+
+from backend.main import app
+from backend.database import SessionLocal, ExtractionJob, Invoice
+from backend import jobs, worker
+from backend.jobs import enqueue_job, claim_job, heartbeat, complete_job, fail_job, expire_jobs, job_stats
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    yield session
+    session.close()
+
+
+def _expire_lease(db, job_id):
+    db.query(ExtractionJob).filter(ExtractionJob.id == job_id).update(
+        {ExtractionJob.locked_until: datetime.now() - timedelta(seconds=1)}
+    )
+    db.commit()
+
+
+class TestJobQueue:
+    """Tests para el reclamo de trabajos, latidos y reintentos"""
+
+    def test_claim_in_order_once(self, db):
+        """Cada trabajo se reclama una sola vez, en orden de llegada"""
+        first = enqueue_job(db, "/tmp/a.pdf")
+        second = enqueue_job(db, "/tmp/b.pdf")
+        claimed = claim_job(db, "w1")
+        assert claimed.id == first.id and claimed.status == "running" and claimed.attempts == 1
+        assert claim_job(db, "w2").id == second.id
+        assert claim_job(db, "w3") is None
+
+    def test_concurrent_workers_never_share_a_job(self):
+        """Varios workers a la vez reclaman trabajos distintos"""
+        session = SessionLocal()
+        for i in range(20):
+            enqueue_job(session, f"/tmp/f{i}.pdf")
+        session.close()
+
+        claimed, lock = [], threading.Lock()
+
+        def work(worker_id):
+            own = SessionLocal()
+            try:
+                while True:
+                    try:
+                        job = claim_job(own, worker_id)
+                    except Exception:  # SQLite: "database is locked" con varios escritores
+                        own.rollback()
+                        continue
+                    if job is None:
+                        return
+                    with lock:
+                        claimed.append(job.id)
+            finally:
+                own.close()
+
+        threads = [threading.Thread(target=work, args=(f"w{i}",)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert sorted(claimed) == sorted(set(claimed)) and len(claimed) == 20
+
+    def test_visibility_timeout_and_heartbeat(self, db):
+        """Al vencer el plazo sin latido otro worker retoma el trabajo y el primero lo pierde"""
+        job = enqueue_job(db, "/tmp/a.pdf")
+        claim_job(db, "w1")
+        assert heartbeat(db, job.id, "w1")
+        assert claim_job(db, "w2") is None
+
+        _expire_lease(db, job.id)
+        retaken = claim_job(db, "w2")
+        assert retaken.id == job.id and retaken.worker_id == "w2" and retaken.attempts == 2
+        assert not heartbeat(db, job.id, "w1")
+        assert not complete_job(db, job.id, "w1", {"status": "success"})
+        assert complete_job(db, job.id, "w2", {"status": "success", "raw_text": "x", "invoice": {"id": 7}})
+        db.expire_all()
+        done = db.get(ExtractionJob, job.id)
+        assert done.status == "done" and done.invoice_id == 7 and "raw_text" not in done.result
+
+    def test_retries_with_backoff_then_failed(self, db):
+        """Un error devuelve el trabajo a pending con espera; agotados los intentos queda failed"""
+        job = enqueue_job(db, "/tmp/a.pdf", max_attempts=2)
+        claim_job(db, "w1")
+        assert fail_job(db, job.id, "w1", "LLM caído") == "pending"
+        assert claim_job(db, "w1") is None  # todavía en espera
+
+        db.query(ExtractionJob).update({ExtractionJob.available_at: datetime.now()})
+        db.commit()
+        claim_job(db, "w1")
+        assert fail_job(db, job.id, "w1", "LLM caído") == "failed"
+        assert job_stats(db) == {"pending": 0, "running": 0, "done": 0, "failed": 1}
+
+    def test_expired_without_attempts_left(self, db):
+        """Un trabajo abandonado sin intentos restantes se marca failed"""
+        job = enqueue_job(db, "/tmp/a.pdf", max_attempts=1)
+        claim_job(db, "w1")
+        _expire_lease(db, job.id)
+        assert claim_job(db, "w2") is None
+        assert expire_jobs(db) == 1
+        db.expire_all()
+        assert db.get(ExtractionJob, job.id).status == "failed"
+
+
+class TestWorker:
+    """Tests para el worker de extracción"""
+
+    def test_run_once_processes_job(self, db, tmp_path):
+        """El worker ejecuta el pipeline y guarda el resultado"""
+        pdf = tmp_path / "f.pdf"
+        pdf.write_bytes(b"%PDF")
+        job = enqueue_job(db, str(pdf))
+        result = {"status": "success", "invoice": {"id": 3}}
+        with patch("backend.worker.process_file", return_value=result) as process:
+            assert worker.run_once("w1")
+        process.assert_called_once()
+        assert not worker.run_once("w1")
+        db.expire_all()
+        assert db.get(ExtractionJob, job.id).status == "done"
+
+    def test_pipeline_error_is_retried(self, db, tmp_path):
+        """Una excepción del pipeline deja el trabajo para reintentar"""
+        pdf = tmp_path / "f.pdf"
+        pdf.write_bytes(b"%PDF")
+        job = enqueue_job(db, str(pdf))
+        with patch("backend.worker.process_file", side_effect=RuntimeError("timeout")):
+            worker.run_once("w1")
+        db.expire_all()
+        failed = db.get(ExtractionJob, job.id)
+        assert failed.status == "pending" and failed.last_error == "timeout"
+
+    def test_transient_db_error_is_retried(self, db, tmp_path):
+        """Un fallo pasajero de la base de datos al guardar vuelve a pending; una duplicada es definitiva"""
+        from sqlalchemy.exc import OperationalError
+        pdf = tmp_path / "f.pdf"
+        pdf.write_bytes(b"%PDF")
+        job = enqueue_job(db, str(pdf))
+        lost = OperationalError("INSERT", {}, Exception("server closed the connection"))
+        with patch("backend.ingestion.extract_text", return_value="Factura O2"), \
+                patch("backend.ingestion.extract_invoice_data", return_value='{"invoice_number": "J-1"}'), \
+                patch("backend.ingestion.rescue_with_regex", side_effect=lost):
+            worker.run_once("w1")
+        db.expire_all()
+        retried = db.get(ExtractionJob, job.id)
+        assert retried.status == "pending" and "server closed" in retried.last_error
+
+        db.add(Invoice(invoice_number="J-1", vendor_name="O2"))
+        db.query(ExtractionJob).update({ExtractionJob.available_at: datetime.now()})
+        db.commit()
+        with patch("backend.ingestion.extract_text", return_value="Factura O2"), \
+                patch("backend.ingestion.extract_invoice_data", return_value='{"invoice_number": "J-1"}'):
+            worker.run_once("w1")
+        db.expire_all()
+        rejected = db.get(ExtractionJob, job.id)
+        assert rejected.status == "failed" and rejected.result["reason"] == "duplicate"
+
+    def test_missing_file_fails_without_retry(self, db):
+        """Si el fichero no existe no tiene sentido reintentar"""
+        job = enqueue_job(db, "/tmp/no_existe_123.pdf")
+        worker.run_once("w1")
+        db.expire_all()
+        assert db.get(ExtractionJob, job.id).status == "failed"
+
+
+class TestJobsEndpoints:
+    """Tests para /jobs"""
+
+    def test_enqueue_and_status(self, db):
+        """POST /jobs guarda el fichero y encola; GET /jobs/{id} devuelve el estado"""
+        data = client.post("/jobs", files={"file": ("f.pdf", b"%PDF", "application/pdf")}).json()
+        again = client.post("/jobs", files={"file": ("f.pdf", b"%PDF", "application/pdf")}).json()
+        assert data["status"] == "success" and data["job"]["status"] == "pending"
+        assert again["job"]["id"] == data["job"]["id"]  # ya estaba en cola
+        with open(db.get(ExtractionJob, data["job"]["id"]).file_path, "rb") as f:
+            assert f.read() == b"%PDF"
+
+        assert client.get(f"/jobs/{data['job']['id']}").json()["job"]["file_name"] == "f.pdf"
+        assert client.get("/jobs/9999").json()["status"] == "error"
+        assert client.get("/admin/jobs").json()["jobs"]["pending"] == 1
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
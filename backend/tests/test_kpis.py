@@ -0,0 +1,78 @@
+import pytest
+import json
+from unittest.mock import patch
+
+from backend.kpis import compute_kpis, normalize_record
+from backend.ai_service import generate_kpis_direccion
+
+
+def _invoices(count):
+    vendors = [("Som Energia", "Electricity", "kWh"), ("O2", "Telecom", None), ("Canal", "Water", "m3")]
+    rows = []
+    for i in range(count):
+        vendor, category, unit = vendors[i % 3]
+        rows.append({"vendor_name": vendor, "category": category, "total_amount": 10.0 + i % 7,
+                     "date": f"2024-{i % 12 + 1:02d}-15", "consumption": 5.0 if unit else 0, "consumption_unit": unit})
+    return rows
+
+
+class TestComputeKPIs:
+    """Tests para los KPIs deterministas"""
+
+    def test_totals_and_breakdowns(self):
+        kpis = compute_kpis([
+            {"vendor": "Som Energia", "category": "Electricity", "total": 100.0, "consumption": 400, "unit": "kWh", "date": "2025-01-10"},
+            {"vendor": "Som Energia", "category": "Electricity", "total": 150.0, "consumption": 500, "unit": "kWh", "date": "2025-02-10"},
+            {"vendor_name": "O2", "category": "Telecom", "total_amount": 50.0, "date": "2025-02-03"},
+        ])
+        assert kpis["numero_facturas"] == 3
+        assert kpis["gasto_total"] == 300.0
+        assert kpis["gasto_por_categoria"] == {"Electricity": 250.0, "Telecom": 50.0}
+        assert kpis["tendencia_mensual"] == [{"mes": "2025-01", "gasto": 100.0}, {"mes": "2025-02", "gasto": 200.0}]
+        assert kpis["variacion_ultimo_mes_pct"] == 100.0
+        assert kpis["coste_por_unidad"]["Electricity"] == {"coste_unitario": round(250 / 900, 4), "unidad": "kWh"}
+        assert kpis["mayores_variaciones"][0]["proveedor"] == "Som Energia"
+        assert kpis["mayores_variaciones"][0]["variacion"] == 50.0
+
+    def test_accepts_rollup_rows(self):
+        row = normalize_record({"vendor": "O2", "category": "Telecom", "month": "2025-03", "invoices": 4, "total": 180.0})
+        assert (row["count"], row["month"], row["total"]) == (4, "2025-03", 180.0)
+
+    def test_cost_per_unit_same_for_invoices_and_rollups(self):
+        """El coste por unidad de un rollup solo cuenta el importe de las facturas con consumo"""
+        invoices = [
+            {"vendor_name": "Som Energia", "category": "Electricity", "total_amount": 80.0, "consumption": 300,
+             "consumption_unit": "kWh", "date": "2025-01-05"},
+            {"vendor_name": "Som Energia", "category": "Electricity", "total_amount": 20.0, "consumption": 0,
+             "date": "2025-01-20"},
+        ]
+        rollup = [{"vendor": "Som Energia", "category": "Electricity", "month": "2025-01", "invoices": 2,
+                   "total": 100.0, "consumption": 300.0, "metered": 80.0, "unit": "kWh"}]
+        expected = {"Electricity": {"coste_unitario": round(80 / 300, 4), "unidad": "kWh"}}
+        assert compute_kpis(invoices)["coste_por_unidad"] == expected
+        assert compute_kpis(rollup)["coste_por_unidad"] == expected
+
+    def test_summary_size_is_bounded(self):
+        small = len(json.dumps(compute_kpis(_invoices(30))))
+        large = len(json.dumps(compute_kpis(_invoices(3000))))
+        assert large < small * 1.2
+
+    def test_empty(self):
+        assert compute_kpis([])["gasto_total"] == 0
+
+
+class TestKPIPrompt:
+    """Tests para el prompt de kpis-direccion"""
+
+    @patch('backend.ai_service.call_ai_service')
+    def test_prompt_contains_summary_not_invoices(self, mock_call):
+        mock_call.return_value = "## KPIs PRINCIPALES"
+        generate_kpis_direccion(_invoices(500))
+        prompt = mock_call.call_args.args[0]
+        assert '"gasto_total"' in prompt
+        assert "2024-01-15" not in prompt
+        assert len(prompt) < 20000
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
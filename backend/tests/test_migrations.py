@@ -0,0 +1,132 @@
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import Session
+
+from backend import migrations
+from backend.database import Invoice, Document
+from backend.bench.indexes import main as bench_main
+
+
+@pytest.fixture
+def legacy_engine(tmp_path):
+    """Base de datos con la tabla invoices tal como era antes de los índices"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE invoices (id INTEGER PRIMARY KEY, invoice_number VARCHAR, date DATE, "
+            "vendor_name VARCHAR, total_amount FLOAT, currency VARCHAR, type VARCHAR, file_path VARCHAR, "
+            "category VARCHAR, consumption FLOAT, consumption_unit VARCHAR, raw_text TEXT)"
+        ))
+        conn.execute(text(
+            "INSERT INTO invoices (invoice_number, vendor_name, raw_text) VALUES "
+            "('F1', 'Som Energia', 'Factura Som Energia'), ('F2', 'Som Energia', 'Factura Som Energia'), "
+            "('F3', 'O2', NULL)"
+        ))
+    yield engine
+    engine.dispose()
+
+
+def _index_names(engine) -> set:
+    return {ix["name"] for ix in inspect(engine).get_indexes("invoices")}
+
+
+class TestMigrations:
+    """Tests para las migraciones de esquema versionadas"""
+
+    def test_applies_invoice_indexes_to_existing_table(self, legacy_engine):
+        """La migración 1 crea los índices en una tabla existente sin perder datos"""
+        assert migrations.run_migrations(legacy_engine) == [1, 2, 3, 4, 5, 6, 7]
+        expected = {name for name, _, _ in migrations.INVOICE_INDEXES}
+        assert expected <= _index_names(legacy_engine)
+        assert migrations.applied_versions(legacy_engine) == {1, 2, 3, 4, 5, 6, 7}
+        with legacy_engine.connect() as conn:
+            assert conn.execute(text("SELECT count(*) FROM invoices")).scalar() == 3
+
+    def test_moves_raw_text_to_documents(self, legacy_engine):
+        """La migración 2 lleva raw_text a documents (una fila por texto) y elimina la columna"""
+        migrations.run_migrations(legacy_engine)
+        columns = {c["name"] for c in inspect(legacy_engine).get_columns("invoices")}
+        assert "raw_text" not in columns and "document_hash" in columns
+        assert "ix_invoices_document_hash" in _index_names(legacy_engine)
+        with Session(legacy_engine) as db:
+            assert db.query(Document).count() == 1
+            texts = dict(db.query(Invoice.invoice_number, Invoice.raw_text))
+        assert texts == {"F1": "Factura Som Energia", "F2": "Factura Som Energia", "F3": None}
+
+    def test_adds_enrichment_columns(self, legacy_engine):
+        """Las migraciones 4 y 5 añaden las columnas de la ingesta en dos fases; lo existente queda enriquecido"""
+        migrations.run_migrations(legacy_engine)
+        columns = {c["name"] for c in inspect(legacy_engine).get_columns("invoices")}
+        assert {"period", "taxes", "enrichment_status", "updated_at", "enrichment_claimed_at"} <= columns
+        assert "ix_invoices_enrichment_status" in _index_names(legacy_engine)
+        with Session(legacy_engine) as db:
+            assert {status for (status,) in db.query(Invoice.enrichment_status)} == {"done"}
+
+    def test_is_idempotent(self, legacy_engine):
+        """Las migraciones ya registradas no se vuelven a ejecutar"""
+        migrations.run_migrations(legacy_engine)
+        assert migrations.run_migrations(legacy_engine) == []
+
+    def test_runs_only_pending_in_order(self, legacy_engine):
+        """Solo se aplican las versiones pendientes y en orden"""
+        calls = []
+        steps = [
+            (11, "segunda", lambda conn: calls.append(11), True),
+            (10, "primera", lambda conn: calls.append(10), True),
+        ]
+        migrations.run_migrations(legacy_engine)
+        assert migrations.run_migrations(legacy_engine, migrations.MIGRATIONS + steps) == [10, 11]
+        assert calls == [10, 11]
+        assert migrations.applied_versions(legacy_engine) == {1, 2, 3, 4, 5, 6, 7, 10, 11}
+
+    def test_failed_transactional_migration_is_not_recorded(self, legacy_engine):
+        """Si una migración falla no queda registrada y se reintenta en el siguiente arranque"""
+        def broken(conn):
+            conn.execute(text("UPDATE invoices SET currency = 'EUR'"))
+            raise RuntimeError("fallo")
+
+        with pytest.raises(RuntimeError):
+            migrations.run_migrations(legacy_engine, [(50, "rota", broken, True)])
+        assert 50 not in migrations.applied_versions(legacy_engine)
+        with legacy_engine.connect() as conn:
+            assert conn.execute(text("SELECT currency FROM invoices")).scalar() is None
+
+    def test_schema_lock_serializes_startup_on_postgres(self):
+        """En PostgreSQL init_db toma un advisory lock en autocommit y lo libera aunque falle"""
+        from unittest.mock import MagicMock
+        engine = MagicMock()
+        engine.dialect.name = "postgresql"
+        conn = engine.connect.return_value.execution_options.return_value.__enter__.return_value
+        with pytest.raises(RuntimeError):
+            with migrations.schema_lock(engine):
+                raise RuntimeError("migración fallida")
+        engine.connect.return_value.execution_options.assert_called_with(isolation_level="AUTOCOMMIT")
+        sql = [str(c.args[0]) for c in conn.execute.call_args_list]
+        assert sql == ["SELECT pg_advisory_lock(:key)", "SELECT pg_advisory_unlock(:key)"]
+
+    def test_schema_lock_is_noop_on_sqlite(self, legacy_engine):
+        """Fuera de PostgreSQL el bloqueo no hace nada"""
+        with migrations.schema_lock(legacy_engine):
+            assert migrations.run_migrations(legacy_engine) == [1, 2, 3, 4, 5, 6, 7]
+
+    def test_model_declares_same_indexes(self):
+        """Las bases de datos nuevas (create_all) tienen los mismos índices que la migración"""
+        declared = {ix.name: tuple(c.name for c in ix.columns) for ix in Invoice.__table__.indexes}
+        for name, _, columns in migrations.INVOICE_INDEXES:
+            assert declared[name] == columns
+
+
+class TestIndexBenchmark:
+    """Tests para el benchmark de índices"""
+
+    def test_bench_reports_index_usage(self, tmp_path, capsys):
+        """Con los índices, las consultas dejan de recorrer la tabla completa"""
+        bench_main(["--database-url", f"sqlite:///{tmp_path / 'bench.db'}", "--rows", "2000", "--repeat", "1"])
+        out = capsys.readouterr().out
+        assert "sin índices" in out and "SCAN invoices" in out
+        assert "USING COVERING INDEX ix_invoices_number_vendor" in out
+        assert "ix_invoices_category_date" in out
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,103 @@
+import pytest
+from datetime import datetime, date
+from unittest.mock import patch
+from fastapi.testclient import TestClient
+
+from backend.main import app
+from backend.database import SessionLocal, Invoice
+from backend.query_router import route_query, parse_intent
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    rows = [
+        ("Som Energia", "Electricity", datetime(2024, 12, 10), 80.0, 300.0, "kWh"),
+        ("Som Energia", "Electricity", datetime(2024, 11, 10), 70.0, 250.0, "kWh"),
+        ("Som Energia", "Electricity", datetime(2023, 12, 10), 60.0, 200.0, "kWh"),
+        ("O2", "Telecom", datetime(2024, 12, 5), 45.5, 0.0, "GB"),
+    ]
+    for i, (vendor, category, when, total, consumption, unit) in enumerate(rows):
+        session.add(Invoice(invoice_number=f"Q-{i}", vendor_name=vendor, category=category, date=when,
+                            total_amount=total, consumption=consumption, consumption_unit=unit,
+                            currency="EUR", file_path=f"q{i}.pdf"))
+    session.commit()
+    yield session
+    session.close()
+
+
+class TestParseIntent:
+    """Tests para la detección de intención"""
+
+    def test_category_month_without_year_uses_latest(self, db):
+        intent = parse_intent("¿Cuánto gastamos en luz en diciembre?", db)
+        assert intent["metric"] == "sum"
+        assert intent["category"] == "Electricity"
+        assert intent["period"][:2] == (date(2024, 12, 1), date(2025, 1, 1))
+
+    def test_vendor_and_year(self, db):
+        intent = parse_intent("total Som Energia 2024", db)
+        assert intent["vendor"] == "Som Energia"
+        assert intent["period"][2] == "2024"
+
+    def test_non_aggregate_question(self, db):
+        assert route_query(db, "¿Qué dice la cláusula de permanencia?") is None
+
+
+class TestRouteQuery:
+    """Tests para las respuestas calculadas con SQL"""
+
+    def test_sum_by_category_and_month(self, db):
+        routed = route_query(db, "¿Cuánto gastamos en luz en diciembre?")
+        assert routed["direct"] is True
+        assert routed["figures"]["sum"] == 80.0
+        assert "80,00 EUR" in routed["answer"]
+
+    def test_vendor_year_total(self, db):
+        routed = route_query(db, "total Som Energia 2024")
+        assert routed["figures"]["sum"] == 150.0
+        assert routed["figures"]["count"] == 2
+
+    def test_consumption_and_count(self, db):
+        assert "550,00 kWh" in route_query(db, "consumo de Som Energia en 2024")["answer"]
+        assert route_query(db, "¿Cuántas facturas de O2 tenemos?")["figures"]["count"] == 1
+
+    def test_analysis_question_goes_to_llm(self, db):
+        routed = route_query(db, "¿Por qué ha subido el gasto de luz en diciembre?")
+        assert routed["direct"] is False
+
+    @pytest.mark.parametrize("question", [
+        "Dime el total de la factura FE023456",
+        "¿Cuál es el importe de la última factura de Som Energia?",
+        "¿Cuánto pagamos de IVA en la factura de O2?",
+        "¿Cuánto nos cobra Som Energia por kWh?",
+    ])
+    def test_single_invoice_questions_go_to_llm(self, db, question):
+        """Una factura concreta o un dato que no es un agregado no se responde con el total del archivo"""
+        routed = route_query(db, question)
+        assert routed is None or routed["direct"] is False
+
+
+class TestChatRouting:
+    """Tests para la integración del enrutador en /chat"""
+
+    @patch('backend.main.chat_with_invoices')
+    def test_chat_aggregate_skips_llm(self, mock_chat, db):
+        response = client.post("/chat", json={"query": "total Som Energia 2024"})
+        data = response.json()
+        assert data["source"] == "sql"
+        assert "150,00 EUR" in data["response"]
+        mock_chat.assert_not_called()
+
+    @patch('backend.main.chat_with_invoices')
+    def test_chat_analysis_gets_figures(self, mock_chat, db):
+        mock_chat.return_value = "ok"
+        client.post("/chat", json={"query": "¿Por qué ha subido el gasto de luz en diciembre?"})
+        context = mock_chat.call_args.args[1]
+        assert context.startswith("CIFRAS CALCULADAS")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,77 @@
+import pytest
+from datetime import datetime
+
+from backend.database import SessionLocal, Invoice, InvoiceChunk
+from backend.retrieval import split_chunks, build_chunk_rows, retrieve_passages, get_index, tokenize
+
+
+def long_invoice_text(vendor: str, reading_line: str) -> str:
+    filler = "\n".join(f"Condiciones generales del contrato, cláusula {i}." for i in range(60))
+    return f"{vendor}\nN.º de factura: X-1\n{filler}\n{reading_line}\nGracias por su confianza.\n"
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    for n, (vendor, line) in enumerate([
+        ("Som Energia", "Lectura final 15230 kWh - Lectura inicial 14810 kWh"),
+        ("Naturgy", "Impuesto especial sobre hidrocarburos 3,21 EUR"),
+    ]):
+        session.add(Invoice(
+            invoice_number=f"R-{n}", date=datetime(2024, 12, 1), vendor_name=vendor, total_amount=10.0,
+            category="Electricity", file_path=f"r{n}.pdf", raw_text=long_invoice_text(vendor, line)
+        ))
+    session.commit()
+    yield session
+    session.close()
+
+
+class TestChunking:
+    """Tests para la fragmentación y las estadísticas de términos"""
+
+    def test_split_chunks_covers_text_on_line_boundaries(self):
+        text = "".join(f"línea {i}\n" for i in range(200))
+        spans = split_chunks(text, target_chars=100)
+        assert spans[0][0] == 0
+        assert spans[-1][1] == len(text)
+        assert all(text[end - 1] == "\n" for _, end in spans)
+
+    def test_chunk_rows_store_packed_arrays(self):
+        rows = build_chunk_rows(1, "Lectura lectura kWh")
+        assert len(rows) == 1
+        assert rows[0]["length"] == 3
+        assert len(rows[0]["term_hashes"]) == 2 * 4  # dos términos distintos, uint32
+
+    def test_tokenize_strips_accents(self):
+        assert tokenize("Período de facturación") == ["periodo", "facturacion"]
+
+
+class TestRetrievePassages:
+    """Tests para la recuperación BM25 bajo presupuesto de caracteres"""
+
+    def test_finds_line_beyond_prefix(self, db):
+        """La lectura está más allá de los primeros 2000 caracteres y aun así se recupera"""
+        passages = retrieve_passages(db, "lectura final kWh", k=3)
+        assert passages
+        assert "Lectura final 15230" in passages[0]["text"]
+
+    def test_respects_char_budget(self, db):
+        passages = retrieve_passages(db, "condiciones contrato cláusula", k=20, char_budget=1500)
+        assert sum(len(p["text"]) for p in passages) <= 1500
+
+    def test_filters_by_invoice(self, db):
+        naturgy = db.query(Invoice).filter(Invoice.vendor_name == "Naturgy").first()
+        passages = retrieve_passages(db, "lectura impuesto", k=5, invoice_ids=[naturgy.id])
+        assert passages and all(p["invoice_id"] == naturgy.id for p in passages)
+
+    def test_index_follows_deletes(self, db):
+        inv = db.query(Invoice).filter(Invoice.vendor_name == "Som Energia").first()
+        db.delete(inv)
+        db.commit()
+        assert db.query(InvoiceChunk).filter(InvoiceChunk.invoice_id == inv.id).count() == 0
+        assert retrieve_passages(db, "lectura final", k=3) == []
+        assert len(get_index(db)) == db.query(InvoiceChunk).count()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,118 @@
+import pytest
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+from fastapi.testclient import TestClient
+
+from backend.main import app
+from backend.database import SessionLocal, Invoice, SpendRollup
+from backend.rollups import rebuild_rollups, rollup_rows, lock_group_statement
+
+client = TestClient(app)
+
+
+def _snapshot(db):
+    return sorted(
+        (r.vendor_name, r.category, r.month, r.invoice_count, round(r.total_amount, 2),
+         round(r.total_consumption, 2), round(r.metered_amount, 2), r.consumption_unit, r.min_amount, r.max_amount)
+        for r in db.query(SpendRollup)
+    )
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    session.add_all([
+        Invoice(invoice_number="S1", vendor_name="Som Energia", category="Electricity", date=datetime(2025, 1, 5),
+                total_amount=80.0, consumption=300.0, consumption_unit="kWh", file_path="s1.pdf"),
+        Invoice(invoice_number="S2", vendor_name="Som Energia", category="Electricity", date=datetime(2025, 1, 20),
+                total_amount=20.0, consumption=0.0, file_path="s2.pdf"),
+        Invoice(invoice_number="O1", vendor_name="O2", category="Telecom", date=datetime(2025, 2, 1),
+                total_amount=45.5, file_path="o1.pdf"),
+        Invoice(invoice_number="X1", vendor_name=None, category=None, date=None, total_amount=10.0, file_path="x1.pdf"),
+    ])
+    session.commit()
+    yield session
+    session.close()
+
+
+class TestRollupMaintenance:
+    """Tests para el mantenimiento incremental de spend_rollups"""
+
+    def test_insert_accumulates_group(self, db):
+        row = db.query(SpendRollup).filter_by(vendor_name="Som Energia", month="2025-01").one()
+        assert row.invoice_count == 2
+        assert row.total_amount == 100.0
+        assert row.total_consumption == 300.0
+        assert row.metered_amount == 80.0
+        assert row.consumption_unit == "kWh"
+        assert (row.min_amount, row.max_amount) == (20.0, 80.0)
+        assert db.query(SpendRollup).filter_by(vendor_name="", category="", month="").one().invoice_count == 1
+
+    def test_delete_recomputes_group(self, db):
+        db.delete(db.query(Invoice).filter_by(invoice_number="S1").one())
+        db.commit()
+        row = db.query(SpendRollup).filter_by(vendor_name="Som Energia", month="2025-01").one()
+        assert (row.invoice_count, row.total_amount, row.total_consumption) == (1, 20.0, 0.0)
+
+        db.delete(db.query(Invoice).filter_by(invoice_number="O1").one())
+        db.commit()
+        assert db.query(SpendRollup).filter_by(vendor_name="O2").count() == 0
+
+    def test_update_moves_invoice_between_groups(self, db):
+        invoice = db.query(Invoice).filter_by(invoice_number="S2").one()
+        db.commit()  # expira los atributos: el valor anterior debe cargarse igualmente
+        invoice.date = datetime(2025, 3, 2)
+        invoice.total_amount = 25.0
+        db.commit()
+        january = db.query(SpendRollup).filter_by(vendor_name="Som Energia", month="2025-01").one()
+        march = db.query(SpendRollup).filter_by(vendor_name="Som Energia", month="2025-03").one()
+        assert (january.invoice_count, january.total_amount) == (1, 80.0)
+        assert (march.invoice_count, march.total_amount) == (1, 25.0)
+
+    def test_recompute_locks_group_row_on_postgres(self):
+        """El recálculo bloquea la fila del grupo antes de agregar (no pisa un alta concurrente)"""
+        from sqlalchemy.dialects import postgresql
+        from backend.rollups import recompute_group
+
+        sql = str(lock_group_statement(("O2", "Telecom", "2025-01")).compile(dialect=postgresql.dialect()))
+        assert "FOR UPDATE" in sql
+        connection = MagicMock()
+        connection.dialect.name = "postgresql"
+        connection.execute.return_value.mappings.return_value.one.return_value = {"invoice_count": 0}
+        recompute_group(connection, ("O2", "Telecom", "2025-01"))
+        first = connection.execute.call_args_list[0].args[0]
+        assert "FOR UPDATE" in str(first.compile(dialect=postgresql.dialect()))
+
+    def test_rebuild_matches_incremental(self, db):
+        incremental = _snapshot(db)
+        assert rebuild_rollups(db) == 3
+        assert _snapshot(db) == incremental
+
+
+class TestRollupReaders:
+    """Tests para los consumidores de los rollups"""
+
+    def test_rollup_rows_filters(self, db):
+        rows = rollup_rows(db, category="Electricity")
+        assert rows == [{"vendor": "Som Energia", "category": "Electricity", "month": "2025-01",
+                         "invoices": 2, "total": 100.0, "consumption": 300.0, "metered": 80.0, "unit": "kWh"}]
+
+    @patch('backend.main.generate_kpis_direccion')
+    def test_kpis_direccion_uses_rollups(self, mock_kpis, db):
+        mock_kpis.return_value = {"status": "ok"}
+        client.post("/workflow/kpis-direccion", json={})
+        sent = mock_kpis.call_args.args[0]
+        assert len(sent) == 3
+        assert {"vendor", "month", "invoices", "total"} <= set(sent[0])
+
+    def test_advanced_stats_from_rollups(self, db):
+        data = client.get("/advanced-stats").json()
+        assert data["invoice_count"] == 4
+        assert data["total_cost"] == 155.5
+        # Rango que corta un mes: se calcula sobre las facturas
+        partial = client.get("/advanced-stats", params={"date_from": "2025-01-10", "date_to": "2025-01-31"}).json()
+        assert partial["invoice_count"] == 1
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
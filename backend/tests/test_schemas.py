@@ -0,0 +1,59 @@
+import pytest
+from backend.schemas import (
+    InvoiceExtraction, parse_json_tolerant, validate_extraction,
+    json_schema_for, openai_response_format
+)
+
+
+class TestParseJsonTolerant:
+    """Tests para el parser JSON tolerante de respuestas del LLM"""
+
+    def test_markdown_fences_and_prose(self):
+        text = 'Aquí tienes:\n```json\n{"invoice_number": "A1", "total_amount": 10.5}\n```'
+        assert parse_json_tolerant(text) == {"invoice_number": "A1", "total_amount": 10.5}
+
+    def test_truncated_output_keeps_complete_fields(self):
+        """Una salida cortada conserva los pares clave/valor completos"""
+        text = '{"invoice_number": "A1", "total_amount": 10.5, "vendor_na'
+        assert parse_json_tolerant(text) == {"invoice_number": "A1", "total_amount": 10.5}
+
+    def test_truncated_nested(self):
+        assert parse_json_tolerant('{"a": {"b": 1, "c": [1, 2') == {"a": {"b": 1, "c": [1, 2]}}
+
+    def test_no_object_raises(self):
+        with pytest.raises(ValueError):
+            parse_json_tolerant("Error de conexión")
+
+
+class TestValidateExtraction:
+    """Tests para la validación contra el esquema de extracción"""
+
+    def test_spanish_decimals_are_coerced(self):
+        data = validate_extraction({"total_amount": "1.234,56 €", "consumption": "250,5 kWh"})
+        assert data["total_amount"] == 1234.56
+        assert data["consumption"] == 250.5
+
+    def test_invalid_fields_are_dropped_and_extras_kept(self):
+        data = validate_extraction({"consumption": "n/a", "notes": "extra"})
+        assert "consumption" not in data
+        assert data["notes"] == "extra"
+        assert data["currency"] == "EUR"
+
+
+class TestProviderSchemas:
+    """Tests para la traducción del esquema a cada proveedor"""
+
+    def test_ollama_schema_has_all_fields(self):
+        schema = json_schema_for(InvoiceExtraction)
+        assert set(InvoiceExtraction.model_fields) == set(schema["properties"])
+
+    def test_openai_strict_schema(self):
+        fmt = openai_response_format(InvoiceExtraction)
+        schema = fmt["json_schema"]["schema"]
+        assert fmt["json_schema"]["strict"] is True
+        assert schema["additionalProperties"] is False
+        assert set(schema["required"]) == set(schema["properties"])
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,82 @@
+import pytest
+from datetime import datetime
+from fastapi.testclient import TestClient
+
+from backend.main import app
+from backend.database import SessionLocal, Invoice
+from backend.search import search_invoices, rebuild_search_index, tokenize_query
+
+client = TestClient(app)
+
+
+def add_invoice(db, number, vendor, category, raw_text):
+    inv = Invoice(
+        invoice_number=number, date=datetime(2024, 12, 15), vendor_name=vendor,
+        total_amount=50.0, currency="EUR", type="Purchase", category=category,
+        file_path=f"{number}.pdf", raw_text=raw_text
+    )
+    db.add(inv)
+    db.commit()
+    db.refresh(inv)
+    return inv
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    add_invoice(session, "SE-001", "Som Energia", "Electricity", "Lectura final 1520 kWh. Potencia contratada 4,6 kW")
+    add_invoice(session, "O2-001", "O2", "Telecom", "Tarifa fibra 600Mb y móvil ilimitado")
+    yield session
+    session.close()
+
+
+class TestSearchIndex:
+    """Tests para el índice de texto completo"""
+
+    def test_search_ranks_and_highlights(self, db):
+        results = search_invoices(db, "potencia contratada")
+        assert len(results) == 1
+        assert results[0]["vendor_name"] == "Som Energia"
+        assert "<mark>" in results[0]["snippet"]
+
+    def test_search_ignores_accents_and_prefixes(self, db):
+        assert search_invoices(db, "movil")[0]["invoice_number"] == "O2-001"
+        assert search_invoices(db, "energ")[0]["invoice_number"] == "SE-001"
+
+    def test_delete_removes_from_index(self, db):
+        inv = db.query(Invoice).filter(Invoice.invoice_number == "O2-001").first()
+        db.delete(inv)
+        db.commit()
+        assert search_invoices(db, "fibra") == []
+
+    def test_update_reindexes(self, db):
+        inv = db.query(Invoice).filter(Invoice.invoice_number == "O2-001").first()
+        inv.vendor_name = "Movistar"
+        db.commit()
+        assert search_invoices(db, "movistar")[0]["id"] == inv.id
+
+    def test_rebuild(self, db):
+        assert rebuild_search_index(db) == 2
+        assert len(search_invoices(db, "kwh")) == 1
+
+    def test_chat_tokenization_drops_stopwords(self):
+        assert tokenize_query("¿Cuánto gastamos en luz de Som Energia?", drop_stopwords=True) == ["luz", "som", "energia"]
+
+
+class TestSearchEndpoint:
+    """Tests para GET /search"""
+
+    def test_search_endpoint(self, db):
+        response = client.get("/search", params={"q": "fibra"})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["status"] == "success"
+        assert data["results"][0]["invoice_number"] == "O2-001"
+
+    def test_search_endpoint_no_results(self, db):
+        data = client.get("/search", params={"q": "inexistente"}).json()
+        assert data["count"] == 0
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
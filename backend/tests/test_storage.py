@@ -0,0 +1,157 @@
+import pytest
+import os
+from io import BytesIO
+from unittest.mock import patch, AsyncMock
+from fastapi.testclient import TestClient
+
+from backend.main import app
+from backend.database import SessionLocal, Invoice, StoredFile, ExtractionJob
+from backend import storage
+from backend.storage import blob_key, save_original, discard_original, prune_files
+
+client = TestClient(app)
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    yield session
+    session.close()
+
+
+def _invoice(db, path, number):
+    invoice = Invoice(invoice_number=number, vendor_name="Test", total_amount=10.0, file_path=path)
+    db.add(invoice)
+    db.commit()
+    return invoice
+
+
+def _refcount(db, path):
+    digest = os.path.basename(path).split(".")[0]
+    row = db.get(StoredFile, digest)
+    return row.refcount if row else 0
+
+
+class TestLocalStore:
+    """Tests para el almacén por contenido"""
+
+    def test_sharded_content_key(self):
+        """La clave es el sha256 repartido en dos niveles, con la extensión en minúsculas"""
+        digest = "ab" * 32
+        assert blob_key(digest, "Factura.PDF") == f"ab/ab/{digest}.pdf"
+
+    def test_same_content_stored_once(self):
+        """Mismo contenido con otro nombre: misma ruta; mismo nombre con otro contenido: otra ruta"""
+        first = save_original(b"%PDF A", "factura.pdf")
+        assert save_original(b"%PDF A", "copia.pdf") == first
+        other = save_original(b"%PDF B", "factura.pdf")
+        assert other != first
+        with open(first, "rb") as f:
+            assert f.read() == b"%PDF A"
+        assert sorted(storage.store.keys()) == sorted(storage.store.key_for_path(p) for p in (first, other))
+
+    def test_paths_outside_store(self, tmp_path):
+        """Las rutas de fuera del almacén (instalaciones anteriores) no se gestionan"""
+        assert not storage.is_stored("backend/uploads/factura.pdf")
+        assert not storage.is_stored(str(tmp_path / "storage" / "ab" / "cd" / "no-es-un-hash.pdf"))
+
+
+class TestReferenceCounting:
+    """Tests para los contadores de referencias y el borrado seguro"""
+
+    def test_delete_keeps_file_while_referenced(self, db):
+        """El fichero se borra solo cuando la última factura que lo usa desaparece"""
+        path = save_original(b"%PDF A", "f.pdf")
+        first = _invoice(db, path, "A-1")
+        second = _invoice(db, path, "A-2")
+        assert _refcount(db, path) == 2
+
+        db.delete(first)
+        db.commit()
+        assert os.path.exists(path) and _refcount(db, path) == 1
+        db.delete(second)
+        db.commit()
+        assert not os.path.exists(path) and _refcount(db, path) == 0
+
+    def test_rollback_keeps_file(self, db):
+        """Un borrado deshecho no toca el fichero"""
+        path = save_original(b"%PDF A", "f.pdf")
+        invoice = _invoice(db, path, "A-1")
+        db.delete(invoice)
+        db.flush()
+        db.rollback()
+        assert os.path.exists(path) and _refcount(db, path) == 1
+
+    def test_changing_file_moves_reference(self, db):
+        """Cambiar file_path libera el fichero anterior y referencia el nuevo"""
+        old = save_original(b"%PDF A", "f.pdf")
+        new = save_original(b"%PDF B", "f.pdf")
+        invoice = _invoice(db, old, "A-1")
+        invoice.file_path = new
+        db.commit()
+        assert not os.path.exists(old)
+        assert _refcount(db, new) == 1
+
+    def test_discard_only_unreferenced(self, db):
+        """Una factura rechazada no borra un fichero que usa otra o un trabajo en cola"""
+        path = save_original(b"%PDF A", "f.pdf")
+        _invoice(db, path, "A-1")
+        discard_original(db, path)
+        assert os.path.exists(path)
+
+        queued = save_original(b"%PDF B", "g.pdf")
+        db.add(ExtractionJob(file_path=queued, file_name="g.pdf"))
+        db.commit()
+        discard_original(db, queued)
+        assert os.path.exists(queued)
+
+        orphan = save_original(b"%PDF C", "h.pdf")
+        discard_original(db, orphan)
+        assert not os.path.exists(orphan)
+
+    def test_prune_recounts_and_removes_orphans(self, db):
+        """prune-files corrige contadores y borra los ficheros sin facturas ni trabajos"""
+        used = save_original(b"%PDF A", "f.pdf")
+        orphan = save_original(b"%PDF B", "g.pdf")
+        _invoice(db, used, "A-1")
+        db.query(StoredFile).update({StoredFile.refcount: 7})
+        db.commit()
+        assert prune_files(db) == 1
+        assert os.path.exists(used) and not os.path.exists(orphan)
+        assert _refcount(db, used) == 1
+
+
+class TestUploadStorage:
+    """Tests para /upload y DELETE /invoices con el almacén por contenido"""
+
+    def _upload(self, name, content, text):
+        with patch("backend.main.schedule_enrichment", new_callable=AsyncMock, return_value="pending"), \
+                patch("backend.ai_service.extract_text", return_value=text):
+            return client.post("/upload", files={"file": (name, BytesIO(content), "application/pdf")}).json()
+
+    def test_same_name_different_suppliers(self, db):
+        """Dos factura.pdf distintas se guardan las dos sin pisarse"""
+        first = self._upload("factura.pdf", b"%PDF O2", "Factura O2\nNº Factura: O2-1")
+        second = self._upload("factura.pdf", b"%PDF Endesa", "Factura Endesa\nNº Factura: EN-1")
+        assert first["status"] == second["status"] == "success"
+        paths = [db.get(Invoice, r["invoice"]["id"]).file_path for r in (first, second)]
+        assert paths[0] != paths[1]
+        for path, content in zip(paths, (b"%PDF O2", b"%PDF Endesa")):
+            with open(path, "rb") as f:
+                assert f.read() == content
+
+        # Mismo contenido otra vez: duplicado, sin segunda copia
+        again = self._upload("otro_nombre.pdf", b"%PDF O2", "Factura O2\nNº Factura: O2-1")
+        assert again["status"] == "error"
+        assert len(list(storage.store.keys())) == 2
+
+    def test_delete_endpoint_removes_file(self, db):
+        """Borrar la factura libera su fichero"""
+        result = self._upload("factura.pdf", b"%PDF O2", "Factura O2\nNº Factura: O2-1")
+        path = db.get(Invoice, result["invoice"]["id"]).file_path
+        assert client.delete(f"/invoices/{result['invoice']['id']}").json()["status"] == "success"
+        assert not os.path.exists(path)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,118 @@
+import pytest
+from datetime import date, datetime
+from fastapi.testclient import TestClient
+
+from backend.main import app
+from backend.database import SessionLocal, Invoice
+from backend.validation import check_invoice, validate_with_rules, validate_all
+
+client = TestClient(app)
+TODAY = date(2025, 6, 1)
+
+VALID = {"invoice_number": "F-1", "vendor": "Som Energia", "date": "2025-05-02", "total": 121.0,
+         "taxes": 21.0, "base": 100.0, "consumption": 500, "unit": "kWh", "category": "Electricity"}
+
+
+class TestRules:
+    """Tests para las reglas deterministas"""
+
+    def test_valid_invoice(self):
+        result = check_invoice(VALID, today=TODAY)
+        assert result == {"status": "OK", "alerts": [], "reasons": [], "missing_fields": [],
+                          "source": "rules", "escalate": False}
+
+    def test_missing_fields_and_zero_total(self):
+        result = check_invoice({"invoice_number": "unknown", "total_amount": 0}, today=TODAY)
+        assert result["status"] == "REVISAR"
+        assert result["missing_fields"] == ["invoice_number", "vendor", "date"]
+        assert "Importe total a cero" in result["alerts"]
+        assert result["escalate"] is False
+
+    @pytest.mark.parametrize("when, alert", [
+        ("2026-01-01", "Fecha futura"), ("2001-01-01", "Fecha improbable"), ("32/13/2025", "Fecha no válida")
+    ])
+    def test_date_sanity(self, when, alert):
+        assert alert in check_invoice({**VALID, "date": when}, today=TODAY)["alerts"]
+
+    def test_tax_arithmetic(self):
+        assert "Descuadre de importes" in check_invoice({**VALID, "base": 90.0}, today=TODAY)["alerts"]
+        assert "Impuestos incoherentes" in check_invoice({**VALID, "taxes": 200.0, "base": None}, today=TODAY)["alerts"]
+
+    def test_ambiguous_cases_escalate(self):
+        odd_rate = check_invoice({**VALID, "base": None, "taxes": 30.0}, today=TODAY)
+        assert odd_rate["escalate"] is True
+        assert odd_rate["status"] == "REVISAR"
+        expensive = check_invoice({**VALID, "consumption": 50}, today=TODAY)
+        assert expensive["escalate"] is True
+        assert "Coste por unidad" in expensive["reasons"][0]
+        credit_note = check_invoice({**VALID, "total": -121.0, "taxes": None}, today=TODAY)
+        assert credit_note["escalate"] is True
+
+    def test_hard_errors_do_not_escalate(self):
+        result = check_invoice({**VALID, "consumption": -5, "total": -3, "taxes": None}, today=TODAY)
+        assert result["escalate"] is False
+        assert "Consumo negativo" in result["alerts"]
+
+
+@pytest.fixture
+def db():
+    session = SessionLocal()
+    session.add_all([
+        Invoice(invoice_number="D-1", vendor_name="O2", date=datetime(2025, 1, 1), total_amount=40.0, file_path="a.pdf"),
+        Invoice(invoice_number="D-1", vendor_name="O2", date=datetime(2025, 2, 1), total_amount=40.0, file_path="b.pdf"),
+        Invoice(invoice_number="D-1", vendor_name="Iberdrola", date=datetime(2025, 2, 1), total_amount=80.0,
+                consumption=400.0, consumption_unit="kWh", category="Electricity", file_path="c.pdf"),
+        Invoice(invoice_number="unknown", vendor_name="Canal", date=datetime(2025, 3, 1), total_amount=0.0, file_path="d.pdf"),
+    ])
+    session.commit()
+    yield session
+    session.close()
+
+
+class TestDatabaseRules:
+    """Tests para las reglas que consultan la base de datos"""
+
+    def test_duplicate_per_vendor(self, db):
+        first = db.query(Invoice).filter_by(vendor_name="O2").first()
+        other_vendor = db.query(Invoice).filter_by(vendor_name="Iberdrola").one()
+        assert "Factura duplicada" in validate_with_rules(db, {"id": first.id, "invoice_number": "D-1", "vendor": "O2"})["alerts"]
+        data = {"id": other_vendor.id, "invoice_number": "D-1", "vendor": "Iberdrola", "date": "2025-02-01", "total": 80.0}
+        assert "Factura duplicada" not in validate_with_rules(db, data)["alerts"]
+
+    def test_saved_invoice_without_id_is_not_its_own_duplicate(self, db):
+        """Sin id, la propia fila guardada (mismo nº, proveedor y fecha) no cuenta como duplicado"""
+        saved = {"invoice_number": "D-1", "vendor": "Iberdrola", "date": "2025-02-01", "total": 80.0}
+        assert "Factura duplicada" not in validate_with_rules(db, saved)["alerts"]
+        other = {"invoice_number": "D-1", "vendor": "Iberdrola", "date": "2025-05-01", "total": 80.0}
+        assert "Factura duplicada" in validate_with_rules(db, other)["alerts"]
+
+    def test_tax_rule_with_stored_invoices(self, db):
+        """Los impuestos guardados se validan en bloque y por invoice_id"""
+        invoice = Invoice(invoice_number="T-1", vendor_name="Holaluz", date=datetime(2025, 3, 1),
+                          total_amount=40.0, taxes=50.0, file_path="t.pdf")
+        db.add(invoice)
+        db.commit()
+        results = {r["invoice_number"]: r for r in validate_all(db, today=TODAY)["results"]}
+        assert "Impuestos incoherentes" in results["T-1"]["alerts"]
+        data = client.post("/workflow/validar-factura", json={"invoice_id": invoice.id}).json()
+        assert "Impuestos incoherentes" in data["alerts"]
+
+    def test_bulk_validation(self, db):
+        result = validate_all(db, today=TODAY)
+        assert result["checked"] == 4
+        assert result["OK"] == 1
+        assert result["REVISAR"] == 3
+        by_vendor = {}
+        for r in result["results"]:
+            by_vendor.setdefault(r["vendor"], []).append(r)
+        assert all("Factura duplicada" in r["alerts"] for r in by_vendor["O2"])
+        assert by_vendor["Canal"][0]["missing_fields"] == ["invoice_number"]
+
+    def test_bulk_endpoint(self, db):
+        data = client.post("/workflow/validar-factura/bulk", params={"only_issues": "false"}).json()
+        assert data["status"] == "success"
+        assert len(data["results"]) == 4
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,418 @@
+import json
+import pytest
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+from backend import watcher
+from backend.database import SessionLocal, Invoice
+from backend.ingestion import apply_defaults
+from backend.watcher import (UploadPool, InvoiceHandler, Debouncer, FolderMetadata, wait_until_stable, is_candidate,
+                             create_session)
+
+
+class FakeSession:
+    """Sesión HTTP falsa que mide cuántas subidas hay a la vez"""
+
+    def __init__(self, delay=0.05, status_code=200, body=None):
+        self.delay = delay
+        self.status_code = status_code
+        self.body = body or {"status": "success"}
+        self.posted = []
+        self.data = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def post(self, url, files=None, data=None, timeout=None):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.posted.append(files["file"][0])
+            self.data.append(data)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        return SimpleNamespace(status_code=self.status_code, text="error", json=lambda: self.body)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def fast_stability(monkeypatch):
+    monkeypatch.setattr(watcher, "STABLE_INTERVAL", 0.01)
+    monkeypatch.setattr(watcher, "STABLE_CHECKS", 2)
+    monkeypatch.setattr(watcher, "STABLE_TIMEOUT", 5)
+
+
+def _pool(tmp_path, session, workers=4):
+    return UploadPool(workers=workers, api_url="http://api/upload", processed_dir=str(tmp_path / "processed"),
+                      session=session).start()
+
+
+class TestFileStability:
+    """Tests para la detección de ficheros completos"""
+
+    def test_candidates(self):
+        """Solo PDF e imágenes; nunca descargas a medias ni ocultos"""
+        assert is_candidate("f.PDF") and is_candidate("f.jpeg")
+        assert not is_candidate("f.pdf.crdownload") and not is_candidate(".f.pdf") and not is_candidate("f.txt")
+
+    def test_waits_while_file_grows(self, tmp_path):
+        """Un fichero que sigue creciendo no se da por completo hasta que deja de cambiar"""
+        path = tmp_path / "f.pdf"
+        path.write_bytes(b"a")
+
+        def grow():
+            for _ in range(10):
+                time.sleep(0.01)
+                with open(path, "ab") as f:
+                    f.write(b"x" * 100)
+
+        writer = threading.Thread(target=grow)
+        writer.start()
+        assert wait_until_stable(str(path), interval=0.02, checks=3)
+        writer.join()
+        assert path.stat().st_size == 1001
+
+    def test_missing_or_never_stable(self, tmp_path):
+        """Un fichero borrado o vacío hasta el timeout no se sube"""
+        assert not wait_until_stable(str(tmp_path / "no.pdf"))
+        (tmp_path / "empty.pdf").write_bytes(b"")
+        assert not wait_until_stable(str(tmp_path / "empty.pdf"), timeout=0.1)
+
+
+class TestUploadPool:
+    """Tests para el pool de subidas"""
+
+    def test_uploads_in_parallel_and_moves(self, tmp_path):
+        """Los ficheros se suben en paralelo (hasta `workers`) y se mueven a processed"""
+        session = FakeSession()
+        pool = _pool(tmp_path, session, workers=3)
+        for i in range(9):
+            path = tmp_path / f"f{i}.pdf"
+            path.write_bytes(b"%PDF " + str(i).encode())
+            pool.submit(str(path))
+        pool.join()
+        pool.stop()
+        assert sorted(session.posted) == sorted(f"f{i}.pdf" for i in range(9))
+        assert 1 < session.max_active <= 3
+        assert len(list((tmp_path / "processed").glob("*.pdf"))) == 9
+
+    def test_duplicate_events_upload_once(self, tmp_path):
+        """created + modified del mismo fichero solo lo encolan una vez"""
+        session = FakeSession()
+        pool = _pool(tmp_path, session, workers=1)
+        path = tmp_path / "f.pdf"
+        path.write_bytes(b"%PDF")
+        assert pool.submit(str(path))
+        assert not pool.submit(str(path))
+        pool.join()
+        pool.stop()
+        assert session.posted == ["f.pdf"]
+
+    def test_failed_upload_keeps_file(self, tmp_path):
+        """Si la API responde con error el fichero se queda en la carpeta"""
+        pool = _pool(tmp_path, FakeSession(status_code=500), workers=1)
+        path = tmp_path / "f.pdf"
+        path.write_bytes(b"%PDF")
+        pool.submit(str(path))
+        pool.join()
+        pool.stop()
+        assert path.exists()
+
+    def test_shared_keep_alive_session(self):
+        """La sesión compartida admite una conexión por worker"""
+        session = create_session(6)
+        assert session.get_adapter("http://app:8000")._pool_maxsize == 6
+
+
+class TestManifest:
+    """Tests para el manifiesto persistente, los reintentos y la carpeta de fallidos"""
+
+    def _pool(self, tmp_path, session):
+        return UploadPool(workers=1, api_url="http://api/upload", processed_dir=str(tmp_path / "processed"),
+                          dead_letter_dir=str(tmp_path / "failed"), session=session)
+
+    def test_completed_hash_is_skipped(self, tmp_path):
+        """Un fichero con el mismo contenido que uno ya procesado no se vuelve a subir"""
+        session = FakeSession(delay=0)
+        pool = self._pool(tmp_path, session)
+        (tmp_path / "a.pdf").write_bytes(b"%PDF A")
+        (tmp_path / "copia.pdf").write_bytes(b"%PDF A")
+        assert pool.process(str(tmp_path / "a.pdf"))
+        assert not pool.process(str(tmp_path / "copia.pdf"))
+        assert session.posted == ["a.pdf"]
+        assert pool.manifest.counts() == {"done": 2}
+
+    def test_restart_only_queues_new_files(self, tmp_path):
+        """Tras reiniciar, los ficheros ya resueltos no se encolan ni se vuelven a leer"""
+        watch = tmp_path / "in"
+        watch.mkdir()
+        (watch / "viejo.pdf").write_bytes(b"%PDF viejo")
+        pool = self._pool(tmp_path, FakeSession(delay=0, status_code=500))
+        pool.process(str(watch / "viejo.pdf"))  # falla: queda esperando reintento
+        pool.manifest.close()
+
+        (watch / "nuevo.pdf").write_bytes(b"%PDF nuevo")
+        restarted = self._pool(tmp_path, FakeSession(delay=0))
+        with patch("backend.watcher.file_sha256", wraps=watcher.file_sha256) as hashing:
+            assert restarted.scan(str(watch)) == 1
+        assert restarted.queue.get_nowait() == str(watch / "nuevo.pdf")
+        hashing.assert_not_called()
+
+    def test_retries_with_backoff(self, tmp_path):
+        """Una caída de la API deja el fichero para reintentar cuando vence la espera"""
+        session = FakeSession(delay=0, status_code=503)
+        pool = self._pool(tmp_path, session)
+        path = tmp_path / "f.pdf"
+        path.write_bytes(b"%PDF")
+        assert not pool.process(str(path))
+        assert pool.manifest.get(str(path))[3:5] == ("retry", 1)
+        assert pool.manifest.due() == []  # todavía en espera
+        assert pool.manifest.due(now=time.time() + watcher.RETRY_BACKOFF + 1) == [str(path)]
+
+        session.status_code = 200
+        assert pool.process(str(path))
+        assert pool.manifest.get(str(path))[3] == "done"
+
+    def test_poison_file_goes_to_dead_letter(self, tmp_path):
+        """Agotados los intentos el fichero pasa a la carpeta de fallidos con su error"""
+        pool = self._pool(tmp_path, FakeSession(delay=0, status_code=500))
+        path = tmp_path / "f.pdf"
+        path.write_bytes(b"%PDF")
+        with patch.object(watcher, "MAX_ATTEMPTS", 2):
+            pool.process(str(path))
+            pool.process(str(path))
+        assert not path.exists()
+        assert (tmp_path / "failed" / "f.pdf").exists()
+        assert "HTTP 500" in (tmp_path / "failed" / "f.pdf.error.txt").read_text()
+        assert pool.manifest.get(str(path))[3] == "dead"
+
+    def test_error_body_is_not_done(self, tmp_path):
+        """Un 200 con status error no da el fichero por procesado: se reintenta; un duplicado va a fallidos"""
+        session = FakeSession(delay=0, body={"status": "error", "reason": "invalid", "message": "database is down"})
+        pool = self._pool(tmp_path, session)
+        path = tmp_path / "f.pdf"
+        path.write_bytes(b"%PDF")
+        assert not pool.process(str(path))
+        assert path.exists() and not (tmp_path / "processed" / "f.pdf").exists()
+        assert pool.manifest.get(str(path))[3:6] == ("retry", 1, "database is down")
+
+        session.body = {"status": "error", "reason": "duplicate", "message": "Factura duplicada"}
+        assert not pool.process(str(path))
+        assert (tmp_path / "failed" / "f.pdf").exists()
+        assert "duplicada" in (tmp_path / "failed" / "f.pdf.error.txt").read_text()
+        assert pool.manifest.get(str(path))[3] == "dead"
+
+
+class TestLocalMode:
+    """Tests para el modo local (pipeline en el propio watcher, sin HTTP)"""
+
+    EXTRACTED = json.dumps({"invoice_number": "LOC-1", "vendor_name": "O2", "total_amount": 20.5})
+
+    def test_ingests_without_http(self, tmp_path):
+        """El fichero se mueve a processed y la factura apunta ahí; no hay subida multipart"""
+        session = FakeSession()
+        pool = UploadPool(workers=1, processed_dir=str(tmp_path / "processed"), session=session, mode="local")
+        path = tmp_path / "f.pdf"
+        path.write_bytes(b"%PDF")
+        with patch("backend.ingestion.extract_text", return_value="Factura O2 LOC-1"), \
+                patch("backend.ingestion.extract_invoice_data", return_value=self.EXTRACTED):
+            assert pool.process(str(path))
+            (tmp_path / "f.pdf").write_bytes(b"%PDF")
+            assert not pool.process(str(path))  # mismo fichero otra vez: ya ingerido
+        assert session.posted == []
+        db = SessionLocal()
+        try:
+            invoice = db.query(Invoice).one()
+            assert invoice.file_path == str(tmp_path / "processed" / "f.pdf")
+            assert invoice.raw_text == "Factura O2 LOC-1"
+        finally:
+            db.close()
+
+    def _pool(self, tmp_path):
+        return UploadPool(workers=1, processed_dir=str(tmp_path / "processed"), dead_letter_dir=str(tmp_path / "failed"),
+                          session=FakeSession(), mode="local")
+
+    def test_rejected_invoice_keeps_original(self, tmp_path):
+        """Una factura duplicada no borra el fichero original: pasa a fallidos sin reintentos"""
+        db = SessionLocal()
+        db.add(Invoice(invoice_number="LOC-1", vendor_name="O2"))
+        db.commit()
+        db.close()
+        pool = self._pool(tmp_path)
+        path = tmp_path / "f.pdf"
+        path.write_bytes(b"%PDF")
+        with patch("backend.ingestion.extract_text", return_value="Factura O2 LOC-1"), \
+                patch("backend.ingestion.extract_invoice_data", return_value=self.EXTRACTED):
+            assert not pool.process(str(path))
+        assert not (tmp_path / "processed" / "f.pdf").exists()
+        assert (tmp_path / "failed" / "f.pdf").exists()
+        assert "duplicada" in (tmp_path / "failed" / "f.pdf.error.txt").read_text()
+        assert pool.manifest.get(str(path))[3] == "dead"
+
+    def test_failed_ingest_is_retried_then_dead_lettered(self, tmp_path):
+        """Si la factura no se guarda el original vuelve a su sitio, se reintenta y acaba en fallidos"""
+        pool = self._pool(tmp_path)
+        path = tmp_path / "f.pdf"
+        path.write_bytes(b"%PDF")
+        with patch.object(watcher, "MAX_ATTEMPTS", 2), \
+                patch("backend.ingestion.extract_text", return_value="Factura O2 LOC-1"), \
+                patch("backend.ingestion.extract_invoice_data", return_value=self.EXTRACTED):
+            with patch("backend.ingestion.save_extracted_invoice", side_effect=TimeoutError("db")):
+                assert not pool.process(str(path))
+            assert path.exists() and not (tmp_path / "processed" / "f.pdf").exists()
+            assert pool.manifest.get(str(path))[3:5] == ("retry", 1)
+            assert pool.manifest.due(now=time.time() + watcher.RETRY_BACKOFF + 1) == [str(path)]
+
+            error = {"status": "error", "reason": "invalid", "message": "database is locked"}
+            with patch("backend.ingestion.save_extracted_invoice", return_value=error):
+                assert not pool.process(str(path))
+        assert not path.exists()
+        assert (tmp_path / "failed" / "f.pdf").exists()
+        assert "database is locked" in (tmp_path / "failed" / "f.pdf.error.txt").read_text()
+        assert pool.manifest.get(str(path))[3] == "dead"
+
+    def test_same_name_new_content_is_ingested(self, tmp_path):
+        """Otro factura.pdf con distinto contenido se ingiere sin pisar el anterior; el mismo contenido no"""
+        pool = self._pool(tmp_path)
+        path = tmp_path / "f.pdf"
+        second = json.dumps({"invoice_number": "LOC-2", "vendor_name": "O2", "total_amount": 30.0})
+        with patch("backend.ingestion.extract_text", return_value="Factura O2"), \
+                patch("backend.ingestion.extract_invoice_data", side_effect=[self.EXTRACTED, second]) as extract:
+            path.write_bytes(b"%PDF enero")
+            assert pool.process(str(path))
+            path.write_bytes(b"%PDF febrero")
+            assert pool.process(str(path))
+
+            # Sin manifiesto (p. ej. borrado), el mismo contenido se reconoce por su hash
+            path.write_bytes(b"%PDF enero")
+            fresh = UploadPool(workers=1, processed_dir=str(tmp_path / "processed"), session=FakeSession(),
+                               mode="local", manifest=watcher.Manifest(":memory:"))
+            assert not fresh.process(str(path))
+        assert extract.call_count == 2
+        assert (tmp_path / "processed" / "f.pdf").read_bytes() == b"%PDF enero"
+        db = SessionLocal()
+        try:
+            paths = {invoice.invoice_number: invoice.file_path for invoice in db.query(Invoice)}
+        finally:
+            db.close()
+        assert paths["LOC-1"] == str(tmp_path / "processed" / "f.pdf")
+        with open(paths["LOC-2"], "rb") as f:
+            assert f.read() == b"%PDF febrero"
+
+    def test_unknown_mode(self):
+        """Un modo desconocido falla al arrancar"""
+        with pytest.raises(ValueError):
+            UploadPool(mode="ftp", session=FakeSession())
+
+
+class TestSubfolders:
+    """Tests para la vigilancia recursiva y los valores por defecto de cada carpeta"""
+
+    def _tree(self, tmp_path):
+        watch = tmp_path / "in"
+        (watch / "luz" / "2025").mkdir(parents=True)
+        (watch / ".oculta").mkdir()
+        (watch / ".watcher.json").write_text(json.dumps({"type": "Purchase"}))
+        (watch / "luz" / ".watcher.json").write_text(json.dumps({"category": "Electricity", "otro": 1}))
+        (watch / "a.pdf").write_bytes(b"%PDF raiz")
+        (watch / "luz" / "2025" / "a.pdf").write_bytes(b"%PDF luz")
+        (watch / ".oculta" / "c.pdf").write_bytes(b"%PDF oculta")
+        return watch
+
+    def _pool(self, tmp_path, watch, session, **kwargs):
+        return UploadPool(workers=1, api_url="http://api/upload", processed_dir=str(tmp_path / "processed"),
+                          dead_letter_dir=str(tmp_path / "failed"), session=session, watch_dir=str(watch), **kwargs)
+
+    def test_recursive_scan_skips_hidden(self, tmp_path):
+        """El escaneo inicial baja por las subcarpetas y se salta las ocultas"""
+        watch = self._tree(tmp_path)
+        pool = self._pool(tmp_path, watch, FakeSession(delay=0))
+        assert pool.scan() == 2
+        queued = {pool.queue.get_nowait(), pool.queue.get_nowait()}
+        assert queued == {str(watch / "a.pdf"), str(watch / "luz" / "2025" / "a.pdf")}
+
+    def test_metadata_inherited_and_cached(self, tmp_path):
+        """Las subcarpetas heredan y sobrescriben los valores; solo se admiten campos conocidos"""
+        watch = self._tree(tmp_path)
+        metadata = FolderMetadata(str(watch))
+        path = str(watch / "luz" / "2025" / "a.pdf")
+        assert metadata.for_file(path) == {"type": "Purchase", "category": "Electricity"}
+        assert metadata.for_file(str(watch / "a.pdf")) == {"type": "Purchase"}
+        assert metadata.for_file(str(tmp_path / "fuera.pdf")) == {}
+        with patch("backend.watcher.json.load") as load:
+            metadata.for_file(path)
+        load.assert_not_called()
+
+    def test_upload_keeps_folder_in_name_and_sends_defaults(self, tmp_path):
+        """Mismo nombre en dos carpetas: no se pisan en processed y cada uno lleva sus valores"""
+        watch = self._tree(tmp_path)
+        session = FakeSession(delay=0)
+        pool = self._pool(tmp_path, watch, session)
+        assert pool.process(str(watch / "a.pdf"))
+        assert pool.process(str(watch / "luz" / "2025" / "a.pdf"))
+        assert session.posted == ["a.pdf", "luz__2025__a.pdf"]
+        assert session.data == [{"invoice_type": "Purchase"}, {"category": "Electricity", "invoice_type": "Purchase"}]
+        assert (tmp_path / "processed" / "a.pdf").read_bytes() == b"%PDF raiz"
+        assert (tmp_path / "processed" / "luz" / "2025" / "a.pdf").read_bytes() == b"%PDF luz"
+
+    def test_local_mode_applies_defaults(self, tmp_path):
+        """En modo local la categoría de la carpeta sustituye a la que no encontró la extracción"""
+        watch = self._tree(tmp_path)
+        pool = self._pool(tmp_path, watch, FakeSession(), mode="local")
+        extracted = json.dumps({"invoice_number": "LUZ-1", "vendor_name": "Iberdrola", "category": "Other"})
+        with patch("backend.ingestion.extract_text", return_value="Factura Iberdrola LUZ-1"), \
+                patch("backend.ingestion.extract_invoice_data", return_value=extracted):
+            assert pool.process(str(watch / "luz" / "2025" / "a.pdf"))
+        db = SessionLocal()
+        try:
+            invoice = db.query(Invoice).one()
+            assert invoice.category == "Electricity"
+            assert invoice.file_path == str(tmp_path / "processed" / "luz" / "2025" / "a.pdf")
+        finally:
+            db.close()
+
+    def test_defaults_never_override_extraction(self):
+        """Los valores de la carpeta solo rellenan lo que la extracción dejó sin detectar"""
+        data = apply_defaults({"category": "Telecom", "type": "Purchase"}, {"category": "Electricity", "type": "Sale"})
+        assert data == {"category": "Telecom", "type": "Sale"}
+        assert apply_defaults({"category": "Other"}, {"category": None}) == {"category": "Other"}
+
+
+class TestInvoiceHandler:
+    """Tests para los eventos de watchdog"""
+
+    def test_events_only_queue(self, tmp_path):
+        """Los eventos encolan sin bloquear; los renombrados también cuentan"""
+        pool = MagicMock()
+        pool.submit.return_value = True
+        handler = InvoiceHandler(pool, debounce=0.01)
+        handler.on_created(SimpleNamespace(is_directory=False, src_path=str(tmp_path / "a.pdf")))
+        handler.on_created(SimpleNamespace(is_directory=False, src_path=str(tmp_path / "a.pdf.crdownload")))
+        handler.on_moved(SimpleNamespace(is_directory=False, src_path=str(tmp_path / "b.tmp"),
+                                         dest_path=str(tmp_path / "b.pdf")))
+        time.sleep(0.2)
+        handler.debouncer.stop()
+        assert sorted(c.args[0] for c in pool.submit.call_args_list) == [str(tmp_path / "a.pdf"),
+                                                                        str(tmp_path / "b.pdf")]
+
+    def test_burst_of_events_queues_once(self, tmp_path):
+        """created + varios modified de una copia se agrupan en una sola entrada"""
+        fired = []
+        debouncer = Debouncer(fired.append, delay=0.1)
+        for _ in range(5):
+            debouncer.touch("a.pdf")
+            time.sleep(0.02)
+        debouncer.touch("b.pdf")
+        assert fired == []  # sigue llegando actividad
+        time.sleep(0.3)
+        debouncer.stop()
+        assert fired == ["a.pdf", "b.pdf"]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
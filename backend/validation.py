@@ -0,0 +1,253 @@
+"""
+Motor de reglas para el workflow validar-factura.
+
+Comprueba en código lo que no necesita un LLM: campos obligatorios, fechas
+imposibles, importes a cero, cuadre base + impuestos = total, números de
+factura duplicados por proveedor y rangos razonables de consumo y precio.
+Devuelve el mismo esquema que validate_invoice (status/alerts/reasons/
+missing_fields). Solo los casos ambiguos (ninguna regla falla pero algo no
+encaja, p. ej. un tipo de IVA no estándar o un precio por unidad fuera de
+rango) se escalan al LLM.
+"""
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .database import Invoice
+
+REQUIRED_FIELDS = ("invoice_number", "vendor", "date", "total")
+PLACEHOLDERS = {"", "unknown", "desconocido", "n/a", "none"}
+MAX_AGE_YEARS = 10
+AMOUNT_TOLERANCE = 0.02  # céntimos de redondeo al cuadrar base + impuestos
+VAT_RATES = (0.21, 0.10, 0.05, 0.04, 0.0)
+VAT_TOLERANCE = 0.006
+
+# Consumo razonable por unidad (mín, máx por factura)
+CONSUMPTION_RANGES = {
+    "kwh": (1, 100000),
+    "m3": (0.1, 10000),
+    "gb": (0, 10000),
+    "min": (0, 100000),
+}
+# Precio por unidad razonable por categoría (EUR)
+UNIT_PRICE_RANGES = {
+    "Electricity": (0.03, 0.60),
+    "Gas": (0.02, 0.30),
+    "Water": (0.30, 6.00),
+}
+
+
+def _get(data: dict, *keys):
+    for key in keys:
+        value = data.get(key)
+        if value is not None:
+            return value
+    return None
+
+
+def _number(value):
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    text = str(value).strip()
+    try:
+        return datetime.fromisoformat(text).date()
+    except ValueError:
+        pass
+    for fmt in ("%d/%m/%Y", "%d-%m-%Y"):
+        try:
+            return datetime.strptime(text[:10], fmt).date()
+        except ValueError:
+            continue
+    raise ValueError(text)
+
+
+def normalize_invoice(data: dict) -> dict:
+    """Acepta el formato de la API (vendor/total/unit) o el de la tabla (vendor_name/total_amount...)"""
+    return {
+        "id": data.get("id"),
+        "invoice_number": _get(data, "invoice_number"),
+        "vendor": _get(data, "vendor", "vendor_name"),
+        "date": _get(data, "date"),
+        "total": _get(data, "total", "total_amount"),
+        "taxes": _get(data, "taxes", "tax", "iva"),
+        "base": _get(data, "base", "subtotal", "base_imponible"),
+        "consumption": _get(data, "consumption"),
+        "unit": _get(data, "unit", "consumption_unit"),
+        "unit_price": _get(data, "unit_price"),
+        "category": _get(data, "category"),
+    }
+
+
+class RuleResult:
+    def __init__(self):
+        self.alerts = []
+        self.reasons = []
+        self.missing_fields = []
+        self.ambiguous = []
+
+    def error(self, alert: str, reason: str):
+        self.alerts.append(alert)
+        self.reasons.append(reason)
+
+    def doubt(self, reason: str):
+        self.ambiguous.append(reason)
+
+    def as_dict(self) -> dict:
+        failed = bool(self.alerts or self.missing_fields)
+        return {
+            "status": "REVISAR" if failed or self.ambiguous else "OK",
+            "alerts": self.alerts,
+            "reasons": self.reasons + self.ambiguous,
+            "missing_fields": self.missing_fields,
+            "source": "rules",
+            "escalate": bool(self.ambiguous) and not failed,
+        }
+
+
+def check_invoice(data: dict, duplicate: bool = False, today: date = None) -> dict:
+    """Aplica todas las reglas a una factura (sin acceso a la base de datos)"""
+    inv = normalize_invoice(data)
+    today = today or date.today()
+    result = RuleResult()
+
+    # Campos obligatorios
+    for field in REQUIRED_FIELDS:
+        value = inv[field]
+        if value is None or (isinstance(value, str) and value.strip().lower() in PLACEHOLDERS):
+            result.missing_fields.append(field)
+    if result.missing_fields:
+        result.reasons.append(f"Faltan campos obligatorios: {', '.join(result.missing_fields)}")
+
+    # Importe
+    total = _number(inv["total"])
+    if inv["total"] is not None and total is None:
+        result.error("Importe no numérico", f"El total '{inv['total']}' no es un número")
+    elif total is not None:
+        if total == 0:
+            result.error("Importe total a cero", "El total de la factura es 0")
+        elif total < 0:
+            result.doubt(f"Importe negativo ({total}): puede ser un abono o un error de signo")
+
+    # Fecha
+    if inv["date"] is not None:
+        try:
+            when = _parse_date(inv["date"])
+        except ValueError:
+            result.error("Fecha no válida", f"No se reconoce la fecha '{inv['date']}'")
+        else:
+            if when > today + timedelta(days=1):
+                result.error("Fecha futura", f"La fecha {when} es posterior a hoy")
+            elif when < today - timedelta(days=365 * MAX_AGE_YEARS):
+                result.error("Fecha improbable", f"La fecha {when} tiene más de {MAX_AGE_YEARS} años")
+
+    # Base + impuestos = total
+    taxes, base = _number(inv["taxes"]), _number(inv["base"])
+    if total is not None and taxes is not None:
+        if taxes < 0 or (total > 0 and taxes > total):
+            result.error("Impuestos incoherentes", f"Impuestos {taxes} fuera de rango para un total de {total}")
+        elif base is not None:
+            if abs(base + taxes - total) > AMOUNT_TOLERANCE:
+                result.error("Descuadre de importes",
+                             f"Base {base} + impuestos {taxes} = {round(base + taxes, 2)} ≠ total {total}")
+        elif total - taxes > 0:
+            rate = taxes / (total - taxes)
+            if not any(abs(rate - r) <= VAT_TOLERANCE for r in VAT_RATES):
+                result.doubt(f"Tipo impositivo efectivo no estándar ({rate:.1%}); puede incluir otros impuestos")
+
+    # Duplicados (la comprobación con la base de datos la hace quien llama)
+    if duplicate:
+        result.error("Factura duplicada",
+                     f"Ya existe la factura {inv['invoice_number']} del proveedor {inv['vendor']}")
+
+    # Consumo y precio por unidad
+    consumption = _number(inv["consumption"])
+    unit = (inv["unit"] or "").strip().lower()
+    if consumption is not None:
+        if consumption < 0:
+            result.error("Consumo negativo", f"Consumo {consumption} {inv['unit'] or ''}".strip())
+        elif unit in CONSUMPTION_RANGES and consumption > 0:
+            low, high = CONSUMPTION_RANGES[unit]
+            if not low <= consumption <= high:
+                result.doubt(f"Consumo {consumption} {inv['unit']} fuera del rango habitual ({low}-{high})")
+    if consumption and consumption > 0 and total and total > 0:
+        unit_price = _number(inv["unit_price"])
+        if unit_price is not None and unit_price * consumption > total * 1.05:
+            result.error("Precio unitario incoherente",
+                         f"{unit_price} × {consumption} = {round(unit_price * consumption, 2)} supera el total {total}")
+        price_range = UNIT_PRICE_RANGES.get(inv["category"])
+        if price_range and unit in ("kwh", "m3"):
+            price = total / consumption
+            if not price_range[0] <= price <= price_range[1]:
+                result.doubt(f"Coste por unidad {price:.4f} EUR/{inv['unit']} fuera del rango habitual "
+                             f"{price_range[0]}-{price_range[1]}")
+
+    return result.as_dict()
+
+
+def is_duplicate(db: Session, data: dict) -> bool:
+    """¿Hay otra factura con el mismo número y proveedor?
+
+    Sin id, la fila guardada con el mismo número, proveedor y fecha es la
+    propia factura (validar invoice_data de una factura ya guardada) y no
+    cuenta como duplicado.
+    """
+    inv = normalize_invoice(data)
+    if not inv["invoice_number"] or str(inv["invoice_number"]).lower() in PLACEHOLDERS:
+        return False
+    query = db.query(Invoice.id, Invoice.date).filter(
+        Invoice.invoice_number == inv["invoice_number"], Invoice.vendor_name == inv["vendor"]
+    )
+    if inv["id"] is not None:
+        return query.filter(Invoice.id != inv["id"]).first() is not None
+    matches = query.limit(2).all()
+    try:
+        when = _parse_date(inv["date"]) if inv["date"] else None
+    except ValueError:
+        when = None
+    if when is not None and any(row.date and _parse_date(row.date) == when for row in matches):
+        return len(matches) > 1
+    return len(matches) > 0
+
+
+def validate_with_rules(db: Session, data: dict, today: date = None) -> dict:
+    return check_invoice(data, duplicate=is_duplicate(db, data), today=today)
+
+
+def validate_all(db: Session, today: date = None, only_issues: bool = True) -> dict:
+    """Valida todas las facturas en una pasada (duplicados con un único GROUP BY)"""
+    duplicates = {
+        (vendor, number) for vendor, number, _ in db.query(
+            Invoice.vendor_name, Invoice.invoice_number, func.count(Invoice.id)
+        ).filter(Invoice.invoice_number.isnot(None)).group_by(
+            Invoice.vendor_name, Invoice.invoice_number
+        ).having(func.count(Invoice.id) > 1)
+        if number and number.lower() not in PLACEHOLDERS
+    }
+    rows = db.query(
+        Invoice.id, Invoice.invoice_number, Invoice.vendor_name, Invoice.date, Invoice.total_amount,
+        Invoice.taxes, Invoice.consumption, Invoice.consumption_unit, Invoice.category
+    ).order_by(Invoice.id).yield_per(1000)
+
+    summary = {"OK": 0, "REVISAR": 0, "escalate": 0}
+    results = []
+    for row in rows:
+        data = dict(row._mapping)
+        result = check_invoice(data, duplicate=(row.vendor_name, row.invoice_number) in duplicates, today=today)
+        summary[result["status"]] += 1
+        summary["escalate"] += result["escalate"]
+        if result["status"] != "OK" or not only_issues:
+            results.append({"invoice_id": row.id, "invoice_number": row.invoice_number,
+                            "vendor": row.vendor_name, **result})
+    return {"checked": summary["OK"] + summary["REVISAR"], **summary, "results": results}
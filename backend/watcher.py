@@ -1,72 +1,534 @@
 import time
 import os
 import shutil
+import queue
+import hashlib
+import json
+import sqlite3
+import threading
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import requests
-import json
+from requests.adapters import HTTPAdapter
 
 # Configuration
-WATCH_DIR = "/app/backend/uploads"
-PROCESSED_DIR = "/app/backend/processed"
-API_URL = "http://app:8000/upload"
+WATCH_DIR = os.getenv("WATCH_DIR", "/app/backend/uploads")
+PROCESSED_DIR = os.getenv("PROCESSED_DIR", "/app/backend/processed")
+API_URL = os.getenv("WATCHER_API_URL", "http://app:8000/upload")
+# http: multipart POST to the API (remote setups). local: run the ingestion pipeline
+# in this process on the shared volume, with its own DB session (no HTTP hop, no second copy)
+WATCHER_MODE = os.getenv("WATCHER_MODE", "http").lower()
+WATCHER_WORKERS = int(os.getenv("WATCHER_WORKERS", "4"))  # Uploads in parallel
+WATCHER_QUEUE_SIZE = int(os.getenv("WATCHER_QUEUE_SIZE", "100"))  # Pending files before the observer blocks
+STABLE_INTERVAL = float(os.getenv("WATCHER_STABLE_INTERVAL", "1.0"))  # Seconds between size/mtime polls
+STABLE_CHECKS = int(os.getenv("WATCHER_STABLE_CHECKS", "2"))  # Consecutive unchanged polls
+STABLE_TIMEOUT = float(os.getenv("WATCHER_STABLE_TIMEOUT", "300"))  # Give up on files still growing
+UPLOAD_TIMEOUT = float(os.getenv("WATCHER_UPLOAD_TIMEOUT", "300"))
+# Durable state: hash and state of every file seen, so restarts only look at new files
+MANIFEST_PATH = os.getenv("WATCHER_MANIFEST", os.path.join(PROCESSED_DIR, ".watcher_manifest.db"))
+DEAD_LETTER_DIR = os.getenv("WATCHER_DEAD_LETTER_DIR", "/app/backend/failed")
+MAX_ATTEMPTS = int(os.getenv("WATCHER_MAX_ATTEMPTS", "5"))
+RETRY_BACKOFF = float(os.getenv("WATCHER_RETRY_BACKOFF", "30"))  # Seconds, doubled on every attempt
 
-class InvoiceHandler(FileSystemEventHandler):
-    def on_created(self, event):
-        if event.is_directory:
-            return
-        
-        filename = os.path.basename(event.src_path)
-        # Skip incomplete downloads or hidden files
-        if filename.startswith('.') or filename.endswith('.crdownload'):
-            return
-            
-        # Allowed extensions
-        if not any(filename.lower().endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.pdf']):
-            return
-            
-        print(f"New file detected: {filename}")
-        time.sleep(2) # Wait for file to be completely written
-        
+DEBOUNCE_SECONDS = float(os.getenv("WATCHER_DEBOUNCE", "0.5"))  # Quiet time before a burst of events is queued
+# Per-folder defaults: a .watcher.json in any subfolder, e.g. {"category": "Electricity", "type": "Purchase"}.
+# Subfolders inherit and override their parents' values.
+FOLDER_META_FILE = ".watcher.json"
+FOLDER_FIELDS = {"category": "category", "type": "invoice_type"}  # metadata key -> /upload form field
+
+ALLOWED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.pdf')
+
+
+def is_candidate(filename: str) -> bool:
+    # Skip incomplete downloads, hidden files and unsupported extensions
+    if filename.startswith('.') or filename.endswith('.crdownload'):
+        return False
+    return filename.lower().endswith(ALLOWED_EXTENSIONS)
+
+
+def wait_until_stable(path: str, interval: float = None, checks: int = None, timeout: float = None) -> bool:
+    """True once size and mtime stay unchanged for `checks` polls (file completely written)"""
+    interval = STABLE_INTERVAL if interval is None else interval
+    checks = STABLE_CHECKS if checks is None else checks
+    timeout = STABLE_TIMEOUT if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    last, unchanged = None, 0
+    while time.monotonic() < deadline:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        current = (stat.st_size, stat.st_mtime_ns)
+        if current == last and stat.st_size > 0:
+            unchanged += 1
+            if unchanged >= checks:
+                return True
+        else:
+            unchanged = 0
+        last = current
+        time.sleep(interval)
+    return False
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class UploadError(Exception):
+    """The API did not accept the file (retried with backoff)"""
+
+
+class RejectedError(UploadError):
+    """The invoice was rejected for good (duplicate): dead-lettered without retrying"""
+
+
+class Manifest:
+    """SQLite checkpoint of every file: hash, state, attempts and next retry.
+
+    States: pending (queued or in progress), retry (failed, waiting for
+    next_attempt_at), done (uploaded, or same content already uploaded) and
+    dead (moved to the dead-letter folder after MAX_ATTEMPTS).
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path or MANIFEST_PATH
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, mtime_ns INTEGER, "
+                "state TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt_at REAL, last_error TEXT, updated_at REAL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_files_sha256_state ON files (sha256, state)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_files_state_next ON files (state, next_attempt_at)")
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def get(self, path: str):
+        rows = self._execute("SELECT sha256, size, mtime_ns, state, attempts, last_error FROM files WHERE path = ?",
+                             (path,))
+        return rows[0] if rows else None
+
+    def is_settled(self, path: str, stat) -> bool:
+        """Known file with the same size/mtime that needs nothing now (done, or waiting to retry)"""
+        row = self.get(path)
+        return bool(row) and (row[1], row[2]) == (stat.st_size, stat.st_mtime_ns) and row[3] in ("done", "retry")
+
+    def checkpoint(self, path: str) -> tuple:
+        """Record the file before sending it. Returns (sha256, already_done)."""
+        stat = os.stat(path)
+        row = self.get(path)
+        if row and row[0] and (row[1], row[2]) == (stat.st_size, stat.st_mtime_ns):
+            digest = row[0]  # Unchanged: no need to hash again
+        else:
+            digest = file_sha256(path)
+        if self._execute("SELECT 1 FROM files WHERE sha256 = ? AND state = 'done' LIMIT 1", (digest,)):
+            self._upsert(path, digest, stat, "done", last_error="Same content already processed")
+            return digest, True
+        attempts = row[4] if row and row[0] == digest else 0
+        self._upsert(path, digest, stat, "pending", attempts=attempts)
+        return digest, False
+
+    def _upsert(self, path, digest, stat, state, attempts=0, last_error=None):
+        self._execute(
+            "INSERT INTO files (path, sha256, size, mtime_ns, state, attempts, last_error, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(path) DO UPDATE SET sha256 = excluded.sha256, "
+            "size = excluded.size, mtime_ns = excluded.mtime_ns, state = excluded.state, "
+            "attempts = excluded.attempts, last_error = excluded.last_error, next_attempt_at = NULL, "
+            "updated_at = excluded.updated_at",
+            (path, digest, stat.st_size, stat.st_mtime_ns, state, attempts, last_error, time.time()),
+        )
+
+    def mark_done(self, path: str):
+        self._execute("UPDATE files SET state = 'done', last_error = NULL, next_attempt_at = NULL, updated_at = ? "
+                      "WHERE path = ?", (time.time(), path))
+
+    def mark_failed(self, path: str, error: str, max_attempts: int = None, backoff: float = None) -> str:
+        """One more failed attempt: 'retry' (with exponential backoff) or 'dead'"""
+        max_attempts = max_attempts or MAX_ATTEMPTS
+        backoff = RETRY_BACKOFF if backoff is None else backoff
+        row = self.get(path)
+        attempts = (row[4] if row else 0) + 1
+        state = "dead" if attempts >= max_attempts else "retry"
+        next_at = time.time() + backoff * 2 ** (attempts - 1) if state == "retry" else None
+        self._execute("UPDATE files SET state = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ? "
+                      "WHERE path = ?", (state, attempts, next_at, str(error)[:2000], time.time(), path))
+        return state
+
+    def due(self, now: float = None) -> list:
+        """Paths whose retry time has come"""
+        now = time.time() if now is None else now
+        return [row[0] for row in self._execute(
+            "SELECT path FROM files WHERE state = 'retry' AND next_attempt_at <= ? ORDER BY next_attempt_at", (now,)
+        )]
+
+    def counts(self) -> dict:
+        return dict(self._execute("SELECT state, count(*) FROM files GROUP BY state"))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class FolderMetadata:
+    """Defaults for the files of each folder, merged from the watch root down (cached by mtime)"""
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self._cache = {}  # meta file path -> (mtime_ns, values)
+        self._lock = threading.Lock()
+
+    def _load(self, directory: str) -> dict:
+        meta_path = os.path.join(directory, FOLDER_META_FILE)
+        try:
+            mtime = os.stat(meta_path).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        with self._lock:
+            cached = self._cache.get(meta_path)
+            if cached and cached[0] == mtime:
+                return cached[1]
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                values = {k: v for k, v in json.load(f).items() if k in FOLDER_FIELDS}
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"Ignoring {meta_path}: {str(e)}")
+            values = {}
+        with self._lock:
+            self._cache[meta_path] = (mtime, values)
+        return values
+
+    def for_file(self, path: str) -> dict:
+        directory = os.path.dirname(os.path.abspath(path))
+        relative = os.path.relpath(directory, self.root)
+        if relative.startswith(os.pardir):
+            return {}
+        values, current = {}, self.root
+        values.update(self._load(current))
+        if relative != os.curdir:
+            for part in relative.split(os.sep):
+                current = os.path.join(current, part)
+                values.update(self._load(current))
+        return values
+
+
+class Debouncer:
+    """Coalesces bursts of events: `callback(path)` runs once a path has been quiet for `delay` seconds"""
+
+    def __init__(self, callback, delay: float = None):
+        self.callback = callback
+        self.delay = DEBOUNCE_SECONDS if delay is None else delay
+        self._pending = {}  # path -> time of the last event
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="watcher-debounce", daemon=True)
+        self._thread.start()
+
+    def touch(self, path: str):
+        with self._cond:
+            self._pending[path] = time.monotonic()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                now = time.monotonic()
+                due = [path for path, last in self._pending.items() if now - last >= self.delay]
+                for path in due:
+                    del self._pending[path]
+                if not due:
+                    self._cond.wait(min(self._pending.values()) + self.delay - now)
+                    continue
+            for path in due:
+                self.callback(path)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+
+def create_session(pool_size: int = None) -> requests.Session:
+    """Keep-alive session shared by all upload workers (one connection per worker)"""
+    pool_size = pool_size or WATCHER_WORKERS
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class UploadPool:
+    """Bounded queue of files plus a fixed number of upload threads"""
+
+    def __init__(self, workers: int = None, api_url: str = None, processed_dir: str = None,
+                 session: requests.Session = None, queue_size: int = None, mode: str = None,
+                 manifest: Manifest = None, dead_letter_dir: str = None, watch_dir: str = None,
+                 metadata: FolderMetadata = None):
+        self.workers = workers or WATCHER_WORKERS
+        self.api_url = api_url or API_URL
+        self.processed_dir = processed_dir or PROCESSED_DIR
+        self.dead_letter_dir = dead_letter_dir or DEAD_LETTER_DIR
+        self.watch_dir = os.path.abspath(watch_dir or WATCH_DIR)
+        self.metadata = metadata or FolderMetadata(self.watch_dir)
+        self.manifest = manifest or Manifest(
+            MANIFEST_PATH if processed_dir is None else os.path.join(processed_dir, ".watcher_manifest.db")
+        )
+        self.mode = mode or WATCHER_MODE
+        if self.mode not in ("http", "local"):
+            raise ValueError(f"Unknown WATCHER_MODE: {self.mode} (http or local)")
+        self.session = session or create_session(self.workers)
+        self.queue = queue.Queue(maxsize=queue_size or WATCHER_QUEUE_SIZE)
+        self._queued = set()  # Paths waiting or in progress (created + modified events arrive together)
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"watcher-upload-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def submit(self, path: str) -> bool:
+        """Queue a file (blocks when the queue is full). False if already queued."""
+        with self._lock:
+            if path in self._queued:
+                return False
+            self._queued.add(path)
+        self.queue.put(path)
+        return True
+
+    def _run(self):
+        while True:
+            path = self.queue.get()
+            if path is None:
+                self.queue.task_done()
+                return
+            try:
+                self.process(path)
+            finally:
+                with self._lock:
+                    self._queued.discard(path)
+                self.queue.task_done()
+
+    def relative_path(self, path: str) -> str:
+        """Path below the watch folder (just the name for files outside it)"""
+        relative = os.path.relpath(os.path.abspath(path), self.watch_dir)
+        return os.path.basename(path) if relative.startswith(os.pardir) else relative
+
+    def process(self, path: str) -> bool:
+        filename = os.path.basename(path)
+        if not wait_until_stable(path):
+            print(f"Skipping {filename}: file disappeared or kept changing")
+            return False
         try:
-            with open(event.src_path, 'rb') as f:
-                files = {'file': (filename, f)}
-                response = requests.post(API_URL, files=files)
-                if response.status_code == 200:
-                    print(f"Successfully processed {filename}")
-                    # Move to uploads once processed
-                    os.makedirs(PROCESSED_DIR, exist_ok=True)
-                    shutil.move(event.src_path, os.path.join(PROCESSED_DIR, filename))
-                else:
-                    print(f"Error processing {filename}: {response.text}")
+            digest, already_done = self.manifest.checkpoint(path)
+            if already_done:
+                print(f"Skipping {filename}: same content already processed")
+                return False
+            handled = self.ingest_local(path, digest) if self.mode == "local" else self.send_http(path, digest)
         except Exception as e:
-            print(f"Failed to process {filename}: {str(e)}")
+            self.fail(path, e)
+            return False
+        self.manifest.mark_done(path)
+        return handled
+
+    def fail(self, path: str, error: Exception):
+        """Schedule a retry, or move a poison file to the dead-letter folder with its error"""
+        filename = os.path.basename(path)
+        state = self.manifest.mark_failed(path, error, max_attempts=1 if isinstance(error, RejectedError) else None)
+        if state == "retry":
+            print(f"Failed to process {filename}: {str(error)} (will retry)")
+            return
+        target = os.path.join(self.dead_letter_dir, self.relative_path(path))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(path):
+            shutil.move(path, target)
+        with open(target + ".error.txt", "w", encoding="utf-8") as f:
+            f.write(f"{type(error).__name__}: {error}\n")
+        print(f"Giving up on {filename} ({error}): moved to {self.dead_letter_dir}")
+
+    def retry_due(self) -> int:
+        """Queue the files whose backoff has expired"""
+        return sum(1 for path in self.manifest.due() if os.path.exists(path) and self.submit(path))
+
+    def scan(self, directory: str = None) -> int:
+        """Queue the files below `directory` that the manifest has not settled (only new files are hashed).
+
+        Walks the tree with os.scandir (one stat per entry, cached by the OS
+        listing) and skips hidden folders.
+        """
+        queued, pending = 0, [directory or self.watch_dir]
+        while pending:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not entry.name.startswith('.'):
+                            pending.append(entry.path)
+                    elif entry.is_file() and is_candidate(entry.name) \
+                            and not self.manifest.is_settled(entry.path, entry.stat()):
+                        queued += self.submit(entry.path)
+        return queued
+
+    def send_http(self, path: str, digest: str = None) -> bool:
+        filename = os.path.basename(path)
+        # Subfolders travel in the name (a/b.pdf -> a__b.pdf) so equal names in different folders don't clash
+        upload_name = self.relative_path(path).replace(os.sep, "__")
+        meta = self.metadata.for_file(path)
+        data = {field: meta[key] for key, field in FOLDER_FIELDS.items() if meta.get(key)}
+        with open(path, 'rb') as f:
+            files = {'file': (upload_name, f)}
+            response = self.session.post(self.api_url, files=files, data=data, timeout=UPLOAD_TIMEOUT)
+        if response.status_code != 200:
+            raise UploadError(f"HTTP {response.status_code}: {response.text[:500]}")
+        # /upload answers 200 with {"status": "error"} for duplicates and for invoices it could not save
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        if isinstance(body, dict) and body.get("status") == "error":
+            error = RejectedError if body.get("reason") == "duplicate" else UploadError
+            raise error(body.get("message") or response.text[:500])
+        print(f"Successfully processed {filename}")
+        # Move to processed once uploaded
+        self.move_to_processed(path, digest)
+        return True
+
+    def ingest_local(self, path: str, digest: str = None) -> bool:
+        """Extraction, LLM, regex rescue and DB write in this process (WATCHER_MODE=local)"""
+        from .database import SessionLocal, Invoice
+        from .ingestion import process_file
+
+        filename = os.path.basename(path)
+        digest = digest or file_sha256(path)
+        defaults = self.metadata.for_file(path)
+        db = SessionLocal()
+        try:
+            # Same content already in processed/ with its invoice (scanners reuse names: never by name alone)
+            for candidate in self.processed_candidates(path, digest):
+                if os.path.exists(candidate) and file_sha256(candidate) == digest:
+                    existing = db.query(Invoice).filter(Invoice.file_path == candidate).first()
+                    if existing:
+                        print(f"Skipping {filename}: already ingested (Nº {existing.invoice_number})")
+                        return False
+            # Same volume: a rename, not a copy. The invoice points at its final location.
+            target = self.move_to_processed(path, digest)
+            try:
+                result = process_file(db, target, filename, remove_on_error=False, defaults=defaults)
+                if result.get("status") != "success":
+                    error = RejectedError if result.get("reason") == "duplicate" else UploadError
+                    raise error(result.get("message"))
+            except Exception:
+                # Back to the watch folder: the manifest retries (or dead-letters) the original path
+                shutil.move(target, path)
+                raise
+        finally:
+            db.close()
+        print(f"Successfully processed {filename}")
+        return True
+
+    def processed_candidates(self, path: str, digest: str) -> list:
+        """Where the file may land in processed/: its relative path, or name-<sha256 prefix> if that is taken"""
+        # Keep the subfolder layout so equal names in different folders don't overwrite each other
+        target = os.path.join(self.processed_dir, self.relative_path(path))
+        stem, ext = os.path.splitext(target)
+        return [target, f"{stem}-{digest[:12]}{ext}"]
+
+    def move_to_processed(self, path: str, digest: str = None) -> str:
+        """Move into processed/ without ever overwriting a file already there"""
+        for target in self.processed_candidates(path, digest or file_sha256(path)):
+            if not os.path.exists(target):
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.move(path, target)
+                return target
+        raise UploadError(f"{target} already exists in {self.processed_dir}")
+
+    def join(self):
+        """Wait until every queued file has been processed"""
+        self.queue.join()
+
+    def stop(self):
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self.session.close()
+        self.manifest.close()
+
+
+class InvoiceHandler(FileSystemEventHandler):
+    """Watchdog callbacks only touch the debouncer: the observer thread never sleeps or uploads.
+
+    A copy fires created + several modified events; the file is queued once,
+    after DEBOUNCE_SECONDS without events for it.
+    """
+
+    def __init__(self, pool: UploadPool, debounce: float = None):
+        super().__init__()
+        self.pool = pool
+        self.debouncer = Debouncer(self.submit, debounce)
+
+    def submit(self, path: str):
+        if self.pool.submit(path):
+            print(f"New file detected: {self.pool.relative_path(path)}")
+
+    def queue_file(self, path: str):
+        if is_candidate(os.path.basename(path)):
+            self.debouncer.touch(path)
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.queue_file(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.queue_file(event.src_path)
+
+    def on_moved(self, event):
+        # Browsers and scanners write to a temp name and rename when done
+        if not event.is_directory:
+            self.queue_file(event.dest_path)
+
 
 if __name__ == "__main__":
     os.makedirs(WATCH_DIR, exist_ok=True)
-    print(f"Starting watcher... Monitoring: {WATCH_DIR}")
-    
-    # Process existing files first
-    handler = InvoiceHandler()
-    files = os.listdir(WATCH_DIR)
-    print(f"Found {len(files)} existing files in {WATCH_DIR}")
-    
-    for f in files:
-        print(f"Checking existing file: {f}")
-        if not f.endswith('.crdownload') and not f.startswith('.'):
-            path = os.path.join(WATCH_DIR, f)
-            class MockEvent:
-                src_path = path
-                is_directory = False
-            handler.on_created(MockEvent())
+    print(f"Starting watcher... Monitoring: {WATCH_DIR} ({WATCHER_WORKERS} workers, mode: {WATCHER_MODE})")
+
+    pool = UploadPool().start()
+    handler = InvoiceHandler(pool)
+
+    # Process existing files first (files already done or waiting to retry are skipped)
+    queued = pool.scan(WATCH_DIR)
+    print(f"Queued {queued} existing files in {WATCH_DIR} (manifest: {pool.manifest.counts()})")
 
     observer = Observer()
-    observer.schedule(handler, WATCH_DIR, recursive=False)
+    observer.schedule(handler, WATCH_DIR, recursive=True)
     observer.start()
     print(f"Monitoring folder: {WATCH_DIR}")
     try:
         while True:
             time.sleep(1)
+            pool.retry_due()
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    handler.debouncer.stop()
+    pool.stop()
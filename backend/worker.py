@@ -0,0 +1,147 @@
+"""
+Worker de extracción: procesa la cola de trabajos (jobs.py) fuera de la API.
+
+    python -m backend.worker            # bucle continuo
+    python -m backend.worker --once     # un solo trabajo (si lo hay) y sale
+
+Cada réplica reclama trabajos distintos (SKIP LOCKED), así que la ingesta
+escala añadiendo réplicas del servicio `worker` en docker-compose.yml.
+Mientras procesa, un hilo renueva el plazo de visibilidad cada
+WORKER_HEARTBEAT_SECONDS; si el worker muere, otro retoma el trabajo al
+vencer el plazo.
+"""
+import argparse
+import logging
+import os
+import socket
+import threading
+
+from .database import SessionLocal, init_db
+from .ingestion import process_file
+from .enrichment import enrich_pending
+from . import jobs
+
+logger = logging.getLogger(__name__)
+
+WORKER_POLL_SECONDS = float(os.getenv("WORKER_POLL_SECONDS", "2"))
+WORKER_HEARTBEAT_SECONDS = float(os.getenv("WORKER_HEARTBEAT_SECONDS", str(jobs.JOB_VISIBILITY_TIMEOUT / 3)))
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Heartbeat(threading.Thread):
+    """Renueva el plazo de visibilidad del trabajo en curso (sesión propia: las sesiones no se comparten entre hilos)"""
+
+    def __init__(self, job_id: int, worker_id: str, interval: float = None):
+        super().__init__(daemon=True, name=f"heartbeat-{job_id}")
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.interval = interval or WORKER_HEARTBEAT_SECONDS
+        self.lost = False
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            db = SessionLocal()
+            try:
+                if not jobs.heartbeat(db, self.job_id, self.worker_id):
+                    self.lost = True
+                    logger.warning(f"⚠️ Trabajo {self.job_id}: plazo perdido, lo ha retomado otro worker")
+                    return
+            except Exception as e:
+                logger.error(f"❌ Latido del trabajo {self.job_id}: {e}")
+            finally:
+                db.close()
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+def process_job(job_id: int, file_path: str, file_name: str, worker_id: str) -> str:
+    """Ejecuta el pipeline de un trabajo reclamado y registra el resultado. Devuelve el estado final."""
+    beat = Heartbeat(job_id, worker_id)
+    beat.start()
+    db = SessionLocal()
+    try:
+        if not os.path.exists(file_path):
+            return jobs.fail_job(db, job_id, worker_id, f"No existe el fichero {file_path}", retry=False)
+        result = process_file(db, file_path, file_name)
+        db.rollback()  # por si el pipeline dejó la sesión a medias
+        if not jobs.complete_job(db, job_id, worker_id, result):
+            logger.warning(f"⚠️ Trabajo {job_id}: resultado descartado, ya no pertenece a {worker_id}")
+            return None
+        status = "failed" if result.get("status") == "error" else "done"
+        logger.info(f"✅ Trabajo {job_id} ({file_name}) → {status}")
+        return status
+    except Exception as e:
+        db.rollback()
+        return jobs.fail_job(db, job_id, worker_id, e)
+    finally:
+        beat.stop()
+        db.close()
+
+
+def run_once(worker_id: str) -> bool:
+    """Reclama y procesa un trabajo. False si la cola está vacía."""
+    db = SessionLocal()
+    try:
+        job = jobs.claim_job(db, worker_id)
+        if job is None:
+            return False
+        job_id, file_path, file_name = job.id, job.file_path, job.file_name
+    finally:
+        db.close()
+    logger.info(f"🔧 {worker_id} procesa el trabajo {job_id} ({file_name})")
+    process_job(job_id, file_path, file_name, worker_id)
+    return True
+
+
+def run_worker(worker_id: str = None, stop: threading.Event = None, max_jobs: int = None) -> int:
+    """Bucle del worker hasta stop o max_jobs. Devuelve los trabajos procesados."""
+    worker_id = worker_id or default_worker_id()
+    stop = stop or threading.Event()
+    processed = 0
+    while not stop.is_set() and (max_jobs is None or processed < max_jobs):
+        try:
+            if run_once(worker_id):
+                processed += 1
+                continue
+            db = SessionLocal()
+            try:
+                jobs.expire_jobs(db)
+                # Sin trabajos: completar facturas que /upload dejó pendientes (p. ej. tras un reinicio)
+                if enrich_pending(db, limit=1):
+                    processed += 1
+                    continue
+            finally:
+                db.close()
+        except Exception as e:
+            logger.error(f"❌ Worker {worker_id}: {e}")
+        stop.wait(WORKER_POLL_SECONDS)
+    return processed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Worker de extracción de facturas")
+    parser.add_argument("--once", action="store_true", help="Procesar un trabajo (si lo hay) y salir")
+    parser.add_argument("--worker-id", default=None)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    init_db()
+    worker_id = args.worker_id or default_worker_id()
+    if args.once:
+        run_once(worker_id)
+        return
+    print(f"👷 Worker {worker_id} esperando trabajos...")
+    try:
+        run_worker(worker_id)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()